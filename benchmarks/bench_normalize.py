@@ -0,0 +1,52 @@
+import re
+import sys
+import random
+from pathlib import Path
+# Add the project directory to the PYTHONPATH
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest
+from lib.processing_docs import normalize_text
+
+## pytest-benchmark suite of the text normalization. It compares normalize_text with the normalization used before,
+## on texts of 1 KB to 10 MB. The rules of normalize_text are checked by tests/test_normalize.py.
+# Usage (from the main directory, needs pytest and pytest-benchmark): python -m pytest benchmarks/bench_normalize.py
+# Compare with a saved run: python -m pytest benchmarks/bench_normalize.py --benchmark-autosave --benchmark-compare
+
+SIZES = {"1KB": 1024, "100KB": 100 * 1024, "1MB": 1024 * 1024, "10MB": 10 * 1024 * 1024}
+
+# Pieces of text with the characters changed by the normalization
+WORDS = ["the", "document", "answer", "Qdrant", "embeddings", "#title", "end.", "dots..", ". .", "list. ,", "a,", "\n", "\t", "  "]
+
+# The normalization used before, two regular expressions compiled on every call and five str.replace
+def legacy_normalize_text(s):
+    s = re.sub(r'\s+', ' ', s).strip()
+    s = re.sub(r". ,", "", s)
+    s = s.replace("..", ".")
+    s = s.replace(". .", ".")
+    s = s.replace("\n", "")
+    s = s.replace("#", "")
+    s = s.strip()
+    return s
+
+# Build a random text of about size characters, the same for every run
+def make_text(size, seed=0):
+    rng = random.Random(seed)
+    pieces, length = [], 0
+    while length < size:
+        word = rng.choice(WORDS)
+        pieces.append(word)
+        length += len(word) + 1
+    return " ".join(pieces)[:size]
+
+@pytest.fixture(scope="module", params=list(SIZES), ids=list(SIZES))
+def text(request):
+    return make_text(SIZES[request.param])
+
+@pytest.mark.benchmark(group="normalize")
+def test_legacy_normalize_text(benchmark, text):
+    benchmark(legacy_normalize_text, text)
+
+@pytest.mark.benchmark(group="normalize")
+def test_normalize_text(benchmark, text):
+    benchmark(normalize_text, text)
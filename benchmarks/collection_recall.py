@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+from pathlib import Path
+from datetime import datetime, timezone
+# Add the project directory to the PYTHONPATH
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import numpy as np
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.http.models import PointStruct, SearchParams
+import lib.collection as collection
+from e2e import git_revision, percentile
+
+## Recall and latency of the settings of the Qdrant collection. The same vectors are stored in one collection per
+## quantization, with the HNSW parameters of the command line, and every collection is searched with several values
+## of hnsw_ef. The results are compared with the exact nearest neighbours computed with numpy, so the report shows
+## how much recall every setting trades for its latency and for the RAM used by the vectors.
+# Usage (from the main directory, with Qdrant running on localhost:6333): python benchmarks/collection_recall.py
+# Use the vectors of the collection of the API: python benchmarks/collection_recall.py --source <collection>
+# The embedded Qdrant (--local) always searches exactly, it only checks that the benchmark runs.
+
+# Prefix of the collections created by the benchmark
+PREFIX = "recall_benchmark"
+
+# Generate clustered unit vectors, close to the embeddings of documents about a few topics
+def generate_vectors(rng, count, dimension, centers):
+    """
+    Generate unit vectors around random centers.
+
+    Args:
+        rng (numpy.random.Generator): The random generator.
+        count (int): The number of vectors.
+        dimension (int): The size of the vectors.
+        centers (numpy.ndarray): The centers of the clusters.
+
+    Returns:
+        numpy.ndarray: The vectors, one per row.
+    """
+    vectors = centers[rng.integers(0, len(centers), count)] + rng.normal(0, 0.6, (count, dimension)) / np.sqrt(dimension) * 4
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+# Load the vectors of an existing collection
+async def load_vectors(client_vdb, collection_name, limit):
+    """
+    Read the vectors of a collection.
+
+    Args:
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
+        collection_name (str): The name of the collection.
+        limit (int): The maximum number of vectors.
+
+    Returns:
+        numpy.ndarray: The normalized vectors, one per row.
+    """
+    vectors, offset = [], None
+    while len(vectors) < limit:
+        points, offset = await client_vdb.scroll(
+            collection_name=collection_name, limit=min(256, limit - len(vectors)), offset=offset, with_vectors=True,
+        )
+        vectors.extend(point.vector for point in points)
+        if offset is None:
+            break
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+# Wait until Qdrant has built the index of all the vectors of a collection
+async def wait_indexed(client_vdb, collection_name, points, timeout=600):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        info = await client_vdb.get_collection(collection_name)
+        if info.status.value == "green" and (info.indexed_vectors_count or 0) >= points:
+            return time.perf_counter() - start
+        await asyncio.sleep(0.5)
+    raise TimeoutError(f"{collection_name} was not indexed after {timeout} seconds")
+
+# Estimate the RAM used by the vectors of a collection
+def vectors_ram_mb(qdrant, points, dimension):
+    """
+    Estimate the megabytes of RAM of the vectors, without the HNSW graph.
+
+    Args:
+        qdrant (dict): The settings of the collection, as in the qdrant section of the configuration file.
+        points (int): The number of vectors.
+        dimension (int): The size of the vectors.
+
+    Returns:
+        float: The megabytes of the original vectors kept in RAM plus the quantized vectors.
+    """
+    ram = 0 if qdrant.get('on_disk_vectors') else points * dimension * 4
+    if qdrant.get('quantization_always_ram', True):
+        ram += {"none": 0, "scalar": points * dimension, "binary": points * dimension / 8}[qdrant['quantization']]
+    return round(ram / 1024 / 1024, 1)
+
+# Search all the queries one at a time
+async def run_searches(client_vdb, collection_name, queries, truth, top_k, search_params):
+    """
+    Search the queries in a collection and compare the results with the exact neighbours.
+
+    Args:
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
+        collection_name (str): The name of the collection.
+        queries (numpy.ndarray): The query vectors.
+        truth (numpy.ndarray): The ids of the exact top_k neighbours of every query.
+        top_k (int): The number of results of every search.
+        search_params (SearchParams): The parameters of the searches.
+
+    Returns:
+        dict: The mean recall at top_k, the latency percentiles in milliseconds and the searches per second.
+    """
+    latencies, recalls = [], []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        hits = await client_vdb.search(
+            collection_name=collection_name, query_vector=query.tolist(), limit=top_k,
+            search_params=search_params, with_payload=False,
+        )
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len({hit.id for hit in hits} & set(expected.tolist())) / top_k)
+    latencies.sort()
+    return {
+        "recall": round(float(np.mean(recalls)), 4),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "searches_per_second": round(len(latencies) / sum(latencies), 1),
+    }
+
+async def run_benchmark(args):
+    client_vdb = AsyncQdrantClient(location=":memory:") if args.local else AsyncQdrantClient(args.host, port=args.port, timeout=600)
+    rng = np.random.default_rng(args.seed)
+    if args.source:
+        vectors = await load_vectors(client_vdb, args.source, args.points)
+        queries = vectors[rng.choice(len(vectors), args.queries, replace=len(vectors) < args.queries)]
+        queries = queries + rng.normal(0, 0.02, queries.shape).astype(np.float32)
+    else:
+        centers = rng.normal(0, 1, (args.clusters, args.dimension)) / np.sqrt(args.dimension)
+        vectors = generate_vectors(rng, args.points, args.dimension, centers)
+        queries = generate_vectors(rng, args.queries, args.dimension, centers)
+    points, dimension = vectors.shape
+    # The exact neighbours of the queries, the vectors are normalized so the dot product is the cosine similarity
+    truth = np.argsort(-(queries @ vectors.T), axis=1)[:, :args.top_k]
+    print(f"{points} vectors of {dimension} dimensions, {len(queries)} queries, recall at {args.top_k}")
+
+    results = []
+    try:
+        for quantization in args.quantization:
+            qdrant = {
+                "quantization": quantization,
+                "hnsw_m": args.m,
+                "hnsw_ef_construct": args.ef_construct,
+                "on_disk_vectors": args.on_disk,
+                "on_disk_payload": True,
+                "quantization_rescore": not args.no_rescore,
+                "quantization_oversampling": args.oversampling,
+                "local_path": ":memory:" if args.local else None,
+            }
+            name = f"{PREFIX}_{quantization}"
+            if await client_vdb.collection_exists(name):
+                await client_vdb.delete_collection(name)
+            await collection.create_collection(client_vdb, name, qdrant, dimension)
+            start = time.perf_counter()
+            for first in range(0, points, 256):
+                await client_vdb.upsert(collection_name=name, points=[
+                    PointStruct(id=first + n, vector=vector.tolist()) for n, vector in enumerate(vectors[first:first + 256])
+                ])
+            upload_seconds = time.perf_counter() - start
+            index_seconds = 0 if args.local else await wait_indexed(client_vdb, name, points)
+            # Warm the caches of Qdrant before measuring
+            await run_searches(client_vdb, name, queries[:10], truth[:10], args.top_k, collection.search_params(qdrant))
+
+            searches = [("exact", SearchParams(exact=True))] if quantization == "none" else []
+            searches += [(ef, collection.search_params({**qdrant, "hnsw_ef": ef})) for ef in args.ef]
+            for ef, search_params in searches:
+                result = {
+                    "quantization": quantization,
+                    "hnsw_ef": ef,
+                    "vectors_ram_mb": vectors_ram_mb(qdrant, points, dimension),
+                    "upload_seconds": round(upload_seconds, 2),
+                    "index_seconds": round(index_seconds, 2),
+                    **await run_searches(client_vdb, name, queries, truth, args.top_k, search_params),
+                }
+                results.append(result)
+                print(
+                    f"quantization={quantization:<7} ef={str(ef):<6} recall={result['recall']:.4f}  p50={result['p50_ms']:8.2f} ms  "
+                    f"p95={result['p95_ms']:8.2f} ms  {result['searches_per_second']:8.1f} searches/s  "
+                    f"vectors RAM={result['vectors_ram_mb']} MB"
+                )
+            if not args.keep:
+                await client_vdb.delete_collection(name)
+    finally:
+        await client_vdb.close()
+    return {"points": points, "dimension": dimension, "results": results}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Recall and latency of the quantization and HNSW settings of the Qdrant collection.")
+    parser.add_argument("--host", default="localhost", help="The host of Qdrant (default localhost)")
+    parser.add_argument("--port", type=int, default=6333, help="The port of Qdrant (default 6333)")
+    parser.add_argument("--local", action="store_true", help="Use the embedded Qdrant, it ignores the index and the quantization")
+    parser.add_argument("--source", help="A collection whose vectors are used, random clustered vectors are generated if it is not given")
+    parser.add_argument("--points", type=int, default=20000, help="Number of vectors (default 20000)")
+    parser.add_argument("--dimension", type=int, default=1536, help="Size of the generated vectors (default 1536)")
+    parser.add_argument("--clusters", type=int, default=50, help="Number of clusters of the generated vectors (default 50)")
+    parser.add_argument("--queries", type=int, default=200, help="Number of searches (default 200)")
+    parser.add_argument("--top-k", type=int, default=10, help="Number of results of every search (default 10)")
+    parser.add_argument("--quantization", default="none,scalar,binary", help="Comma separated quantizations (default none,scalar,binary)")
+    parser.add_argument("--ef", default="16,64,128", help="Comma separated hnsw_ef of the searches (default 16,64,128)")
+    parser.add_argument("--m", type=int, default=16, help="hnsw_m of the collections (default 16)")
+    parser.add_argument("--ef-construct", type=int, default=100, help="hnsw_ef_construct of the collections (default 100)")
+    parser.add_argument("--on-disk", action="store_true", help="Keep the original vectors on disk")
+    parser.add_argument("--oversampling", type=float, default=2.0, help="Oversampling of the quantized searches (default 2.0)")
+    parser.add_argument("--no-rescore", action="store_true", help="Do not rescore the quantized searches with the original vectors")
+    parser.add_argument("--keep", action="store_true", help="Keep the collections of the benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated vectors (default 0)")
+    parser.add_argument("--output", help="Path of the JSON results (default benchmarks/results/collection-<commit>.json)")
+    args = parser.parse_args()
+    args.quantization = args.quantization.split(",")
+    args.ef = [int(ef) for ef in args.ef.split(",")]
+    return args
+
+def main_benchmark():
+    args = parse_args()
+    commit, dirty = git_revision()
+    output = Path(args.output or ROOT / "benchmarks" / "results" / f"collection-{commit}{'-dirty' if dirty else ''}.json").resolve()
+    results = asyncio.run(run_benchmark(args))
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        **results,
+    }
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved in {output}")
+
+if __name__ == "__main__":
+    main_benchmark()
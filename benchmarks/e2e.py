@@ -0,0 +1,384 @@
+import os
+import io
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+from datetime import datetime, timezone
+from urllib.parse import quote
+# Add the project directory to the PYTHONPATH
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import yaml
+import httpx
+from docx import Document
+from passlib.context import CryptContext
+
+## End-to-end benchmark of the /upload/, /search/{prompt} and /token endpoints. It drives main.app in the same
+## process through an ASGI client, with the fake embeddings and chat providers and Qdrant running in memory, so
+## the outcome only depends on the code of the API. A corpus of documents is uploaded and a mix of searches and
+## logins is replayed at several concurrency levels, and the latencies and throughput of every endpoint are saved
+## in a JSON file that can be compared with the file of another commit.
+# Usage (from the main directory): python benchmarks/e2e.py --concurrency 1,4,16
+# Use your own documents and searches: python benchmarks/e2e.py --corpus path/to/docx --queries queries.txt
+# Compare two commits: python benchmarks/e2e.py --compare benchmarks/results/e2e-<commit>.json
+# The benchmark runs offline, but the tiktoken encoding of --tokenizer must already be in the tiktoken cache.
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark password"
+DOCX_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# Words of the generated documents and searches
+WORDS = (
+    "pump valve pressure maintenance manual warranty invoice contract supplier delivery schedule engine filter "
+    "battery sensor calibration safety inspection report budget quarter revenue customer support ticket policy "
+    "training employee payroll audit compliance shipment warehouse inventory order replacement model series"
+).split()
+CODES = ["XR-200", "ISO 9001", "PX-15", "V2.4", "EN-1090", "QT-77"]
+QUESTIONS = ["What does the document say about", "How is the", "When is the", "Who is responsible for the", "Summarize the"]
+
+# Read the commit and the state of the working tree the benchmark runs on
+def git_revision():
+    """
+    Get the commit of the repository.
+
+    Returns:
+        tuple: The short hash of the commit and True if the working tree has uncommitted changes.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, dirty
+
+# Build a .docx file in memory from its paragraphs
+def make_docx(paragraphs):
+    document = Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+# Generate a document of random sentences, the same for the same seed
+def generate_document(rng, paragraphs=20, words=60):
+    return [
+        " ".join(rng.choice(CODES) if rng.random() < 0.03 else rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+        for _ in range(paragraphs)
+    ]
+
+# Load the documents of the corpus, or generate them
+def load_corpus(args, rng):
+    """
+    Get the documents uploaded by the benchmark.
+
+    Every upload must be a different file, otherwise the queue returns the job that already ingested it,
+    so a paragraph with the number of the upload is added to the documents of the corpus.
+
+    Args:
+        args (argparse.Namespace): The options of the benchmark.
+        rng (random.Random): The random generator.
+
+    Returns:
+        list: A function for every document that builds its content for the upload number n.
+    """
+    if not args.corpus:
+        documents = [generate_document(rng) for _ in range(args.documents)]
+        return [lambda n, paragraphs=paragraphs: make_docx(paragraphs + [f"Benchmark upload {n}."]) for paragraphs in documents]
+    paths = sorted(Path(args.corpus).rglob("*.docx")) if Path(args.corpus).is_dir() else [Path(args.corpus)]
+    if not paths:
+        raise SystemExit(f"No .docx files found in {args.corpus}")
+
+    def build(n, path):
+        document = Document(str(path))
+        document.add_paragraph(f"Benchmark upload {n}.")
+        buffer = io.BytesIO()
+        document.save(buffer)
+        return buffer.getvalue()
+
+    return [lambda n, path=path: build(n, path) for path in paths]
+
+# Load the searches of the query mix, or generate them
+def load_queries(args, rng):
+    """
+    Get the searches replayed by the benchmark.
+
+    The generated mix has questions in natural language, answered with the embeddings, and lookups
+    of codes, answered by the keyword index.
+
+    Args:
+        args (argparse.Namespace): The options of the benchmark.
+        rng (random.Random): The random generator.
+
+    Returns:
+        list: The searches.
+    """
+    if args.queries:
+        with open(args.queries, 'r', encoding='utf-8') as f:
+            queries = [line.strip() for line in f if line.strip()]
+        if not queries:
+            raise SystemExit(f"No searches found in {args.queries}")
+        return queries
+    queries = []
+    for _ in range(100):
+        if rng.random() < args.lexical_share:
+            queries.append(f"{rng.choice(CODES)} {rng.choice(WORDS)}")
+        else:
+            queries.append(f"{rng.choice(QUESTIONS)} {' '.join(rng.sample(WORDS, 3))}?")
+    return queries
+
+# Write the configuration, the users and the API metadata used by the benchmark in a new directory
+def prepare_workspace(directory, args):
+    """
+    Create the files read by the API when it is imported: config.yaml, the users database and data/tags.json.
+
+    Args:
+        directory (str): The directory where the files are created.
+        args (argparse.Namespace): The options of the benchmark.
+    """
+    data = os.path.join(directory, "data")
+    os.makedirs(data)
+    shutil.copy(ROOT / "data" / "tags.json", os.path.join(data, "tags.json"))
+    context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=args.bcrypt_rounds)
+    users = {"1": {
+        "username": USERNAME, "full_name": "Benchmark", "email": "benchmark@example.com",
+        "hashed_password": context.hash(PASSWORD), "disabled": False,
+    }}
+    with open(os.path.join(data, "users.json"), 'w') as f:
+        json.dump(users, f, indent=4)
+    config = {
+        "openai": {"key": "benchmark", "model": "fake", "tokenizer": args.tokenizer, "llm_model": "fake", "chunk_size": 500, "chunk_overlap": 50},
+        "qdrant": {
+            "host": "localhost", "port": 6333, "collection": "benchmark", "size_embeddings": args.dimension,
+            "ids_path": "./data/document_ids.db", "local_path": ":memory:",
+        },
+        "llm": {"threshold": args.threshold, "top_k": 3, "prompt_template": "Answer the question {question} using this information: {content}"},
+        "secure": {
+            "SECRET_KEY": "benchmark", "ALGORITHM": "HS256", "ACCESS_TOKEN_EXPIRE_MINUTES": 60, "PASSWORD": "benchmark",
+            "users_backend": "json", "users_json": "./data/users.json", "bcrypt_rounds": args.bcrypt_rounds,
+        },
+        "ingest": {"queue_path": "./data/jobs.db", "spool_dir": "./data/spool", "queue_max_depth": 10000},
+        "keyword": {"enabled": True, "path": "./data/keyword_index.npz"},
+        "cache": {"embedding_path": "", "answer_max_entries": args.answer_cache},
+        "api": {"max_length_prompt": 500, "log_level": "WARNING"},
+        "providers": {"embeddings": "fake", "chat": "fake", "fake_latency_ms": args.latency_ms},
+    }
+    with open(os.path.join(directory, "config.yaml"), 'w') as f:
+        yaml.safe_dump(config, f)
+
+# Value below which a fraction q of the sorted latencies fall (nearest rank)
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+# Summarize the latencies of an endpoint at a concurrency level
+def summarize(endpoint, concurrency, latencies, errors, seconds):
+    """
+    Compute the statistics of a run.
+
+    Args:
+        endpoint (str): The name of the endpoint.
+        concurrency (int): The maximum number of requests in flight.
+        latencies (list): The seconds of every successful request.
+        errors (int): The number of failed requests.
+        seconds (float): The duration of the run.
+
+    Returns:
+        dict: The number of requests, errors, throughput and latency percentiles in milliseconds.
+    """
+    latencies = sorted(latencies)
+    milliseconds = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / seconds, 2) if seconds else None,
+        "mean_ms": milliseconds(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": milliseconds(percentile(latencies, 0.50)),
+        "p95_ms": milliseconds(percentile(latencies, 0.95)),
+        "p99_ms": milliseconds(percentile(latencies, 0.99)),
+        "max_ms": milliseconds(latencies[-1] if latencies else None),
+    }
+
+# Send requests keeping at most `concurrency` of them in flight
+async def replay(request, count, concurrency):
+    """
+    Run a request function count times with a given concurrency level.
+
+    Args:
+        request (Callable): An async function of the request number that raises an exception if the request fails.
+        count (int): The number of requests.
+        concurrency (int): The maximum number of requests in flight.
+
+    Returns:
+        tuple: The latencies of the successful requests, the number of errors and the duration of the run.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def timed(n):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await request(n)
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(n) for n in range(count)))
+    return latencies, errors, time.perf_counter() - start
+
+async def run_benchmark(args, main, corpus, queries, rng):
+    results = []
+    uploaded = 0
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app), httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        response = await client.post("/token", data={"username": USERNAME, "password": PASSWORD})
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        # Upload a document and wait until the job that ingests it is done
+        async def upload(n):
+            files = {"file": (f"benchmark_{uploaded + n + 1}.docx", prepared[n], DOCX_TYPE)}
+            response = await client.post("/upload/", files=files, headers=headers)
+            response.raise_for_status()
+            job_id = response.json()["job_id"]
+            while True:
+                job = (await client.get(f"/jobs/{job_id}", headers=headers)).json()
+                if job["status"] == "done":
+                    break
+                if job["status"] == "failed":
+                    raise RuntimeError(job["error"])
+                await asyncio.sleep(args.poll_ms / 1000)
+
+        async def search(n):
+            response = await client.get(f"/search/{quote(search_mix[n], safe='')}", headers=headers)
+            response.raise_for_status()
+
+        async def login(n):
+            response = await client.post("/token", data={"username": USERNAME, "password": PASSWORD})
+            response.raise_for_status()
+
+        for concurrency in args.concurrency:
+            # The documents are built before the run, so the timing only includes the requests
+            prepared = [corpus[(uploaded + n) % len(corpus)](uploaded + n + 1) for n in range(args.uploads)]
+            results.append(summarize("/upload/", concurrency, *await replay(upload, args.uploads, concurrency)))
+            uploaded += args.uploads
+            search_mix = [rng.choice(queries) for _ in range(args.searches)]
+            results.append(summarize("/search/{prompt}", concurrency, *await replay(search, args.searches, concurrency)))
+            results.append(summarize("/token", concurrency, *await replay(login, args.logins, concurrency)))
+            for result in results[-3:]:
+                print_result(result)
+    return results
+
+def print_result(result):
+    print(
+        f"{result['endpoint']:<18} c={result['concurrency']:<4} n={result['requests']:<5} errors={result['errors']:<3} "
+        f"{result['throughput_rps'] or 0:9.1f} req/s  p50={result['p50_ms'] or 0:9.1f} ms  "
+        f"p95={result['p95_ms'] or 0:9.1f} ms  p99={result['p99_ms'] or 0:9.1f} ms"
+    )
+
+# Print the change of every result against the results of another run
+def compare(results, baseline_path):
+    """
+    Print the relative change of the throughput and latencies against a previous run.
+
+    Args:
+        results (dict): The results of this run.
+        baseline_path (str): The path to the JSON file of the previous run.
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    previous = {(result["endpoint"], result["concurrency"]): result for result in baseline["results"]}
+    print(f"\nChange against {baseline['commit']}{' (dirty)' if baseline.get('dirty') else ''}, negative latency is faster:")
+    change = lambda new, old: f"{(new - old) / old * 100:+7.1f}%" if new is not None and old else "    n/a"
+    for result in results["results"]:
+        old = previous.get((result["endpoint"], result["concurrency"]))
+        if old is None:
+            continue
+        print(
+            f"{result['endpoint']:<18} c={result['concurrency']:<4} throughput {change(result['throughput_rps'], old['throughput_rps'])}"
+            f"  p50 {change(result['p50_ms'], old['p50_ms'])}  p95 {change(result['p95_ms'], old['p95_ms'])}"
+            f"  p99 {change(result['p99_ms'], old['p99_ms'])}"
+        )
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the upload, search and token endpoints.")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated concurrency levels (default 1,4,16)")
+    parser.add_argument("--uploads", type=int, default=20, help="Uploads at every concurrency level (default 20)")
+    parser.add_argument("--searches", type=int, default=200, help="Searches at every concurrency level (default 200)")
+    parser.add_argument("--logins", type=int, default=20, help="Logins at every concurrency level (default 20)")
+    parser.add_argument("--corpus", help="A .docx file or a directory with .docx files, documents are generated if it is not given")
+    parser.add_argument("--documents", type=int, default=10, help="Number of generated documents (default 10)")
+    parser.add_argument("--queries", help="A text file with a search per line, searches are generated if it is not given")
+    parser.add_argument("--lexical-share", type=float, default=0.3, help="Share of code lookups in the generated searches (default 0.3)")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Latency of every fake embedding and chat request (default 20)")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12, help="Cost of the password hash of the benchmark user (default 12)")
+    parser.add_argument("--answer-cache", type=int, default=0, help="Entries of the answer cache, 0 disables it (default 0)")
+    parser.add_argument("--threshold", type=float, default=0.05, help="Minimum score of the retrieved chunks (default 0.05)")
+    parser.add_argument("--dimension", type=int, default=1536, help="Size of the fake embeddings (default 1536)")
+    parser.add_argument("--tokenizer", default="cl100k_base", help="The tiktoken encoding (default cl100k_base)")
+    parser.add_argument("--poll-ms", type=float, default=5, help="Interval between two checks of an upload job (default 5)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated documents and searches (default 0)")
+    parser.add_argument("--output", help="Path of the JSON results (default benchmarks/results/e2e-<commit>.json)")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+    return args
+
+def main_benchmark():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    corpus = load_corpus(args, rng)
+    queries = load_queries(args, rng)
+    commit, dirty = git_revision()
+    output = Path(args.output or ROOT / "benchmarks" / "results" / f"e2e-{commit}{'-dirty' if dirty else ''}.json").resolve()
+    compare_path = Path(args.compare).resolve() if args.compare else None
+
+    # The API reads config.yaml and the data directory from the working directory when it is imported
+    workspace = tempfile.mkdtemp(prefix="e2e_benchmark_")
+    cwd = os.getcwd()
+    try:
+        prepare_workspace(workspace, args)
+        os.chdir(workspace)
+        import main
+        results = asyncio.run(run_benchmark(args, main, corpus, queries, rng))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    settings = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": settings,
+        "results": results,
+    }
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved in {output}")
+    if compare_path:
+        compare(report, compare_path)
+
+if __name__ == "__main__":
+    main_benchmark()
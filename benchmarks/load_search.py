@@ -0,0 +1,89 @@
+import sys
+import time
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+# Add the project directory to the PYTHONPATH
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx
+import tiktoken
+import main
+import lib.providers as providers
+import lib.processing_docs as processing_docs
+import security.security as security
+from lib.services import Services
+from langchain.prompts import PromptTemplate
+
+## Load test for the /search/{prompt} endpoint. It replaces OpenAI and Qdrant with the fake providers and a fake
+## Qdrant client that only wait a fixed latency, so the outcome shows if the concurrent requests overlap or are serialized.
+# Usage (from the main directory, with a valid config.yaml): python benchmarks/load_search.py
+
+LATENCY = 0.05
+REQUESTS = 50
+
+class FakeQdrant:
+    async def get_collections(self):
+        return [("collections", [SimpleNamespace(name=main.config['qdrant']['collection'])])]
+
+    async def create_payload_index(self, collection_name, field_name, field_schema=None, **kwargs):
+        pass
+
+    async def search(self, collection_name, query_vector, limit, **kwargs):
+        await asyncio.sleep(LATENCY)
+        return [SimpleNamespace(id=1, score=1.0, vector=None, payload={"document_id": 1, "chunk_index": 0, "Document_text": "fake document"})]
+
+# Services with the fake providers of lib.providers and the fake Qdrant client, every call waits LATENCY seconds
+def fake_services():
+    """
+    Create the shared resources of the app with fake providers and a fake Qdrant client.
+
+    Returns:
+        Services: The context with the fake resources.
+    """
+    client_vdb = FakeQdrant()
+    return Services(
+        config=main.config, client_vdb=client_vdb, embeddings=providers.FakeEmbeddings(latency=LATENCY),
+        chat=providers.FakeChat(latency=LATENCY), encoding=tiktoken.get_encoding(main.config['openai']['tokenizer']),
+        prompt_template=PromptTemplate.from_template(main.config['llm']['prompt_template']),
+        embedding_cache=None, answer_cache=None, parse_executor=None, job_queue=None,
+        document_ids=processing_docs.DocumentIds(client_vdb, main.config['qdrant']['collection']), keyword_index=None,
+    )
+
+# Send the requests keeping at most `concurrency` of them in flight and return the throughput
+async def run(client, concurrency):
+    """
+    Send REQUESTS searches with a given concurrency level.
+
+    Args:
+        client (httpx.AsyncClient): The client connected to the app.
+        concurrency (int): The maximum number of requests in flight.
+
+    Returns:
+        float: The throughput in requests per second.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def search(n):
+        async with semaphore:
+            response = await client.get(f"/search/question {n}")
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(search(n) for n in range(REQUESTS)))
+    return REQUESTS / (time.perf_counter() - start)
+
+async def main_load():
+    main.app.state.services = fake_services()
+    main.app.dependency_overrides[security.get_current_active_user] = lambda: security.User(username="load_test")
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        baseline = None
+        for concurrency in (1, 5, 10, 25, 50):
+            throughput = await run(client, concurrency)
+            baseline = baseline or throughput
+            print(f"concurrency={concurrency:>3}  throughput={throughput:8.1f} req/s  speedup={throughput / baseline:5.1f}x")
+
+if __name__ == "__main__":
+    asyncio.run(main_load())
@@ -0,0 +1,56 @@
+import sys
+import time
+import asyncio
+import statistics
+from pathlib import Path
+# Add the project directory to the PYTHONPATH
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx
+import main
+import security.security as security
+from load_search import fake_services
+
+## Benchmark of the /search/{prompt} latency while other clients request tokens. Every /token request verifies
+## a bcrypt hash of the first user of the database with a wrong password, so it pays the full bcrypt cost.
+# Usage (from the main directory, with a valid config.yaml): python benchmarks/login_load.py
+
+SEARCHES = 40
+LOGIN_CLIENTS = (0, 4, 16)
+
+# Keep sending /token requests until the searches finish
+async def login_loop(client, username, stop):
+    while not stop.is_set():
+        await client.post("/token", data={"username": username, "password": "wrong password"})
+
+# Measure the latency of sequential searches
+async def search_latencies(client):
+    latencies = []
+    for n in range(SEARCHES):
+        start = time.perf_counter()
+        response = await client.get(f"/search/question {n}")
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+async def main_load():
+    main.app.state.services = fake_services()
+    main.app.dependency_overrides[security.get_current_active_user] = lambda: security.User(username="load_test")
+    username = next(iter(security.users.index)) if hasattr(security.users, "index") else "fabiancoy"
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=None) as client:
+        for clients in LOGIN_CLIENTS:
+            stop = asyncio.Event()
+            logins = [asyncio.create_task(login_loop(client, username, stop)) for _ in range(clients)]
+            latencies = await search_latencies(client)
+            stop.set()
+            await asyncio.gather(*logins)
+            latencies.sort()
+            print(
+                f"login clients={clients:>3}  search p50={statistics.median(latencies) * 1000:8.1f} ms"
+                f"  p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:8.1f} ms"
+            )
+
+if __name__ == "__main__":
+    asyncio.run(main_load())
@@ -0,0 +1,38 @@
+import sys
+import timeit
+from pathlib import Path
+# Add the project directory to the PYTHONPATH
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import tiktoken
+from langchain_openai import ChatOpenAI
+from langchain.prompts import PromptTemplate
+import lib.utils as utils
+
+## Microbenchmark of the objects that every request used to build: the ChatOpenAI instance, the prompt template
+## and the tiktoken encoding. It compares building them per request with reusing the ones created at startup.
+# Usage (from the main directory, with a valid config.yaml): python benchmarks/setup_overhead.py
+
+NUMBER = 200
+
+config = utils.load_config('./config.yaml')
+
+# The objects created per request before they were moved to the shared Services context
+def per_request_setup():
+    llm = ChatOpenAI(temperature=0, openai_api_key=config['openai']['key'], model_name=config['openai']['llm_model'])
+    prompt_template = PromptTemplate.from_template(config['llm']['prompt_template'])
+    encoding = tiktoken.get_encoding(config['openai']['tokenizer'])
+    return llm, prompt_template.format(question="question", content="content"), encoding
+
+llm = ChatOpenAI(temperature=0, openai_api_key=config['openai']['key'], model_name=config['openai']['llm_model'])
+prompt_template = PromptTemplate.from_template(config['llm']['prompt_template'])
+encoding = tiktoken.get_encoding(config['openai']['tokenizer'])
+
+# The work left per request when the objects are created once at startup
+def shared_setup():
+    return llm, prompt_template.format(question="question", content="content"), encoding
+
+if __name__ == "__main__":
+    for name, function in (("per request", per_request_setup), ("shared", shared_setup)):
+        seconds = min(timeit.repeat(function, number=NUMBER, repeat=5)) / NUMBER
+        print(f"{name:>12}: {seconds * 1e6:10.1f} us per request")
@@ -0,0 +1,385 @@
+import sys
+from pathlib import Path
+# Add the project directory to the PYTHONPATH
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import json
+import asyncio
+import argparse
+
+## Provisioning of the Qdrant collection from the qdrant section of config.yaml: the size of the vectors, the
+## parameters of the HNSW index, the quantization of the vectors, what is kept on disk and the payload indexes of
+## the fields used to filter the chunks of a document. The API creates the collection with these settings the first
+## time it is used, and the command of this file shows the settings of an existing collection or rebuilds it with
+## the settings of the configuration file, or splits in chunks the documents stored by the first version of the API.
+# Usage (from the main directory): python lib/collection.py show|create|migrate|rechunk --config config.yaml
+
+# Payload fields filtered by the uploads and the count of the documents, and the type of their index
+PAYLOAD_INDEXES = {"document_id": "integer", "chunk_index": "integer"}
+
+# Quantizations of the vectors that can be selected in config.yaml
+QUANTIZATIONS = ("none", "scalar", "binary")
+
+# Name of the temporary collection that keeps the points while a collection is rebuilt
+def staging_name(collection_name):
+    return f"{collection_name}_migration"
+
+# Parameters of the vectors of the collection
+def vectors_config(qdrant, size):
+    """
+    Build the parameters of the vectors from the qdrant section of the configuration file.
+
+    Args:
+        qdrant (dict): The qdrant section of the configuration file.
+        size (int): The size of the embeddings.
+
+    Returns:
+        VectorParams: The size, the cosine distance and the storage of the vectors.
+    """
+    from qdrant_client.http.models import Distance, VectorParams
+
+    return VectorParams(size=size, distance=Distance.COSINE, on_disk=qdrant.get('on_disk_vectors', False))
+
+# Parameters of the HNSW index of the collection
+def hnsw_config(qdrant):
+    """
+    Build the parameters of the HNSW index from the qdrant section of the configuration file.
+
+    Args:
+        qdrant (dict): The qdrant section of the configuration file.
+
+    Returns:
+        HnswConfigDiff: The number of links per node, the size of the candidate list while building and the storage of the index.
+    """
+    from qdrant_client.http.models import HnswConfigDiff
+
+    return HnswConfigDiff(
+        m=qdrant.get('hnsw_m', 16),
+        ef_construct=qdrant.get('hnsw_ef_construct', 100),
+        on_disk=qdrant.get('hnsw_on_disk', False),
+    )
+
+# Quantization of the vectors of the collection, None when the vectors are not quantized
+def quantization_config(qdrant):
+    """
+    Build the quantization of the vectors from the qdrant section of the configuration file.
+
+    Scalar quantization keeps one byte per dimension instead of four and binary quantization one bit,
+    so the quantized vectors can stay in RAM while the original vectors are on disk. The searches use
+    the quantized vectors and rescore the best candidates with the original vectors.
+
+    Args:
+        qdrant (dict): The qdrant section of the configuration file.
+
+    Returns:
+        ScalarQuantization, BinaryQuantization or None: The quantization of the vectors.
+
+    Raises:
+        ValueError: If the quantization is unknown.
+    """
+    from qdrant_client.http.models import (
+        BinaryQuantization, BinaryQuantizationConfig, ScalarQuantization, ScalarQuantizationConfig, ScalarType,
+    )
+
+    quantization = qdrant.get('quantization', 'none')
+    always_ram = qdrant.get('quantization_always_ram', True)
+    if quantization == 'none':
+        return None
+    if quantization == 'scalar':
+        return ScalarQuantization(scalar=ScalarQuantizationConfig(
+            type=ScalarType.INT8, quantile=qdrant.get('quantization_quantile', 0.99), always_ram=always_ram,
+        ))
+    if quantization == 'binary':
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=always_ram))
+    raise ValueError(f"Unknown quantization: {quantization}, use one of {', '.join(QUANTIZATIONS)}")
+
+# Parameters of the searches, they depend on the index and the quantization of the collection
+def search_params(qdrant):
+    """
+    Build the parameters of the searches from the qdrant section of the configuration file.
+
+    Args:
+        qdrant (dict): The qdrant section of the configuration file.
+
+    Returns:
+        SearchParams: The size of the candidate list of the HNSW search and the rescoring of the quantized vectors.
+    """
+    from qdrant_client.http.models import QuantizationSearchParams, SearchParams
+
+    quantization = None
+    if quantization_config(qdrant) is not None:
+        quantization = QuantizationSearchParams(
+            rescore=qdrant.get('quantization_rescore', True),
+            oversampling=qdrant.get('quantization_oversampling', 2.0),
+        )
+    return SearchParams(hnsw_ef=qdrant.get('hnsw_ef'), quantization=quantization)
+
+# Create the payload indexes of the document fields, creating an index that exists does nothing
+async def ensure_payload_indexes(client_vdb, collection_name):
+    """
+    Index the payload fields used to filter the chunks of a document.
+
+    Args:
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
+        collection_name (str): The name of the collection in Qdrant.
+    """
+    from qdrant_client.http.models import PayloadSchemaType
+
+    for field_name, field_type in PAYLOAD_INDEXES.items():
+        await client_vdb.create_payload_index(
+            collection_name=collection_name, field_name=field_name, field_schema=PayloadSchemaType(field_type),
+        )
+
+# Create a collection with the settings of the configuration file
+async def create_collection(client_vdb, collection_name, qdrant, size):
+    """
+    Create a collection with the vectors, index, quantization, storage and payload indexes of the configuration file.
+
+    Args:
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
+        collection_name (str): The name of the collection in Qdrant.
+        qdrant (dict): The qdrant section of the configuration file.
+        size (int): The size of the embeddings.
+    """
+    await client_vdb.create_collection(
+        collection_name=collection_name,
+        vectors_config=vectors_config(qdrant, size),
+        hnsw_config=hnsw_config(qdrant),
+        quantization_config=quantization_config(qdrant),
+        on_disk_payload=qdrant.get('on_disk_payload', True),
+    )
+    # The embedded Qdrant has no payload indexes
+    if not qdrant.get('local_path'):
+        await ensure_payload_indexes(client_vdb, collection_name)
+
+# Read the settings and the size of an existing collection
+async def describe_collection(client_vdb, collection_name):
+    """
+    Get the settings and the number of points of a collection.
+
+    Args:
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
+        collection_name (str): The name of the collection in Qdrant.
+
+    Returns:
+        dict: The status, the number of points and indexed vectors, the parameters of the vectors, the HNSW index
+            and the quantization, and the payload indexes of the collection.
+    """
+    info = await client_vdb.get_collection(collection_name)
+    return {
+        "collection": collection_name,
+        "status": str(info.status.value),
+        "points": info.points_count,
+        "indexed_vectors": info.indexed_vectors_count,
+        "params": info.config.params.model_dump(mode="json", exclude_none=True),
+        "hnsw": info.config.hnsw_config.model_dump(mode="json", exclude_none=True),
+        "quantization": info.config.quantization_config.model_dump(mode="json", exclude_none=True) if info.config.quantization_config else None,
+        "payload_indexes": {field: schema.data_type.value for field, schema in (info.payload_schema or {}).items()},
+    }
+
+# Copy all the points of a collection to another one, with their vectors and payloads
+async def copy_points(client_vdb, source, target, batch_size=256, progress=None):
+    """
+    Copy the points of a collection to another collection in batches.
+
+    Args:
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
+        source (str): The name of the collection to read.
+        target (str): The name of the collection to write.
+        batch_size (int, optional): The number of points read and written at once. Defaults to 256.
+        progress (callable, optional): Called with the number of points copied after every batch. Defaults to None.
+
+    Returns:
+        int: The number of points copied.
+    """
+    from qdrant_client.http.models import PointStruct
+
+    copied, offset = 0, None
+    while True:
+        points, offset = await client_vdb.scroll(
+            collection_name=source, limit=batch_size, offset=offset, with_payload=True, with_vectors=True,
+        )
+        if points:
+            await client_vdb.upsert(
+                collection_name=target,
+                points=[PointStruct(id=point.id, vector=point.vector, payload=point.payload) for point in points],
+            )
+            copied += len(points)
+            if progress is not None:
+                progress(copied)
+        if offset is None:
+            return copied
+
+# Rebuild a collection with the settings of the configuration file, keeping its points
+async def migrate_collection(client_vdb, collection_name, qdrant, size, batch_size=256, progress=None):
+    """
+    Rebuild a collection with the settings of the configuration file.
+
+    The points are first copied to a temporary collection with the new settings. The collection is
+    deleted only when the copy is complete, then created again with the new settings and filled from
+    the temporary collection, which is deleted at the end. The ids and payloads of the points do not
+    change, so the document ids and the keyword index stay valid. The collection is empty while it is
+    filled again, so stop the API or the uploads during the migration.
+
+    Args:
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
+        collection_name (str): The name of the collection in Qdrant.
+        qdrant (dict): The qdrant section of the configuration file.
+        size (int): The size of the embeddings.
+        batch_size (int, optional): The number of points copied at once. Defaults to 256.
+        progress (callable, optional): Called with a message after every step. Defaults to None.
+
+    Returns:
+        dict: The settings of the rebuilt collection.
+
+    Raises:
+        ValueError: If the size of the vectors changes, the documents must then be ingested again.
+        RuntimeError: If a copy does not have all the points of the collection.
+    """
+    report = progress or (lambda message: None)
+    info = await client_vdb.get_collection(collection_name)
+    if info.config.params.vectors.size != size:
+        raise ValueError(
+            f"The vectors of {collection_name} have {info.config.params.vectors.size} dimensions and the embeddings "
+            f"{size}, the documents must be ingested again with the new embeddings model"
+        )
+    points = (await client_vdb.count(collection_name=collection_name, exact=True)).count
+    staging = staging_name(collection_name)
+    # A temporary collection left by a failed migration is created again
+    if await client_vdb.collection_exists(staging):
+        await client_vdb.delete_collection(staging)
+    await create_collection(client_vdb, staging, qdrant, size)
+    report(f"Copying {points} points of {collection_name} to {staging}")
+    copied = await copy_points(client_vdb, collection_name, staging, batch_size, lambda n: report(f"{n}/{points} points copied"))
+    if (await client_vdb.count(collection_name=staging, exact=True)).count != points:
+        raise RuntimeError(f"{staging} has {copied} of the {points} points of {collection_name}, the collection was not changed")
+
+    await client_vdb.delete_collection(collection_name)
+    await create_collection(client_vdb, collection_name, qdrant, size)
+    report(f"Copying {points} points back to {collection_name} with the new settings")
+    await copy_points(client_vdb, staging, collection_name, batch_size, lambda n: report(f"{n}/{points} points copied"))
+    if (await client_vdb.count(collection_name=collection_name, exact=True)).count != points:
+        raise RuntimeError(f"{collection_name} was not filled again, its points are kept in {staging}")
+    await client_vdb.delete_collection(staging)
+    return await describe_collection(client_vdb, collection_name)
+
+# Filter of the points stored by the first version of the API, one point per document without document_id
+def legacy_filter():
+    from qdrant_client.http.models import Filter, IsEmptyCondition, PayloadField
+
+    return Filter(must=[IsEmptyCondition(is_empty=PayloadField(key="document_id"))])
+
+# Split in chunks the documents stored with a single point by the first version of the API
+async def rechunk_collection(client_vdb, collection_name, embeddings, encoding, chunk_size, chunk_overlap, keyword_index=None, batch_size=256, progress=None):
+    """
+    Replace the points stored by the first version of the API with one point per chunk.
+
+    The first version stored every document as a single point whose integer id was the document id, with the
+    whole text in the Document_text payload and no other field. Every such point is split in chunks like a new
+    upload, the chunks are embedded and stored with the document_id of the point, and the old point is deleted
+    once its chunks are stored. The ids of the chunks only depend on the document id and their text, so running
+    the migration again after an interruption stores the same points. The API may keep running meanwhile.
+
+    Args:
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
+        collection_name (str): The name of the collection in Qdrant.
+        embeddings: The embeddings provider, see lib.providers.
+        encoding (tiktoken.Encoding): The tokenizer used to split the documents in chunks.
+        chunk_size (int): The maximum number of tokens of each chunk.
+        chunk_overlap (int): The number of tokens shared by two consecutive chunks.
+        keyword_index (KeywordIndex, optional): The keyword index where the chunks are added. Defaults to None.
+        batch_size (int, optional): The number of old points read at once. Defaults to 256.
+        progress (callable, optional): Called with a message after every document. Defaults to None.
+
+    Returns:
+        dict: The number of documents split and of chunks stored.
+    """
+    import lib.processing_docs as processing_docs
+    from qdrant_client.http.models import PointIdsList
+
+    report = progress or (lambda message: None)
+    documents = chunks = 0
+    while True:
+        # The old points are deleted once split, so the first page always has the ones left
+        records, _ = await client_vdb.scroll(
+            collection_name=collection_name, scroll_filter=legacy_filter(), limit=batch_size,
+            with_payload=["Document_text"], with_vectors=False,
+        )
+        if not records:
+            break
+        for record in records:
+            document_id = int(record.id)
+            texts = list(processing_docs.chunk_stream([(record.payload or {}).get("Document_text") or ""], encoding, chunk_size, chunk_overlap))
+            if texts:
+                chunk_texts = [text for text, _ in texts]
+                vectors = await processing_docs.embed_texts(embeddings, chunk_texts, [count for _, count in texts])
+                points = processing_docs.create_points(
+                    document_id, vectors, chunk_texts, [processing_docs.chunk_fingerprint(embeddings.name, text) for text in chunk_texts],
+                )
+                for start in range(0, len(points), batch_size):
+                    await client_vdb.upsert(collection_name=collection_name, wait=True, points=points[start:start + batch_size])
+                if keyword_index is not None:
+                    keyword_index.add_points(points)
+            await client_vdb.delete(collection_name=collection_name, points_selector=PointIdsList(points=[record.id]), wait=True)
+            documents += 1
+            chunks += len(texts)
+            report(f"Document {document_id} split in {len(texts)} chunks")
+    return {"documents": documents, "chunks": chunks}
+
+# Show, create, rebuild or split in chunks the collection of the configuration file
+async def main(command, config_path, batch_size=256):
+    import lib.providers as providers
+    from lib.settings import get_settings
+    from qdrant_client import AsyncQdrantClient
+
+    config = get_settings(config_path).config
+    qdrant = config['qdrant']
+    collection_name = qdrant['collection']
+    local_path = qdrant.get('local_path')
+    if local_path:
+        client_vdb = AsyncQdrantClient(location=local_path) if local_path == ':memory:' else AsyncQdrantClient(path=local_path)
+    else:
+        client_vdb = AsyncQdrantClient(qdrant['host'], port=qdrant['port'])
+    embeddings = providers.create_embeddings(config)
+    try:
+        if command == 'create':
+            if await client_vdb.collection_exists(collection_name):
+                if not local_path:
+                    await ensure_payload_indexes(client_vdb, collection_name)
+            else:
+                await create_collection(client_vdb, collection_name, qdrant, embeddings.dimension)
+        elif command == 'migrate':
+            return await migrate_collection(
+                client_vdb, collection_name, qdrant, embeddings.dimension, batch_size,
+                progress=lambda message: print(message, file=sys.stderr),
+            )
+        elif command == 'rechunk':
+            import tiktoken
+            from lib.keyword_index import KeywordIndex
+
+            keyword_index = None
+            if config['keyword'].get('enabled', True):
+                keyword_index = KeywordIndex(path=config['keyword'].get('path', './data/keyword_index.npz'))
+            result = await rechunk_collection(
+                client_vdb, collection_name, embeddings, tiktoken.get_encoding(config['openai']['tokenizer']),
+                config['openai'].get('chunk_size', 500), config['openai'].get('chunk_overlap', 50), keyword_index, batch_size,
+                progress=lambda message: print(message, file=sys.stderr),
+            )
+            # The processes of the API read the chunks added to the keyword index from its file
+            if keyword_index is not None:
+                await asyncio.to_thread(keyword_index.save, True)
+            return result
+        return await describe_collection(client_vdb, collection_name)
+    finally:
+        await embeddings.close()
+        await client_vdb.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show, create, rebuild or split in chunks the Qdrant collection with the settings of config.yaml.")
+    parser.add_argument("command", choices=["show", "create", "migrate", "rechunk"],
+                        help="show the settings of the collection, create it (or add its payload indexes), rebuild it with the settings of config.yaml "
+                             "or split in chunks the documents stored by the first version of the API.")
+    parser.add_argument("--config", default="./config.yaml", help="The path to the config.yaml file.")
+    parser.add_argument("--batch-size", type=int, default=256, help="The number of points copied at once by migrate, or read at once by rechunk.")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(main(args.command, args.config, args.batch_size)), indent=4))
@@ -3,50 +3,40 @@ from pathlib import Path
 # Add the project directory to the PYTHONPATH
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
-from security.security import get_password_hash
-import json
+from security.security import get_password_hash, users
 from typing import Dict
 
-def create_user(db,user_data: Dict[str, str]) -> None:
+def create_user(db, user_data: Dict[str, str]) -> None:
     """
-    This function takes a dictionary with user data and appends it to the dummy_users_database.json file.
+    This function takes a dictionary with user data and adds it to the repository of users.
     The user_data dictionary should have the following keys: username, full_name, email, hashed_password, disabled.
 
     Args:
-        db (str): The path to the dummy_users_database.json file.
+        db (JsonUserRepository | SqliteUserRepository): The repository of users configured in config.yaml.
         user_data (Dict[str, str]): A dictionary containing the user data.
 
     Returns:
         None
     """
-    with open(db, 'r+') as file:
-        data = json.load(file)
-        new_id = str(int(max(data.keys())) + 1)  # Get the next id
-        data[new_id] = user_data
-
-        # Move the pointer to the beginning of the file and overwrite it with the updated data
-        file.seek(0)
-        json.dump(data, file, indent=4)
+    db.add(user_data)
 
     return ("User created successfully.")
 
 
 
-## This script allow to create a new user in the dummy_users_database.json file. You must execute this script directly from the terminal.
-# Usage: python create_users.py
+## This script allow to create a new user in the repository of users configured in config.yaml (dummy_users_database.json by default).
+## The JSON file is written to a temporary file that replaces it atomically, and the running API reloads it when it changes.
+# Usage: python lib/create_users.py (from the main directory)
 # Note: Don't update the repository showing the password in the code. This is just an example. It could be a security issue.
 
-db = "../data/dummy_users_database.json"
-
-# Example usage:
-new_user = {
-    "username": "newuser",
-    "full_name": "New User",
-    "email": "newuser@example.com",
-    "hashed_password": get_password_hash("newpassword"),
-    "disabled": False
-}
-
-create_user(db,new_user)
-
-
+if __name__ == "__main__":
+    # Example usage:
+    new_user = {
+        "username": "newuser",
+        "full_name": "New User",
+        "email": "newuser@example.com",
+        "hashed_password": get_password_hash("newpassword"),
+        "disabled": False
+    }
+
+    print(create_user(users, new_user))
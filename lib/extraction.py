@@ -0,0 +1,171 @@
+import zlib
+import zipfile
+
+## Methods to extract the text of a .docx file without loading the whole document in memory. The XML parts of the
+## file are read straight from the zip archive with an incremental parser, and the text is yielded paragraph by paragraph
+
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+PARAGRAPH = W_NS + "p"
+TABLE_ROW = W_NS + "tr"
+TABLE_CELL = W_NS + "tc"
+TEXT = W_NS + "t"
+TAB = W_NS + "tab"
+BREAKS = (W_NS + "br", W_NS + "cr")
+
+# Raised when an upload or one of its XML parts is bigger than the configured limits
+class DocumentTooLarge(ValueError):
+    pass
+
+# Raised when an upload is not a .docx file, is corrupted or has no text, reading it again gives the same error
+class InvalidDocument(ValueError):
+    pass
+
+# File object that stops reading an XML part after a maximum number of bytes
+class LimitedReader:
+    """
+    Wrap a file object and raise DocumentTooLarge when more than max_bytes are read.
+
+    The size of the parts declared in the zip archive can be forged, so the limit is checked
+    on the bytes actually decompressed.
+
+    Args:
+        fileobj: The file object to read.
+        max_bytes (int): The maximum number of bytes that can be read, None for no limit.
+        name (str): The name of the part, used in the error message.
+    """
+
+    def __init__(self, fileobj, max_bytes, name):
+        self.fileobj = fileobj
+        self.max_bytes = max_bytes
+        self.name = name
+        self.read_bytes = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.read_bytes += len(data)
+        if self.max_bytes is not None and self.read_bytes > self.max_bytes:
+            raise DocumentTooLarge(f"The part {self.name} is bigger than {self.max_bytes} bytes")
+        return data
+
+# Get the text of a paragraph keeping the tabs and line breaks
+def paragraph_text(paragraph):
+    """
+    Join the text runs of a paragraph.
+
+    Args:
+        paragraph (lxml.etree._Element): A w:p element.
+
+    Returns:
+        str: The text of the paragraph.
+    """
+    pieces = []
+    for element in paragraph.iter(TEXT, TAB, *BREAKS):
+        if element.tag == TEXT:
+            pieces.append(element.text or "")
+        elif element.tag == TAB:
+            pieces.append("\t")
+        else:
+            pieces.append("\n")
+    return "".join(pieces)
+
+# Yield the paragraphs and table rows of an XML part of the document
+def iter_part_text(xml):
+    """
+    Parse an XML part of a .docx file incrementally and yield its text.
+
+    The paragraphs outside the tables are yielded one by one. The paragraphs of a table cell are
+    joined with spaces and every table row is yielded as its cells joined with " | ". The parsed
+    elements are released as soon as their text is yielded.
+
+    Args:
+        xml: A file object with the XML part.
+
+    Yields:
+        str: The text of a paragraph or of a table row.
+    """
+    from lxml import etree
+
+    rows, cells = [], []
+    for event, element in etree.iterparse(xml, events=("start", "end"), tag=(PARAGRAPH, TABLE_ROW, TABLE_CELL)):
+        if event == "start":
+            if element.tag == TABLE_ROW:
+                rows.append([])
+            elif element.tag == TABLE_CELL:
+                cells.append([])
+            continue
+        if element.tag == PARAGRAPH:
+            text = paragraph_text(element)
+            if cells:
+                cells[-1].append(text)
+            else:
+                yield text
+        elif element.tag == TABLE_CELL:
+            rows[-1].append(" ".join(cells.pop()))
+        elif element.tag == TABLE_ROW:
+            row = " | ".join(rows.pop())
+            if cells:
+                cells[-1].append(row)
+            else:
+                yield row
+        # Release the element and the siblings already processed
+        if not cells and not rows:
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+# Check that a file is a zip archive with the document part of a .docx file, reading only the directory of the archive
+def check_docx(fileobj):
+    """
+    Check the signature of a .docx file before it is processed.
+
+    Args:
+        fileobj: A seekable file object with the .docx file.
+
+    Raises:
+        InvalidDocument: If the file is not a zip archive or has no word/document.xml part.
+    """
+    fileobj.seek(0)
+    try:
+        with zipfile.ZipFile(fileobj) as archive:
+            archive.getinfo("word/document.xml")
+    except (zipfile.BadZipFile, KeyError):
+        raise InvalidDocument("Invalid file type. Please upload a .docx file")
+    finally:
+        fileobj.seek(0)
+
+# Yield the text of the headers, the body and the footers of a .docx file
+def iter_docx_text(fileobj, max_bytes=None, max_part_bytes=None):
+    """
+    Stream the text of a .docx file, reading it straight from a file object.
+
+    Args:
+        fileobj: A seekable file object with the .docx file, for example the spooled file of an upload.
+        max_bytes (int, optional): The maximum size of the .docx file. Defaults to None (no limit).
+        max_part_bytes (int, optional): The maximum decompressed size of each XML part. Defaults to None (no limit).
+
+    Yields:
+        str: The text of a paragraph or of a table row.
+
+    Raises:
+        DocumentTooLarge: If the file or one of its parts is bigger than the limits.
+        InvalidDocument: If the file is not a .docx file or one of its parts is corrupted.
+    """
+    from lxml import etree
+
+    if max_bytes is not None:
+        size = fileobj.seek(0, 2)
+        if size > max_bytes:
+            raise DocumentTooLarge(f"The file is bigger than {max_bytes} bytes")
+    fileobj.seek(0)
+    try:
+        with zipfile.ZipFile(fileobj) as archive:
+            names = archive.namelist()
+            headers = sorted(name for name in names if name.startswith("word/header") and name.endswith(".xml"))
+            footers = sorted(name for name in names if name.startswith("word/footer") and name.endswith(".xml"))
+            for name in headers + ["word/document.xml"] + footers:
+                if max_part_bytes is not None and archive.getinfo(name).file_size > max_part_bytes:
+                    raise DocumentTooLarge(f"The part {name} is bigger than {max_part_bytes} bytes")
+                with archive.open(name) as part:
+                    yield from iter_part_text(LimitedReader(part, max_part_bytes, name))
+    except (zipfile.BadZipFile, KeyError, EOFError, zlib.error, etree.XMLSyntaxError) as e:
+        raise InvalidDocument(f"The file is not a valid .docx file: {e}")
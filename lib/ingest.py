@@ -0,0 +1,246 @@
+import sys
+from pathlib import Path
+# Add the project directory to the PYTHONPATH
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import os
+import json
+import zlib
+import asyncio
+import zipfile
+import argparse
+import contextlib
+import tiktoken
+import lib.processing_docs as processing_docs
+import lib.extraction as extraction
+import lib.jobs as jobs
+from lib.settings import get_settings
+import lib.metrics as metrics
+
+## Methods to ingest many .docx files at once: the files are parsed in a pool of worker processes,
+## the chunks of all the files are embedded in batched requests and the points are upserted in large batches
+
+# Copy the .docx files, and the .docx files of the zip archives, to the spool directory
+def spool_files(files, spool_dir, max_bytes=None, max_archive_bytes=None):
+    """
+    Copy the .docx files and the .docx files of the zip archives to the spool directory, so they are
+    parsed from disk and never fully loaded in memory, and separate the files that are rejected.
+
+    The size declared by every member of an archive is checked before it is decompressed, and the
+    bytes actually decompressed are counted while it is copied, so a forged size does not help.
+
+    Args:
+        files (list): A list of tuples with the filename and a seekable file object of each file.
+        spool_dir (str): The directory where the .docx files are copied.
+        max_bytes (int, optional): The maximum size of an uploaded file and of a .docx file of an archive. Defaults to None (no limit).
+        max_archive_bytes (int, optional): The maximum decompressed size of the .docx files of an archive. Defaults to None (no limit).
+
+    Returns:
+        tuple: A list of (filename, spool path, SHA-256) of the .docx files and a list of results for the rejected files.
+    """
+    documents, rejected = [], []
+
+    def too_large(filename, detail):
+        rejected.append({"filename": filename, "status": "error", "status_code": 413, "detail": detail})
+
+    try:
+        for filename, fileobj in files:
+            if filename.lower().endswith('.zip'):
+                if max_bytes is not None and fileobj.seek(0, 2) > max_bytes:
+                    too_large(filename, f"The file is bigger than {max_bytes} bytes")
+                    continue
+                fileobj.seek(0)
+                try:
+                    with zipfile.ZipFile(fileobj) as archive:
+                        extracted = 0
+                        for info in archive.infolist():
+                            name = f"{filename}/{info.filename}"
+                            if not info.filename.lower().endswith('.docx') or info.filename.startswith('__MACOSX/'):
+                                continue
+                            if max_bytes is not None and info.file_size > max_bytes:
+                                too_large(name, f"The file is bigger than {max_bytes} bytes")
+                                continue
+                            if max_archive_bytes is not None and extracted + info.file_size > max_archive_bytes:
+                                too_large(name, f"The files of the archive are bigger than {max_archive_bytes} bytes")
+                                continue
+                            remaining = None if max_archive_bytes is None else max_archive_bytes - extracted
+                            limit = min((size for size in (max_bytes, remaining) if size is not None), default=None)
+                            with archive.open(info) as member:
+                                try:
+                                    path, digest = jobs.spool_upload(member, spool_dir, limit)
+                                except extraction.DocumentTooLarge as e:
+                                    too_large(name, str(e))
+                                    continue
+                            extracted += os.path.getsize(path)
+                            documents.append((name, path, digest))
+                except (zipfile.BadZipFile, zlib.error, EOFError):
+                    rejected.append({"filename": filename, "status": "error", "status_code": 400, "detail": "Invalid zip file"})
+            elif filename.lower().endswith('.docx'):
+                try:
+                    path, digest = jobs.spool_upload(fileobj, spool_dir, max_bytes)
+                except extraction.DocumentTooLarge as e:
+                    too_large(filename, str(e))
+                    continue
+                documents.append((filename, path, digest))
+            else:
+                rejected.append({"filename": filename, "status": "error", "status_code": 400, "detail": "Invalid file type. Please upload a .docx file"})
+    except BaseException:
+        # The files already copied are removed, nobody else knows their path
+        for _, path, _ in documents:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        raise
+    return documents, rejected
+
+# Parse, normalize, tokenize and chunk a .docx file, it runs inside a worker process
+def prepare_chunks(path, tokenizer, chunk_size, chunk_overlap, max_part_bytes=None):
+    """
+    Extract the text of a .docx file and split it in token chunks.
+
+    Args:
+        path (str): The path to the .docx file.
+        tokenizer (str): The name of the tiktoken encoding.
+        chunk_size (int): The maximum number of tokens of each chunk.
+        chunk_overlap (int): The number of tokens shared by consecutive chunks.
+        max_part_bytes (int, optional): The maximum decompressed size of each XML part. Defaults to None (no limit).
+
+    Returns:
+        list: A list of tuples with the text of the chunk and its number of tokens.
+    """
+    with open(path, 'rb') as f:
+        texts = extraction.iter_docx_text(f, max_part_bytes=max_part_bytes)
+        return list(processing_docs.chunk_stream(texts, tiktoken.get_encoding(tokenizer), chunk_size, chunk_overlap))
+
+# Ingest many .docx files with a single embedding and upsert stage
+async def ingest_documents(services, files):
+    """
+    Upload many .docx files, or zip archives with .docx files, to the Qdrant vector database.
+
+    Args:
+        services (Services): The clients, caches and pool of workers shared by the requests.
+        files (list): A list of tuples with the filename and a seekable file object of each file.
+
+    Returns:
+        list: One result per file with its status, document id and number of chunks. A rejected file has the
+            status_code 413 when it is too large and 400 when it is not a .docx file or a zip archive.
+    """
+    config = services.config
+    max_bytes = config['api'].get('max_upload_mb', 50) * 1024 * 1024
+    max_part_bytes = config['api'].get('max_part_mb', 200) * 1024 * 1024
+    with metrics.span("spool"):
+        documents, results = await asyncio.to_thread(spool_files, files, services.job_queue.spool_dir, max_bytes, max_part_bytes)
+    try:
+        return await _ingest_spooled(services, documents, results)
+    finally:
+        for _, path, _ in documents:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+# Ingest the .docx files copied to the spool directory
+async def _ingest_spooled(services, documents, results):
+    config, client_vdb = services.config, services.client_vdb
+    loop = asyncio.get_running_loop()
+
+    # Parse all the files in parallel in the worker pool
+    with metrics.span("parse"):
+        prepared = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    services.parse_executor, prepare_chunks, path, config['openai']['tokenizer'],
+                    config['openai'].get('chunk_size', 500), config['openai'].get('chunk_overlap', 50),
+                    config['api'].get('max_part_mb', 200) * 1024 * 1024,
+                )
+                for _, path, _ in documents
+            ),
+            return_exceptions=True,
+        )
+    parsed = []
+    for (filename, _, source_hash), chunks in zip(documents, prepared):
+        if isinstance(chunks, extraction.DocumentTooLarge):
+            results.append({"filename": filename, "status": "error", "status_code": 413, "detail": str(chunks)})
+        elif isinstance(chunks, Exception):
+            results.append({"filename": filename, "status": "error", "detail": f"Error processing file: {chunks}"})
+        elif not chunks:
+            results.append({"filename": filename, "status": "error", "detail": "The document is empty"})
+        else:
+            parsed.append((filename, source_hash, chunks))
+    if not parsed:
+        return results
+
+    # Embed the chunks of all the files together, so every request is as full as the API allows
+    texts = [chunk for _, _, chunks in parsed for chunk, _ in chunks]
+    token_counts = [count for _, _, chunks in parsed for _, count in chunks]
+    embeddings = await processing_docs.embed_texts(
+        services.embeddings, texts, token_counts,
+        max_concurrency=config['ingest'].get('embedding_concurrency', 4),
+        max_retries=config['ingest'].get('max_retries', 5), cache=services.embedding_cache,
+    )
+
+    # Give consecutive ids to the new documents and create their points with the fingerprints of their chunks
+    collection_name = config['qdrant']['collection']
+    model = services.embeddings.name
+    last_id = await services.document_ids.allocate(len(parsed)) - 1
+    points, first_points, offset = [], [], 0
+    for n, (filename, _, chunks) in enumerate(parsed, start=1):
+        document_embeddings = embeddings[offset:offset + len(chunks)]
+        chunk_texts = [chunk for chunk, _ in chunks]
+        first_points.append(len(points))
+        points.extend(processing_docs.create_points(
+            last_id + n, document_embeddings, chunk_texts,
+            [processing_docs.chunk_fingerprint(model, chunk) for chunk in chunk_texts],
+        ))
+        results.append({"filename": filename, "status": "uploaded", "document_id": last_id + n, "chunks": len(chunks)})
+        offset += len(chunks)
+
+    # Upsert the points in large batches
+    batch_size = config['ingest'].get('upsert_batch_size', 256)
+    for start in range(0, len(points), batch_size):
+        with metrics.span("upsert"):
+            await client_vdb.upsert(collection_name=collection_name, wait=True, points=points[start:start + batch_size])
+    # The documents are complete, a later update of the same file is skipped
+    for first, (_, source_hash, _) in zip(first_points, parsed):
+        await processing_docs.store_document_fingerprint(
+            services, points[first].id, processing_docs.document_fingerprint(config, model, source_hash),
+        )
+    if services.keyword_index is not None:
+        services.keyword_index.add_points(points)
+    return results
+
+# Find the .docx and .zip files of a list of paths, the directories are walked recursively
+def find_paths(paths):
+    """
+    Find the .docx and .zip files in a list of files and directories.
+
+    Args:
+        paths (list): A list of paths to files or directories.
+
+    Returns:
+        list: The paths to the .docx and .zip files.
+    """
+    files = []
+    for path in map(Path, paths):
+        candidates = sorted(path.rglob('*')) if path.is_dir() else [path]
+        files.extend(str(candidate) for candidate in candidates if candidate.suffix.lower() in ('.docx', '.zip'))
+    return files
+
+async def main(paths, config_path):
+    from lib.services import Services
+
+    services = Services.create(get_settings(config_path).config)
+    try:
+        with contextlib.ExitStack() as stack:
+            files = [(path, stack.enter_context(open(path, 'rb'))) for path in find_paths(paths)]
+            return await ingest_documents(services, files)
+    finally:
+        await services.close()
+
+
+## This script allow to upload many .docx files, or zip archives with .docx files, to Qdrant. Directories are walked recursively.
+# Usage: python lib/ingest.py path/to/documents [more paths] --config config.yaml
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload many .docx files to the Qdrant vector database.")
+    parser.add_argument("paths", nargs="+", help="The .docx files, .zip files or directories to upload.")
+    parser.add_argument("--config", default="./config.yaml", help="The path to the config.yaml file.")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(main(args.paths, args.config)), indent=4))
@@ -0,0 +1,368 @@
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import lib.processing_docs as processing_docs
+import lib.extraction as extraction
+import lib.metrics as metrics
+
+## Background ingestion of the uploaded documents. The uploads are stored in a spool directory and queued in a
+## SQLite table, and a few asyncio workers extract, normalize, embed and upsert them outside of the HTTP request
+
+# Columns returned by the status of a job
+JOB_FIELDS = (
+    "id", "filename", "status", "stage", "chunks", "attempts", "requested_id", "document_id",
+    "result", "error", "created_at", "updated_at",
+)
+
+# Errors of the file itself, the job fails at once because every attempt would fail the same way
+PERMANENT_ERRORS = (extraction.DocumentTooLarge, extraction.InvalidDocument)
+
+# Raised when the queue already has the maximum number of pending jobs
+class QueueFull(Exception):
+    pass
+
+# Copy an upload to the spool directory computing its hash
+def spool_upload(fileobj, spool_dir, max_bytes=None, block_size=1024 * 1024):
+    """
+    Copy an uploaded file to a temporary file of the spool directory, computing its SHA-256 on the way.
+
+    Args:
+        fileobj: The file object of the upload.
+        spool_dir (str): The directory where the file is copied.
+        max_bytes (int, optional): The maximum size of the file. Defaults to None (no limit).
+        block_size (int, optional): The number of bytes copied at once. Defaults to 1 MB.
+
+    Returns:
+        tuple: The path to the copy and the hex digest of the content.
+
+    Raises:
+        DocumentTooLarge: If the file is bigger than max_bytes.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    fileobj.seek(0)
+    with tempfile.NamedTemporaryFile('wb', dir=spool_dir, suffix='.docx', delete=False) as f:
+        try:
+            while True:
+                block = fileobj.read(block_size)
+                if not block:
+                    break
+                size += len(block)
+                if max_bytes is not None and size > max_bytes:
+                    raise extraction.DocumentTooLarge(f"The file is bigger than {max_bytes} bytes")
+                digest.update(block)
+                f.write(block)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    return f.name, digest.hexdigest()
+
+# Persistent queue of ingestion jobs processed by asyncio workers
+class JobQueue:
+    """
+    Queue of ingestion jobs stored in SQLite and processed by a pool of asyncio workers.
+
+    A job is identified by the hash of the document and the requested document ID, so uploading
+    again a document that is queued, running or already stored returns the same job instead of
+    processing it twice. A failed attempt is retried with an exponential backoff, and the ID allocated
+    to a new document is kept in the job, so a retry overwrites the points of the previous attempt.
+
+    The database is shared with the other processes of the API and a query waits while another process
+    writes, so the coroutines run the queries in a thread of the queue instead of on the event loop.
+
+    Args:
+        path (str): The path to the SQLite database of the jobs.
+        spool_dir (str): The directory where the uploaded files wait to be processed.
+        max_depth (int, optional): The maximum number of queued and running jobs. Defaults to 100.
+        workers (int, optional): The number of jobs processed at the same time. Defaults to 2.
+        max_attempts (int, optional): The number of attempts before a job fails. Defaults to 3.
+        retry_delay (float, optional): The seconds before the first retry, doubled on every attempt. Defaults to 5.
+        max_part_bytes (int, optional): The maximum decompressed size of each XML part. Defaults to None (no limit).
+        poll_interval (float, optional): The maximum seconds an idle worker waits before looking for jobs. Defaults to 1.
+    """
+
+    def __init__(self, path, spool_dir, max_depth=100, workers=2, max_attempts=3, retry_delay=5.0, max_part_bytes=None, poll_interval=1.0):
+        self.spool_dir = spool_dir
+        self.max_depth = max_depth
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_part_bytes = max_part_bytes
+        self.poll_interval = poll_interval
+        self.tasks = []
+        self.wakeup = None
+        self.lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        # The HTTP workers queue the jobs while the ingestion process updates them
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, document_hash TEXT NOT NULL, requested_id INTEGER NOT NULL, document_id INTEGER, "
+            "filename TEXT, spool_path TEXT, status TEXT NOT NULL, stage TEXT, chunks INTEGER NOT NULL DEFAULT 0, "
+            "attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL, available_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS jobs_document ON jobs (document_hash, requested_id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (status, updated_at)")
+        self.db.commit()
+        # The queries are serialized by the lock, so a single thread runs them
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-queue")
+
+    async def _call(self, function, *args, **kwargs):
+        # Run a query in the thread of the queue without blocking the event loop
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    def _update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self.lock, self.db:
+            self.db.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def _depth(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    async def depth(self):
+        """
+        Count the jobs waiting or being processed.
+
+        Returns:
+            int: The number of queued and running jobs.
+        """
+        return await self._call(self._depth)
+
+    async def full(self):
+        """
+        Check if the queue accepts new jobs.
+
+        Returns:
+            bool: True if the queue has max_depth pending jobs.
+        """
+        return await self.depth() >= self.max_depth
+
+    async def submit(self, document_hash, requested_id, filename, spool_path):
+        """
+        Queue the ingestion of an uploaded document, or return the job that already ingests it.
+
+        A job with the same document hash and requested ID is reused while it is queued or running,
+        and after it is done while no later job changed the same document. A failed job is queued again.
+
+        Args:
+            document_hash (str): The SHA-256 of the document.
+            requested_id (int): The ID of the document to update, 0 for a new document.
+            filename (str): The name of the uploaded file.
+            spool_path (str): The path to the copy of the upload in the spool directory.
+
+        Returns:
+            tuple: The status of the job and True if the document is processed again, False if the job already existed.
+
+        Raises:
+            QueueFull: If the document must be processed and the queue has max_depth pending jobs.
+        """
+        status, queued = await self._call(self._submit, document_hash, requested_id, filename, spool_path)
+        if queued and self.wakeup is not None:
+            self.wakeup.set()
+        return status, queued
+
+    def _submit(self, document_hash, requested_id, filename, spool_path):
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT * FROM jobs WHERE document_hash = ? AND requested_id = ?", (document_hash, requested_id)
+            ).fetchone()
+            if row is not None and row["status"] in ("queued", "running"):
+                return self._status(row), False
+            if row is not None and row["status"] == "done":
+                newer = self.db.execute(
+                    "SELECT 1 FROM jobs WHERE document_id = ? AND created_at > ? AND id != ?",
+                    (row["document_id"], row["created_at"], row["id"]),
+                ).fetchone()
+                if newer is None:
+                    return self._status(row), False
+            pending = self.db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+            if pending >= self.max_depth:
+                raise QueueFull(f"The ingestion queue has {pending} pending jobs")
+            if row is None:
+                job_id = uuid.uuid4().hex
+                self.db.execute(
+                    "INSERT INTO jobs (id, document_hash, requested_id, document_id, filename, spool_path, status, stage, "
+                    "created_at, updated_at, available_at) VALUES (?, ?, ?, ?, ?, ?, 'queued', 'queued', ?, ?, ?)",
+                    (job_id, document_hash, requested_id, requested_id or None, filename, spool_path, now, now, now),
+                )
+            else:
+                # The document changed since this job was done, or the job failed: process it again. A failed
+                # new document keeps its id, so the points stored by the failed attempts are overwritten
+                job_id = row["id"]
+                document_id = requested_id or (row["document_id"] if row["status"] == "failed" else None)
+                self.db.execute(
+                    "UPDATE jobs SET filename = ?, spool_path = ?, status = 'queued', stage = 'queued', chunks = 0, "
+                    "attempts = 0, result = NULL, error = NULL, document_id = ?, created_at = ?, updated_at = ?, "
+                    "available_at = ? WHERE id = ?",
+                    (filename, spool_path, document_id, now, now, now, job_id),
+                )
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._status(row), True
+
+    def _updated_documents(self, since):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT DISTINCT document_id FROM jobs WHERE status = 'done' AND requested_id != 0 AND updated_at >= ?", (since,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    async def updated_documents(self, since):
+        """
+        Get the documents updated by the jobs done since a time.
+
+        Args:
+            since (float): The time, in seconds since the epoch.
+
+        Returns:
+            list: The IDs of the documents.
+        """
+        return await self._call(self._updated_documents, since)
+
+    @staticmethod
+    def _status(row):
+        return {field: row[field] for field in JOB_FIELDS}
+
+    def _get(self, job_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._status(row) if row is not None else None
+
+    async def get(self, job_id):
+        """
+        Get the status of a job.
+
+        Args:
+            job_id (str): The id of the job.
+
+        Returns:
+            dict: The status, stage, number of chunks stored and outcome of the job, None if it does not exist.
+        """
+        return await self._call(self._get, job_id)
+
+    def _claim(self):
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' AND available_at <= ? ORDER BY available_at LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            # Another process may have claimed the job since it was read
+            claimed = self.db.execute(
+                "UPDATE jobs SET status = 'running', stage = 'starting', attempts = attempts + 1, updated_at = ? "
+                "WHERE id = ? AND status = 'queued'",
+                (now, row["id"]),
+            ).rowcount
+        return row if claimed else None
+
+    async def _process(self, services, job):
+        job_id = job["id"]
+        # The stages of the job are logged with the id of the job as correlation id
+        context = metrics.RequestContext(job_id)
+        token = metrics.current_request.set(context)
+        start = time.perf_counter()
+        try:
+            if services.role == "all":
+                # In a single process the jobs take the slots of the uploads, so they cannot slow down the searches either
+                async with await services.ingest_pool.acquire(block=True):
+                    outcome = await self._run(services, job)
+            else:
+                outcome = await self._run(services, job)
+            metrics.log_request(
+                context, route="job", attempt=job["attempts"] + 1, status=outcome,
+                duration_ms=f"{(time.perf_counter() - start) * 1000:.1f}",
+            )
+        finally:
+            metrics.current_request.reset(token)
+
+    async def _run(self, services, job):
+        job_id = job["id"]
+        try:
+            document_id = job["document_id"]
+            if job["requested_id"] == 0 and document_id is None:
+                document_id = await services.document_ids.allocate()
+                await self._call(self._update, job_id, document_id=document_id)
+            with open(job["spool_path"], 'rb') as f:
+                texts = extraction.iter_docx_text(f, max_part_bytes=self.max_part_bytes)
+                result = await processing_docs.upload_documents(
+                    services, texts, id=job["requested_id"], document_id=document_id,
+                    progress=lambda stage, chunks: self._call(self._update, job_id, stage=stage, chunks=chunks),
+                    source_hash=job["document_hash"],
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, PERMANENT_ERRORS) or job["attempts"] + 1 >= self.max_attempts:
+                await self._call(self._update, job_id, status="failed", stage="failed", error=str(e))
+                self._discard(job["spool_path"])
+                return "failed"
+            delay = self.retry_delay * 2 ** job["attempts"]
+            await self._call(self._update, job_id, status="queued", stage="retrying", error=str(e), available_at=time.time() + delay)
+            return "retrying"
+        # the cached answers built from the previous version of the document are not valid anymore
+        if job["requested_id"] != 0 and services.answer_cache is not None:
+            services.answer_cache.invalidate_document(document_id)
+        await self._call(self._update, job_id, status="done", stage="done", result=result, error=None)
+        self._discard(job["spool_path"])
+        return "done"
+
+    @staticmethod
+    def _discard(spool_path):
+        try:
+            os.remove(spool_path)
+        except OSError:
+            pass
+
+    async def _work(self, services):
+        while True:
+            job = await self._call(self._claim)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            await self._process(services, job)
+
+    def _requeue_running(self):
+        with self.lock, self.db:
+            self.db.execute("UPDATE jobs SET status = 'queued', stage = 'queued' WHERE status = 'running'")
+
+    async def start(self, services):
+        """
+        Start the workers. The jobs interrupted by a previous shutdown are queued again, so only one
+        process of the API runs the workers.
+
+        Args:
+            services (Services): The clients, models and caches used to process the jobs.
+        """
+        await self._call(self._requeue_running)
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._work(services)) for _ in range(self.workers)]
+
+    async def close(self):
+        """
+        Stop the workers and close the database. The running jobs are processed again on the next start.
+        """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self._call(self.db.close)
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,439 @@
+import os
+import re
+import math
+import time
+import uuid
+import asyncio
+import tempfile
+import threading
+import contextlib
+import numpy as np
+from array import array
+import lib.metrics as metrics
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (Windows) the saves of several processes are not serialized
+    fcntl = None
+
+## Local keyword index of the chunks stored in Qdrant. The chunks are scored with BM25, so the searches of part
+## numbers, names or codes find the chunks that contain them, and a lexical search does not need an embedding.
+## Every process of the API keeps its own copy of the index in memory. A process that saves its changes first reads
+## the changes saved by the others, and the processes read the file again when another one saved it, so the copies
+## converge on the same chunks.
+
+# Words of the index: letters and digits, keeping the hyphens, dots and slashes inside codes such as "xr-200" or "v1.2"
+TOKEN_PATTERN = re.compile(r"\w(?:[\w\-./]*\w)?")
+
+# Split a text in the lowercase words used by the index
+def tokenize(text):
+    """
+    Split a text in lowercase words.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list: The words of the text.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+# Decide if a search is better answered by the keywords than by the embeddings
+def looks_lexical(text, max_terms=3):
+    """
+    Check if a search looks like a lookup of codes or names: a few words, one of them with a digit
+    or written in capitals, for example "XR-200 manual" or "ISO 9001".
+
+    Args:
+        text (str): The search.
+        max_terms (int, optional): The maximum number of words of a lexical search. Defaults to 3.
+
+    Returns:
+        bool: True if the search looks lexical.
+    """
+    words = TOKEN_PATTERN.findall(text)
+    if not words or len(words) > max_terms:
+        return False
+    return any(any(c.isdigit() for c in word) or (len(word) > 1 and word.isupper()) for word in words)
+
+# Fuse several rankings giving every item the sum of 1 / (k + rank) over the rankings where it appears
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuse rankings with Reciprocal Rank Fusion.
+
+    Args:
+        rankings (list): Lists of keys, best first.
+        k (int, optional): The constant that damps the weight of the first positions. Defaults to 60.
+
+    Returns:
+        list: Tuples of key and fused score, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+# Inverted index of the chunks with BM25 scoring
+class KeywordIndex:
+    """
+    Inverted index of the chunks kept in arrays and scored with BM25.
+
+    Every chunk has a slot. The postings of every word are two arrays with the slots and the
+    frequencies of the word, so a search is a few vectorized NumPy operations. A chunk that is
+    updated or removed is marked as dead and its slot is dropped when the index is saved. The file
+    is a NumPy .npz archive of flat arrays: the words, the offsets of their postings, the postings,
+    the lengths of the chunks and their point ids, document ids and chunk indexes.
+
+    The changes made since the last save are kept, so when another process saved the file meanwhile,
+    the file is read again and the changes are applied on top of it. sync saves the changes and reads
+    the ones saved by the other processes.
+
+    Args:
+        path (str, optional): The path to the .npz file of the index. Defaults to None (kept only in memory).
+        k1 (float, optional): The BM25 saturation of the word frequencies. Defaults to 1.2.
+        b (float, optional): The BM25 normalization by the length of the chunks. Defaults to 0.75.
+        save_interval (float, optional): The minimum seconds between two saves after a change. Defaults to 30.
+    """
+
+    def __init__(self, path=None, k1=1.2, b=0.75, save_interval=30.0):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.save_interval = save_interval
+        self.lock = threading.RLock()
+        # Serializes the reads and writes of the file, which do not hold the lock of the searches
+        self.io_lock = threading.RLock()
+        self.saved_at = 0.0
+        # Changes not saved yet, applied again when the file is read, and the version of the file read last
+        self.pending = [] if path else None
+        self.stamp = None
+        self._reset()
+        if path and os.path.exists(path):
+            self.load()
+
+    def _reset(self):
+        self.postings = {}
+        self.lengths = array('I')
+        self.alive = array('b')
+        self.point_ids = []
+        self.document_ids = array('q')
+        self.chunk_indexes = array('I')
+        self.slots = {}
+        self.live = 0
+        self.total_length = 0
+        self.dirty = False
+
+    def __len__(self):
+        return self.live
+
+    def _remove_slot(self, slot):
+        if self.alive[slot]:
+            self.alive[slot] = 0
+            self.live -= 1
+            self.total_length -= self.lengths[slot]
+
+    def _file_stamp(self):
+        # The version of the file, which changes every time a process replaces it
+        if not self.path:
+            return None
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        # Only one process at a time reads the changes of the others and replaces the file
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def add(self, point_id, document_id, chunk_index, text):
+        """
+        Index a chunk, replacing the previous text of the same point.
+
+        Args:
+            point_id (str): The id of the point in Qdrant.
+            document_id (int): The ID of the document.
+            chunk_index (int): The index of the chunk in the document.
+            text (str): The text of the chunk.
+        """
+        with self.lock:
+            self._add(point_id, document_id, chunk_index, text)
+            if self.pending is not None:
+                self.pending.append(("add", point_id, document_id, chunk_index, text))
+
+    def _add(self, point_id, document_id, chunk_index, text):
+        words = tokenize(text)
+        frequencies = {}
+        for word in words:
+            frequencies[word] = frequencies.get(word, 0) + 1
+        with self.lock:
+            previous = self.slots.get(point_id)
+            if previous is not None:
+                self._remove_slot(previous)
+            slot = len(self.lengths)
+            self.slots[point_id] = slot
+            self.point_ids.append(point_id)
+            self.document_ids.append(document_id)
+            self.chunk_indexes.append(chunk_index)
+            self.lengths.append(len(words))
+            self.alive.append(1)
+            self.live += 1
+            self.total_length += len(words)
+            for word, frequency in frequencies.items():
+                posting = self.postings.get(word)
+                if posting is None:
+                    posting = self.postings[word] = (array('I'), array('I'))
+                posting[0].append(slot)
+                posting[1].append(frequency)
+            self.dirty = True
+
+    def add_points(self, points):
+        """
+        Index the chunks of a list of Qdrant points. The points stored by the first version of the API, one per
+        document with an integer id and only the Document_text payload, are skipped until they are split in
+        chunks by python lib/collection.py rechunk.
+
+        Args:
+            points (list): PointStruct or records with the document_id, chunk_index and Document_text payload.
+
+        Returns:
+            int: The number of points skipped.
+        """
+        skipped = 0
+        for point in points:
+            payload = point.payload or {}
+            if isinstance(point.id, int) or 'document_id' not in payload:
+                skipped += 1
+                continue
+            self.add(str(point.id), payload['document_id'], payload['chunk_index'], payload['Document_text'])
+        return skipped
+
+    def remove_points(self, point_ids):
+        """
+        Remove chunks from the index.
+
+        Args:
+            point_ids (list): The ids of their points in Qdrant.
+        """
+        with self.lock:
+            self._remove_points(point_ids)
+            if self.pending is not None:
+                self.pending.append(("remove", list(point_ids)))
+
+    def _remove_points(self, point_ids):
+        for point_id in point_ids:
+            slot = self.slots.pop(str(point_id), None)
+            if slot is not None:
+                self._remove_slot(slot)
+                self.dirty = True
+
+    def search(self, text, limit=10, min_score=0.0):
+        """
+        Find the chunks with the best BM25 score for the words of a search.
+
+        Only the chunks in the postings of the words are scored, so the time of a search does not
+        depend on the number of chunks in the index.
+
+        Args:
+            text (str): The search.
+            limit (int, optional): The maximum number of chunks returned. Defaults to 10.
+            min_score (float, optional): The minimum BM25 score of a chunk. Defaults to 0.
+
+        Returns:
+            list: Tuples of point id and BM25 score, best first.
+        """
+        words = set(tokenize(text))
+        with self.lock:
+            if not self.live:
+                return []
+            alive = np.frombuffer(self.alive, dtype=np.int8)
+            lengths = np.frombuffer(self.lengths, dtype=np.uint32)
+            average_length = max(self.total_length / self.live, 1e-9)
+            found, contributions = [], []
+            for word in words:
+                posting = self.postings.get(word)
+                if posting is None:
+                    continue
+                slots = np.frombuffer(posting[0], dtype=np.uint32)
+                live = alive[slots].astype(bool)
+                slots = slots[live]
+                if not len(slots):
+                    continue
+                frequencies = np.frombuffer(posting[1], dtype=np.uint32)[live].astype(np.float32)
+                norms = (self.k1 * (1 - self.b + self.b * lengths[slots] / average_length)).astype(np.float32)
+                idf = math.log(1 + (self.live - len(slots) + 0.5) / (len(slots) + 0.5))
+                found.append(slots)
+                contributions.append(idf * frequencies * (self.k1 + 1) / (frequencies + norms))
+            if not found:
+                return []
+            # Add up the scores of every chunk over the words, the chunks are sorted by slot
+            slots, inverse = np.unique(np.concatenate(found), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(contributions)).astype(np.float32)
+            candidates = np.flatnonzero(scores > max(min_score, 0.0))
+            best = candidates[np.argsort(-scores[candidates], kind="stable")[:limit]]
+            return [(self.point_ids[slots[n]], float(scores[n])) for n in best]
+
+    def save(self, force=False):
+        """
+        Write the index to its file, dropping the dead slots. The file is replaced atomically, after
+        reading the changes saved by the other processes since this one read it, and read back, so the
+        dead slots and their postings are also dropped from the memory. The searches only wait while the
+        index is copied and while the arrays read back replace the old ones.
+
+        Args:
+            force (bool, optional): Save even if the last save is more recent than save_interval. Defaults to False.
+        """
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty or (not force and time.monotonic() - self.saved_at < self.save_interval):
+                return
+        with self.io_lock, self._file_lock():
+            self.refresh()
+            with self.lock:
+                snapshot = self._snapshot()
+                saved = len(self.pending or ())
+            self._write(*snapshot)
+            with self.lock:
+                # The changes made while the file was written are saved the next time
+                if self.pending is not None:
+                    del self.pending[:saved]
+            # The file has no dead slots, reading it back drops them from the memory too, and the changes made
+            # meanwhile are applied again on top of it
+            self.load()
+            with self.lock:
+                self.saved_at = time.monotonic()
+                self.dirty = bool(self.pending)
+
+    def _snapshot(self):
+        # Copy the arrays of the index, the slots and postings are only appended and the copies are not
+        return (
+            {word: (array('I', slots), array('I', counts)) for word, (slots, counts) in self.postings.items()},
+            array('b', self.alive), array('I', self.lengths), list(self.point_ids),
+            array('q', self.document_ids), array('I', self.chunk_indexes),
+        )
+
+    def _write(self, postings, alive, lengths, point_ids, document_ids, chunk_indexes):
+        alive = np.frombuffer(alive, dtype=np.int8).astype(bool)
+        # New slot of every live slot
+        remap = np.cumsum(alive, dtype=np.int64) - 1
+        words, offsets, word_postings, frequencies = [], [0], [], []
+        for word, (slots, counts) in postings.items():
+            slots = np.frombuffer(slots, dtype=np.uint32)
+            live = alive[slots]
+            if not live.any():
+                continue
+            words.append(word)
+            word_postings.append(remap[slots[live]].astype(np.uint32))
+            frequencies.append(np.frombuffer(counts, dtype=np.uint32)[live])
+            offsets.append(offsets[-1] + int(live.sum()))
+        live_slots = np.flatnonzero(alive)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False, suffix='.tmp') as f:
+            np.savez(
+                f,
+                words=np.frombuffer("\n".join(words).encode("utf-8"), dtype=np.uint8),
+                offsets=np.asarray(offsets, dtype=np.int64),
+                postings=np.concatenate(word_postings) if word_postings else np.zeros(0, dtype=np.uint32),
+                frequencies=np.concatenate(frequencies) if frequencies else np.zeros(0, dtype=np.uint32),
+                lengths=np.frombuffer(lengths, dtype=np.uint32)[live_slots],
+                point_ids=np.frombuffer(b"".join(uuid.UUID(point_ids[slot]).bytes for slot in live_slots), dtype=np.uint8),
+                document_ids=np.frombuffer(document_ids, dtype=np.int64)[live_slots],
+                chunk_indexes=np.frombuffer(chunk_indexes, dtype=np.uint32)[live_slots],
+            )
+        os.replace(f.name, self.path)
+
+    def load(self):
+        """
+        Read the index from its file and apply again the changes not saved yet. The file is read
+        without the lock of the searches, which only wait while the new arrays replace the old ones.
+        """
+        with self.io_lock:
+            stamp = self._file_stamp()
+            with np.load(self.path, allow_pickle=False) as data:
+                words = bytes(data["words"]).decode("utf-8").split("\n") if len(data["words"]) else []
+                offsets, postings, frequencies = data["offsets"], data["postings"], data["frequencies"]
+                postings = {
+                    word: (array('I', postings[offsets[n]:offsets[n + 1]].tobytes()), array('I', frequencies[offsets[n]:offsets[n + 1]].tobytes()))
+                    for n, word in enumerate(words)
+                }
+                lengths = array('I', data["lengths"].astype(np.uint32).tobytes())
+                document_ids = array('q', data["document_ids"].astype(np.int64).tobytes())
+                chunk_indexes = array('I', data["chunk_indexes"].astype(np.uint32).tobytes())
+                point_ids = data["point_ids"].tobytes()
+                point_ids = [str(uuid.UUID(bytes=point_ids[start:start + 16])) for start in range(0, len(point_ids), 16)]
+                total_length = int(data["lengths"].sum())
+            slots = {point_id: slot for slot, point_id in enumerate(point_ids)}
+            alive = array('b', [1]) * len(point_ids)
+            with self.lock:
+                self.stamp = stamp
+                self.postings, self.lengths, self.alive, self.point_ids = postings, lengths, alive, point_ids
+                self.document_ids, self.chunk_indexes, self.slots = document_ids, chunk_indexes, slots
+                self.live, self.total_length, self.dirty = len(point_ids), total_length, False
+                for change in self.pending or ():
+                    if change[0] == "add":
+                        self._add(*change[1:])
+                    else:
+                        self._remove_points(*change[1:])
+
+    def refresh(self):
+        """
+        Read the file again if another process saved it since this one read it.
+
+        Returns:
+            bool: True if the file was read.
+        """
+        if not self.path:
+            return False
+        with self.io_lock:
+            stamp = self._file_stamp()
+            if stamp is None or stamp == self.stamp:
+                return False
+            self.load()
+            return True
+
+    def sync(self):
+        """
+        Save the changes of this process, at most once every save_interval seconds, and read the changes saved by the others.
+        """
+        self.save()
+        self.refresh()
+
+    async def rebuild(self, client_vdb, collection_name, batch_size=256):
+        """
+        Index again all the chunks stored in a Qdrant collection.
+
+        Args:
+            client_vdb (AsyncQdrantClient): The async Qdrant client.
+            collection_name (str): The name of the collection in Qdrant.
+            batch_size (int, optional): The number of points read at once. Defaults to 256.
+        """
+        with self.lock:
+            self._reset()
+            # The chunks of Qdrant replace the file, so the changes are not kept to be applied on it
+            self.pending = None
+        offset, skipped = None, 0
+        while True:
+            records, offset = await client_vdb.scroll(
+                collection_name=collection_name, limit=batch_size, offset=offset,
+                with_payload=["document_id", "chunk_index", "Document_text"], with_vectors=False,
+            )
+            skipped += self.add_points(records)
+            if offset is None:
+                break
+        if skipped:
+            metrics.logger.warning(
+                "%s points of %s stored before the documents were split in chunks are not in the keyword index, "
+                "run python lib/collection.py rechunk to split them", skipped, collection_name,
+            )
+        with self.lock:
+            self.pending = [] if self.path else None
+            self.stamp = self._file_stamp()
+        await asyncio.to_thread(self.save, True)
@@ -0,0 +1,189 @@
+import time
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+## Admission control of the expensive requests. Every user has a token bucket per kind of request, kept in SQLite
+## so all the processes of the API share the same counters, and the searches and the ingestion run in separate
+## pools of slots, so a client uploading many documents cannot take the slots of the searches.
+
+# Raised when a user has no tokens left in the bucket of a kind of request
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limit exceeded, retry in {retry_after:.1f} seconds")
+        self.retry_after = retry_after
+
+# Raised when a pool has no free slot before the admission timeout
+class PoolBusy(Exception):
+    pass
+
+# Token buckets of the users stored in SQLite
+class RateLimiter:
+    """
+    Per-user token buckets shared by the processes through a SQLite database.
+
+    Every kind of request has a rate of tokens per minute and a burst, the size of the bucket. A request
+    takes one token of the bucket of its user and kind, and the bucket is refilled continuously at the rate.
+    The bucket is read and updated in a single write transaction, so the processes never admit more
+    requests than the bucket allows. The transaction waits for the lock of the database held by the other
+    processes, so the requests take their tokens with acquire, which runs it in a thread of the limiter.
+
+    Args:
+        path (str, optional): The path to the SQLite database of the buckets. Defaults to ":memory:" (shared only by this process).
+        rates (dict, optional): The tokens per minute and the burst of every kind, a kind with 0 tokens per minute is not limited. Defaults to None (no limits).
+    """
+
+    def __init__(self, path=":memory:", rates=None):
+        self.rates = {kind: (per_minute / 60, max(burst, 1)) for kind, (per_minute, burst) in (rates or {}).items() if per_minute > 0}
+        self.limited = {kind: 0 for kind in self.rates}
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "user TEXT NOT NULL, kind TEXT NOT NULL, tokens REAL NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (user, kind))"
+        )
+        # The transactions are serialized by the lock, so a single thread runs them
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rate-limiter")
+
+    async def acquire(self, user, kind):
+        """
+        Take a token of the bucket of a user without blocking the event loop.
+
+        Args:
+            user (str): The user, the sub of the JWT.
+            kind (str): The kind of request, for example search or upload.
+
+        Raises:
+            RateLimited: If the bucket is empty, with the seconds until it has a token again.
+        """
+        if kind in self.rates:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.take, user, kind)
+
+    def take(self, user, kind):
+        """
+        Take a token of the bucket of a user.
+
+        Args:
+            user (str): The user, the sub of the JWT.
+            kind (str): The kind of request, for example search or upload.
+
+        Raises:
+            RateLimited: If the bucket is empty, with the seconds until it has a token again.
+        """
+        if kind not in self.rates:
+            return
+        rate, burst = self.rates[kind]
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self.db.execute("SELECT tokens, updated_at FROM buckets WHERE user = ? AND kind = ?", (user, kind)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + max(now - row[1], 0) * rate)
+                if tokens >= 1:
+                    self.db.execute(
+                        "INSERT INTO buckets (user, kind, tokens, updated_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (user, kind) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                        (user, kind, tokens - 1, now),
+                    )
+            finally:
+                self.db.execute("COMMIT")
+            if tokens < 1:
+                self.limited[kind] += 1
+                raise RateLimited((1 - tokens) / rate)
+
+    @property
+    def stats(self):
+        """
+        dict: The number of requests refused by every limited kind.
+        """
+        return dict(self.limited)
+
+    def close(self):
+        """
+        Close the SQLite database of the buckets.
+        """
+        self.executor.shutdown(wait=True)
+        self.db.close()
+
+# Slot of a pool, released once even if release is called again
+class Slot:
+    __slots__ = ("pool", "released")
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+# Limit of the concurrent requests of a kind in this process
+class ConcurrencyPool:
+    """
+    Pool of slots that caps the requests of a kind running at the same time in the process.
+
+    A request waits for a free slot at most timeout seconds and is refused after, so a busy pool
+    answers quickly instead of piling up requests.
+
+    Args:
+        name (str): The name of the pool in the metrics.
+        size (int, optional): The number of slots, None or 0 for no limit. Defaults to None.
+        timeout (float, optional): The maximum seconds a request waits for a slot. Defaults to 10.
+    """
+
+    def __init__(self, name, size=None, timeout=10.0):
+        self.name = name
+        self.size = size or None
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(size) if size else None
+        self.in_use = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    async def acquire(self, block=False):
+        """
+        Wait for a free slot.
+
+        Args:
+            block (bool, optional): Wait without the timeout, for the background work that is never refused. Defaults to False.
+
+        Returns:
+            Slot: The slot, to be released when the request ends, or used with async with.
+
+        Raises:
+            PoolBusy: If no slot is free after timeout seconds.
+        """
+        if self.semaphore is not None:
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), None if block else self.timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise PoolBusy(f"The {self.name} pool has no free slot")
+        self.in_use += 1
+        self.admitted += 1
+        return Slot(self)
+
+    def release(self):
+        """
+        Free a slot taken by acquire.
+        """
+        self.in_use -= 1
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+    @property
+    def stats(self):
+        """
+        dict: The slots in use and the number of requests admitted and rejected.
+        """
+        return {"in_use": self.in_use, "admitted": self.admitted, "rejected": self.rejected}
@@ -0,0 +1,449 @@
+import re
+import time
+import uuid
+import logging
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+
+## Metrics of the API in the Prometheus text format and a log line per request. The stages of the searches,
+## uploads and logins are timed with spans that add their duration to a histogram and to the request being
+## served, so the log line of a slow request shows where the time went. A span costs two clock reads and a lock.
+
+logger = logging.getLogger("api")
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Correlation ids accepted from the X-Request-ID header of the clients
+REQUEST_ID_PATTERN = re.compile(r"[\w.\-:]{1,128}")
+
+# Request or job being served by the current task: its correlation id, and the seconds and tokens of every stage
+class RequestContext:
+    __slots__ = ("id", "stages", "tokens")
+
+    def __init__(self, request_id):
+        self.id = request_id
+        self.stages = {}
+        self.tokens = {}
+
+current_request = ContextVar("current_request", default=None)
+
+# Escape a label value of the Prometheus text format
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Format the labels of a sample
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+# Format a number of the Prometheus text format
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Metrics registered to be rendered by /metrics
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "".join(metric.render() for metric in self.metrics)
+
+REGISTRY = Registry()
+
+# Value that only goes up, one per combination of label values
+class Counter:
+    """
+    Counter of the Prometheus text format.
+
+    Args:
+        name (str): The name of the metric.
+        documentation (str): The help text of the metric.
+        labels (tuple, optional): The names of the labels. Defaults to no labels.
+        registry (Registry, optional): The registry rendered by /metrics. Defaults to REGISTRY, None to not register it.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, *labels, amount=1):
+        """
+        Add an amount to the value of some label values.
+
+        Args:
+            *labels: The values of the labels, in the order of their names.
+            amount (float, optional): The amount added. Defaults to 1.
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set(self, *labels, value):
+        """
+        Replace the value of some label values, used when the value is counted somewhere else.
+
+        Args:
+            *labels: The values of the labels, in the order of their names.
+            value (float): The new value.
+        """
+        with self.lock:
+            self.values[labels] = value
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        lines = [f"# HELP {self.name} {self.documentation}\n", f"# TYPE {self.name} {self.kind}\n"]
+        lines.extend(f"{self.name}{_labels(self.labels, labels)} {_number(value)}\n" for labels, value in values)
+        return "".join(lines)
+
+# Value that goes up and down, one per combination of label values
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        """
+        Subtract an amount from the value of some label values.
+
+        Args:
+            *labels: The values of the labels, in the order of their names.
+            amount (float, optional): The amount subtracted. Defaults to 1.
+        """
+        self.inc(*labels, amount=-amount)
+
+# Distribution of values in cumulative buckets, one per combination of label values
+class Histogram:
+    """
+    Histogram of the Prometheus text format.
+
+    Args:
+        name (str): The name of the metric.
+        documentation (str): The help text of the metric.
+        labels (tuple, optional): The names of the labels. Defaults to no labels.
+        buckets (tuple, optional): The upper bounds of the buckets, sorted. Defaults to LATENCY_BUCKETS.
+        registry (Registry, optional): The registry rendered by /metrics. Defaults to REGISTRY, None to not register it.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value, *labels):
+        """
+        Add a value to the histogram of some label values.
+
+        Args:
+            value (float): The observed value.
+            *labels: The values of the labels, in the order of their names.
+        """
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # The counts of the buckets and the +Inf bucket, then the sum of the values
+                state = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    def render(self):
+        with self.lock:
+            values = [(labels, list(state)) for labels, state in self.values.items()]
+        lines = [f"# HELP {self.name} {self.documentation}\n", f"# TYPE {self.name} {self.kind}\n"]
+        for labels, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}\n")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {_number(state[-1])}\n")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}\n")
+        return "".join(lines)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Duration of the HTTP requests until the last byte of the response.",
+    ("method", "route", "status"),
+)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being served.")
+STAGE_SECONDS = Histogram("rag_stage_duration_seconds", "Duration of the stages of the searches, uploads and logins.", ("stage",))
+TOKENS = Counter("rag_tokens_total", "Tokens of the texts embedded and of the context sent to the LLM.", ("kind",))
+CACHE_REQUESTS = Counter("rag_cache_requests_total", "Lookups of the caches by outcome.", ("cache", "result"))
+CACHE_ENTRIES = Gauge("rag_cache_entries", "Entries kept in memory by the caches.", ("cache",))
+JOB_QUEUE_DEPTH = Gauge("rag_job_queue_depth", "Ingestion jobs queued or running.")
+INGESTED_CHUNKS = Counter(
+    "rag_ingested_chunks_total", "Chunks of the uploaded documents stored, skipped because unchanged, and removed.", ("outcome",),
+)
+COALESCED_SEARCHES = Counter(
+    "rag_coalesced_searches_total",
+    "Searches that started an answer (leader) or shared one in progress (follower), and shared answers cancelled or timed out.",
+    ("role",),
+)
+KEYWORD_INDEX_CHUNKS = Gauge("rag_keyword_index_chunks", "Chunks in the keyword index.")
+ADMISSIONS = Counter(
+    "rag_admissions_total",
+    "Requests admitted in the search and ingest pools or rejected because the pool was busy, and requests rejected by the rate limit of their user.",
+    ("pool", "result"),
+)
+POOL_IN_USE = Gauge("rag_pool_in_use", "Slots of the search and ingest pools in use.", ("pool",))
+
+# Add the duration of a stage to its histogram and to the current request
+def record(stage, seconds):
+    """
+    Record the duration of a stage.
+
+    Args:
+        stage (str): The name of the stage.
+        seconds (float): The duration of the stage.
+    """
+    STAGE_SECONDS.observe(seconds, stage)
+    request = current_request.get()
+    if request is not None:
+        request.stages[stage] = request.stages.get(stage, 0.0) + seconds
+
+# Time the code of a with block as a stage
+class span:
+    """
+    Context manager that records the duration of its block as a stage, also when the block raises.
+
+    Args:
+        stage (str): The name of the stage.
+    """
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.stage, time.perf_counter() - self.start)
+        return False
+
+# Iterator that measures the time spent producing its items, for the stages that run inside lazy iterators
+class TimedIterator:
+    """
+    Wrap an iterable and add up the seconds spent waiting for its items.
+
+    Args:
+        iterable (iterable): The wrapped iterable.
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def close(self):
+        # Close the wrapped generator, if any
+        close = getattr(self.iterator, "close", None)
+        if close is not None:
+            close()
+
+# Count the tokens of a stage
+def count_tokens(kind, tokens):
+    """
+    Add tokens to the counter of their kind and to the current request.
+
+    Args:
+        kind (str): The kind of tokens, "embedding" or "context".
+        tokens (int): The number of tokens.
+    """
+    if tokens:
+        TOKENS.inc(kind, amount=tokens)
+        request = current_request.get()
+        if request is not None:
+            request.tokens[kind] = request.tokens.get(kind, 0) + tokens
+
+# Count the chunks of the uploaded documents by outcome
+def count_chunks(outcome, chunks):
+    """
+    Add chunks to the counter of their outcome.
+
+    Args:
+        outcome (str): What happened to the chunks, "stored", "unchanged" or "removed".
+        chunks (int): The number of chunks.
+    """
+    if chunks:
+        INGESTED_CHUNKS.inc(outcome, amount=chunks)
+
+# Write the log line of a request or a job with the time and tokens of its stages
+def log_request(context, **fields):
+    """
+    Log a request in logfmt: the given fields and the milliseconds and tokens of every stage. The correlation id
+    is added to the record by RequestIdFilter.
+
+    Args:
+        context (RequestContext): The context of the request.
+        **fields: The fields of the log line, for example the route, the status and the duration.
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    parts = [f"{key}={value}" for key, value in fields.items()]
+    if context.stages:
+        parts.append("stages=" + ",".join(f"{stage}:{seconds * 1000:.1f}" for stage, seconds in context.stages.items()))
+    if context.tokens:
+        parts.append("tokens=" + ",".join(f"{kind}:{count}" for kind, count in context.tokens.items()))
+    logger.info(" ".join(parts))
+
+# ASGI middleware that times every request and gives it a correlation id
+class MetricsMiddleware:
+    """
+    Measure the duration and the requests in flight of every HTTP request, and log it with its stages.
+
+    The correlation id is read from the X-Request-ID header, or created, and sent back in the same
+    header of the response. The duration of a streamed response includes the whole stream.
+
+    Args:
+        app (ASGIApp): The wrapped application.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = {}
+
+    def _route(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        route = self.routes.get(endpoint)
+        if route is None:
+            for candidate in getattr(scope.get("app"), "routes", ()):
+                if getattr(candidate, "endpoint", None) is endpoint:
+                    route = self.routes[endpoint] = candidate.path
+                    break
+            else:
+                return "unmatched"
+        return route
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        if request_id is None or not REQUEST_ID_PATTERN.fullmatch(request_id):
+            request_id = uuid.uuid4().hex
+        context = RequestContext(request_id)
+        token = current_request.set(context)
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [*message.get("headers", ()), (b"x-request-id", request_id.encode("latin-1"))]}
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            seconds = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec()
+            route = self._route(scope)
+            REQUEST_SECONDS.observe(seconds, scope["method"], route, status)
+            log_request(context, method=scope["method"], route=route, status=status, duration_ms=f"{seconds * 1000:.1f}")
+            current_request.reset(token)
+
+# Add the correlation id of the current request to every log record
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        request = current_request.get()
+        record.request_id = request.id if request is not None else "-"
+        return True
+
+# Send the logs of the API to the standard error with the correlation id of the request
+def configure_logging(level="INFO"):
+    """
+    Configure the root logger, unless it is already configured, to write the logs with the correlation id.
+
+    Args:
+        level (str, optional): The minimum level of the logs. Defaults to "INFO".
+    """
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(format="%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s")
+        for handler in root.handlers:
+            handler.addFilter(RequestIdFilter())
+    logger.setLevel(level)
+
+# Render the metrics with the counters kept by the caches, the job queue, the keyword index and the pools
+def render(services, token_cache=None, queue_depth=None):
+    """
+    Build the text of the /metrics endpoint.
+
+    The caches keep their own hit and miss counters, so they are copied to the metrics when the
+    metrics are read instead of on every lookup.
+
+    Args:
+        services (Services): The clients, models and caches shared by the requests.
+        token_cache (TokenCache, optional): The cache of the verified tokens. Defaults to None.
+        queue_depth (int, optional): The number of queued and running jobs, read from the job queue by the caller. Defaults to None (not exported).
+
+    Returns:
+        str: The metrics in the Prometheus text format.
+    """
+    caches = [("embedding", services.embedding_cache), ("answer", services.answer_cache), ("token", token_cache)]
+    for name, cache in caches:
+        if cache is None:
+            continue
+        stats = cache.stats
+        CACHE_REQUESTS.set(name, "hit", value=stats["hits"] + stats.get("disk_hits", 0))
+        CACHE_REQUESTS.set(name, "miss", value=stats["misses"])
+        CACHE_ENTRIES.set(name, value=stats["entries"])
+    if queue_depth is not None:
+        JOB_QUEUE_DEPTH.set(value=queue_depth)
+    if services.keyword_index is not None:
+        KEYWORD_INDEX_CHUNKS.set(value=len(services.keyword_index))
+    if services.search_flights is not None:
+        for role, value in services.search_flights.stats.items():
+            COALESCED_SEARCHES.set(role, value=value)
+    for pool in (services.search_pool, services.ingest_pool):
+        stats = pool.stats
+        ADMISSIONS.set(pool.name, "admitted", value=stats["admitted"])
+        ADMISSIONS.set(pool.name, "busy", value=stats["rejected"])
+        POOL_IN_USE.set(pool.name, value=stats["in_use"])
+    if services.rate_limiter is not None:
+        for kind, value in services.rate_limiter.stats.items():
+            ADMISSIONS.set(kind, "rate_limited", value=value)
+    return REGISTRY.render()
@@ -1,73 +1,544 @@
 import re
-import tiktoken
-from openai import OpenAI
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
-from langchain_openai import ChatOpenAI
-from langchain.prompts import PromptTemplate
+import asyncio
+from lib.extraction import DocumentTooLarge, InvalidDocument
+from lib.keyword_index import looks_lexical, reciprocal_rank_fusion
+from lib.providers import RateLimited, EMBEDDING_MAX_INPUTS, EMBEDDING_MAX_TOKENS
+import lib.metrics as metrics
+import lib.collection as collection
+from itertools import islice
+import random
+import uuid
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from array import array
+from collections import OrderedDict
+from contextlib import aclosing
+from concurrent.futures import ThreadPoolExecutor
+# The models of qdrant_client are imported by the functions that use them, importing them takes most of the start
+# of the API and they are loaded anyway by the warm-up of the services before the first request
+
+# Answer given when no chunk is similar enough to the prompt
+NO_MATCH_ANSWER = "I don´t have data that matching with a document according with your search."
+
+# Namespace used to derive the id of every chunk from the document id and the chunk index
+CHUNK_NAMESPACE = uuid.UUID("6f1c5a52-3f0e-4c3b-9a43-1f5e2c9d7b10")
+
+# Version of the normalization and chunking, part of the fingerprint of the documents: change it when they change
+FINGERPRINT_VERSION = 2
 
 ## Methods to use OPENAI API, process text, and create embeddings
 
+# Characters removed by the normalization
+NORMALIZE_DELETE = str.maketrans("", "", "#")
+
+# A period, or a run of periods, followed by " ," once the whitespace is collapsed
+NORMALIZE_COMMA = re.compile(r"\.(?: ?\.)* ,")
+
+# A run of periods with or without single spaces between them
+NORMALIZE_PERIODS = re.compile(r"\.(?: ?\.)+")
+
+# The double spaces left where a period followed by " ," is removed
+NORMALIZE_SPACES = re.compile(r"  +")
+
+# Apply the rules of the periods and the commas to a text whose whitespace is already collapsed
+def _normalize_periods(s):
+    s, removed = NORMALIZE_COMMA.subn("", s)
+    if removed:
+        s = NORMALIZE_SPACES.sub(" ", s)
+    return NORMALIZE_PERIODS.sub(".", s)
+
 # Process the text applying some normalization steps to remove special characters and multiple spaces
 def normalize_text(s):
     """
     Normalize the text by removing special characters and multiple spaces.
-    
+
+    The rules, applied in this order, are:
+
+    1. Every "#" is removed.
+    2. Every run of whitespace, line breaks included, becomes a single space.
+    3. A period or a run of periods followed by " ," is removed with the " ,", and the two spaces
+       left around it become one, so "end. , next" and "end . , next" become "end next".
+    4. Any other run of periods, with or without single spaces between them, becomes one period,
+       so "end.. next" and "end. . next" become "end. next".
+    5. The spaces at both ends are removed.
+
+    Normalizing an already normalized text does not change it. The text is read by str.translate,
+    str.split and two precompiled regular expressions that only start a match at a period.
+
     Args:
         s (str): The input text.
-    
+
     Returns:
         str: The normalized text.
     """
-    s = re.sub(r'\s+', ' ', s).strip()
-    s = re.sub(r". ,", "", s)
-    s = s.replace("..", ".")
-    s = s.replace(". .", ".")
-    s = s.replace("\n", "")
-    s = s.replace("#", "")
-    s = s.strip()
-    
-    return s
-
-# Using tiktoken framewrokt by OpenAI to create embeddings 
-def create_embeddings(client, text, tokenizer, model):
-    """
-    Create embeddings for a given document file.
-    
-    Args:
-        client (OpenAI): The OpenAI client.
-        file_path (str): The path to the document file.
-    
-    Returns:
-        tuple: A tuple containing the embedding, tokens, and normalized text. 
-               Returns a string when the file format is invalid.
-    """
-    if len(text) > 0:
-        # Read the document file
-        # text = docx2txt.process(file_path)
-        
-        # Normalize the text
-        normalized_text = normalize_text(text)
-        
-        # Tokenize the normalized text
-        tokenizer = tiktoken.get_encoding(tokenizer)
-        tokens = tokenizer.encode(normalized_text)
-        
-        #Create embeddings using OpenAI client
-        embedding = client.embeddings.create(input=normalized_text, model=model).data[0].embedding
-        
-        return embedding, tokens, normalized_text
-    else:
-        return "Error: Invalid file format. Only .docx files are supported.", None, None
+    return _normalize_periods(" ".join(s.translate(NORMALIZE_DELETE).split())).strip()
+
+# A paragraph ends a chunk when the hash of its text, read as a number between 0 and 1, is below its share of the target size
+def _ends_chunk(paragraph, tokens, target):
+    digest = hashlib.blake2b(paragraph.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2 ** 64 < tokens / target
+
+# Split a stream of paragraphs in chunks of whole paragraphs and decode every chunk as a text
+def chunk_stream(texts, encoding, chunk_size, chunk_overlap):
+    """
+    Normalize and tokenize a stream of paragraphs and group them in chunks of at most chunk_size tokens,
+    every chunk starting with the last chunk_overlap tokens of the previous one. The chunks are yielded
+    as soon as they are complete, so only the tokens of the current chunk are kept in memory.
+
+    A chunk ends after a paragraph chosen by the content of the paragraph: the paragraphs are cut at
+    the same places wherever they are in the document, so inserting or removing a paragraph only changes
+    the chunks around it, instead of shifting every later chunk. A chunk also ends before a paragraph
+    that does not fit in it, and a paragraph longer than chunk_size is split in windows of chunk_size
+    tokens that overlap chunk_overlap tokens.
+
+    Args:
+        texts (iterable): The paragraphs of the document.
+        encoding (tiktoken.Encoding): The encoding used to create the tokens.
+        chunk_size (int): The maximum number of tokens of each chunk.
+        chunk_overlap (int): The number of tokens shared by two consecutive chunks.
+
+    Yields:
+        tuple: The text of the chunk and its number of tokens.
+
+    Raises:
+        ValueError: If the overlap is not smaller than the chunk size.
+    """
+    if chunk_overlap >= chunk_size:
+        raise ValueError("The chunk overlap must be smaller than the chunk size")
+    step = chunk_size - chunk_overlap
+    # The chunks have about target tokens, and at least half of them unless the next paragraph does not fit
+    target = max(chunk_size // 2, 1)
+    separator = encoding.encode(" ")
+    # The tokens of the current chunk, the first start of them repeat the end of the previous chunk
+    window, start = [], 0
+    for text in texts:
+        paragraph = normalize_text(text)
+        if not paragraph:
+            continue
+        tokens = encoding.encode(paragraph)
+        if len(window) > start and len(window) + len(separator) + len(tokens) > chunk_size:
+            yield encoding.decode(window), len(window)
+            window = window[len(window) - chunk_overlap:]
+            start = len(window)
+        if window:
+            window.extend(separator)
+        window.extend(tokens)
+        while len(window) > chunk_size:
+            yield encoding.decode(window[:chunk_size]), chunk_size
+            del window[:step]
+            start = chunk_overlap
+        if len(window) - start >= target // 2 and _ends_chunk(paragraph, len(tokens), target):
+            yield encoding.decode(window), len(window)
+            window = window[len(window) - chunk_overlap:]
+            start = len(window)
+    if len(window) > start:
+        yield encoding.decode(window), len(window)
+
+# Close generators that may be suspended, in the thread that runs them
+def close_iterators(*iterators):
+    for iterator in iterators:
+        iterator.close()
+
+# Group the chunks in the fewest requests allowed by the limits of the embeddings API
+def batch_chunks(token_counts, max_inputs=EMBEDDING_MAX_INPUTS, max_tokens=EMBEDDING_MAX_TOKENS):
+    """
+    Group consecutive chunks in batches that respect the input and token limits of one request.
+
+    Args:
+        token_counts (list): The number of tokens of each chunk.
+        max_inputs (int, optional): The maximum number of inputs of one request.
+        max_tokens (int, optional): The maximum number of tokens of one request.
+
+    Returns:
+        list: A list of (start, end) slices over the chunks.
+    """
+    batches = []
+    start, tokens = 0, 0
+    for n, count in enumerate(token_counts):
+        if n > start and (n - start >= max_inputs or tokens + count > max_tokens):
+            batches.append((start, n))
+            start, tokens = n, 0
+        tokens += count
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+# Create the embeddings of several texts sending them in batches to the OpenAI API
+async def embed_texts(provider, texts, token_counts, max_concurrency=1, max_retries=5, cache=None):
+    """
+    Create the embeddings of a list of texts using as few requests as possible.
+
+    The batches are sent with at most max_concurrency requests in flight. When the provider answers
+    with a rate limit error the batch is retried with an exponential backoff. The texts found
+    in the cache are not sent to the provider.
+
+    Args:
+        provider: The embeddings provider, see lib.providers.
+        texts (list): The texts to embed.
+        token_counts (list): The number of tokens of each text, or None when the texts are short.
+        max_concurrency (int, optional): The maximum number of requests in flight. Defaults to 1.
+        max_retries (int, optional): The number of retries after a rate limit error. Defaults to 5.
+        cache (EmbeddingCache, optional): The cache of embeddings. Defaults to None.
+
+    Returns:
+        list: The embeddings in the same order as the texts.
+
+    Raises:
+        RateLimited: If a batch is still rate limited after all the retries.
+    """
+    model = provider.name
+    if token_counts is None:
+        token_counts = [0] * len(texts)
+    embeddings = await cache.get_many(model, texts) if cache is not None else [None] * len(texts)
+    missing = [n for n, embedding in enumerate(embeddings) if embedding is None]
+    missing_texts = [texts[n] for n in missing]
+    metrics.count_tokens("embedding", sum(token_counts[n] for n in missing))
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def embed_batch(start, end):
+        async with semaphore:
+            for attempt in range(max_retries + 1):
+                try:
+                    with metrics.span("embed"):
+                        return await provider.embed(missing_texts[start:end])
+                except RateLimited:
+                    if attempt == max_retries:
+                        raise
+                    await asyncio.sleep(2 ** attempt + random.random())
+
+    batches = await asyncio.gather(
+        *(
+            embed_batch(start, end)
+            for start, end in batch_chunks([token_counts[n] for n in missing], provider.max_inputs, provider.max_tokens)
+        )
+    )
+    created = [embedding for batch in batches for embedding in batch]
+    for n, embedding in zip(missing, created):
+        embeddings[n] = embedding
+    if cache is not None and created:
+        cache.put_many(model, missing_texts, created)
+    return embeddings
+
+# Cache of embeddings keyed by the hash of the model and the normalized text
+class EmbeddingCache:
+    """
+    Content-addressed cache of embeddings with an in-memory LRU tier and an optional SQLite tier.
+
+    The in-memory tier evicts the least recently used vectors when it exceeds max_entries or
+    max_bytes. The SQLite tier keeps every vector on disk, so the cache survives restarts and is
+    shared by the processes of the API. The file is read and written by a thread of the cache, so the
+    event loop never waits for the lock of the file: the texts missing in memory are read with a single
+    query, and the new vectors are written in the background, grouped in one transaction with the
+    vectors stored while the previous write was running.
+
+    Args:
+        max_entries (int, optional): The maximum number of vectors kept in memory. Defaults to 10000.
+        max_bytes (int, optional): The maximum memory used by the vectors kept in memory. Defaults to 64 MB.
+        path (str, optional): The path to the SQLite file of the persistent tier. Defaults to None (disabled).
+    """
+
+    # Maximum number of keys of one query, below the limit of variables of SQLite
+    READ_BATCH = 500
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        self.executor = None
+        # Rows waiting to be written by the thread of the cache
+        self.pending = []
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            # The processes of the API share the file, the readers do not wait for a writer
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self.db.commit()
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-cache")
+
+    @staticmethod
+    def key(model, text):
+        """
+        Build the key of a text embedded with a model.
+
+        Args:
+            model (str): The embedding model.
+            text (str): The normalized text.
+
+        Returns:
+            str: The SHA-256 hex digest of the model and the text.
+        """
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = vector
+        self.bytes += vector.itemsize * len(vector)
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.itemsize * len(evicted)
+
+    def _read(self, keys):
+        # Read the vectors of several keys from the SQLite tier, it runs in the thread of the cache
+        rows = {}
+        for start in range(0, len(keys), self.READ_BATCH):
+            batch = keys[start:start + self.READ_BATCH]
+            rows.update(self.db.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(batch))})", batch
+            ).fetchall())
+        return rows
+
+    def _write(self):
+        # Write the rows stored since the last write in a single transaction, it runs in the thread of the cache
+        with self.lock:
+            rows, self.pending = self.pending, []
+        if rows:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+
+    @staticmethod
+    def _check_write(future):
+        if not future.cancelled() and future.exception() is not None:
+            metrics.logger.error("The embeddings could not be written to the cache file", exc_info=future.exception())
+
+    async def get_many(self, model, texts):
+        """
+        Look up the embeddings of several texts, first in memory and then in the SQLite tier.
+
+        Args:
+            model (str): The embedding model.
+            texts (list): The normalized texts.
+
+        Returns:
+            list: The embedding of every text, or None when it is not cached.
+        """
+        keys = [self.key(model, text) for text in texts]
+        found, missing = [None] * len(keys), []
+        with self.lock:
+            for n, key in enumerate(keys):
+                vector = self.entries.get(key)
+                if vector is not None:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    found[n] = vector.tolist()
+                else:
+                    missing.append(n)
+        if missing and self.db is not None:
+            rows = await asyncio.get_running_loop().run_in_executor(self.executor, self._read, [keys[n] for n in missing])
+            with self.lock:
+                for n in missing:
+                    blob = rows.get(keys[n])
+                    if blob is not None:
+                        vector = array('f')
+                        vector.frombytes(blob)
+                        self._remember(keys[n], vector)
+                        self.disk_hits += 1
+                        found[n] = vector.tolist()
+        with self.lock:
+            self.misses += sum(vector is None for vector in found)
+        return found
+
+    def put_many(self, model, texts, embeddings):
+        """
+        Store the embeddings of several texts in memory, and queue them to be written to the SQLite tier.
+
+        Args:
+            model (str): The embedding model.
+            texts (list): The normalized texts.
+            embeddings (list): The embedding of every text.
+        """
+        with self.lock:
+            rows = []
+            for text, embedding in zip(texts, embeddings):
+                key = self.key(model, text)
+                vector = array('f', embedding)
+                self._remember(key, vector)
+                rows.append((key, vector.tobytes()))
+            if self.db is None or not rows:
+                return
+            # A write is already queued when there are pending rows, the new rows are written with them
+            schedule = not self.pending
+            self.pending.extend(rows)
+        if schedule:
+            self.executor.submit(self._write).add_done_callback(self._check_write)
+
+    @property
+    def stats(self):
+        """
+        dict: The hit and miss counters and the size of the in-memory tier.
+        """
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+        }
+
+    def close(self):
+        """
+        Write the pending embeddings and close the SQLite tier.
+        """
+        if self.db is not None:
+            self.executor.shutdown(wait=True)
+            self._write()
+            self.db.close()
+
+# Cache of answers looked up by the similarity between the new prompt and the prompts already answered
+class AnswerCache:
+    """
+    Semantic cache of LLM answers kept in an in-memory matrix of prompt embeddings.
+
+    A prompt whose cosine similarity with a cached prompt is at least threshold gets the cached
+    answer. The answers are also kept by the normalized text of their prompt, so the same prompt
+    is found without its embedding, which the keyword searches never create. The entries expire
+    after ttl seconds, the least recently used entry is evicted when the cache is full and the
+    entries built from a document are dropped when it is updated.
+
+    Args:
+        threshold (float, optional): The minimum similarity to reuse an answer. Defaults to 0.95.
+        ttl (float, optional): The seconds an answer is kept. Defaults to 3600.
+        max_entries (int, optional): The maximum number of answers kept by embedding, and by text. Defaults to 1000.
+    """
+
+    def __init__(self, threshold=0.95, ttl=3600, max_entries=1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.vectors = None
+        self.valid = np.zeros(max_entries, dtype=bool)
+        self.expires_at = np.zeros(max_entries, dtype=np.float64)
+        self.slots = [None] * max_entries
+        self.recent = OrderedDict()
+        # The answers by the normalized text of their prompt, least recently used first
+        self.texts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _drop(self, slot):
+        self.valid[slot] = False
+        self.slots[slot] = None
+        self.recent.pop(slot, None)
+
+    def get_text(self, text):
+        """
+        Look up the answer of the same normalized prompt, without its embedding.
+
+        Args:
+            text (str): The normalized prompt.
+
+        Returns:
+            str: The cached answer, or None when the prompt was not answered or its answer expired.
+        """
+        entry = self.texts.get(text)
+        if entry is not None and entry[2] <= time.monotonic():
+            del self.texts[text]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.texts.move_to_end(text)
+        self.hits += 1
+        return entry[0]
+
+    def get(self, embedding):
+        """
+        Look up the answer of the most similar cached prompt.
+
+        Args:
+            embedding (list): The embedding of the normalized prompt.
+
+        Returns:
+            str: The cached answer, or None when no cached prompt is similar enough.
+        """
+        # The expired answers are dropped first, so they never hide a valid answer that is less similar
+        for slot in np.flatnonzero(self.valid & (self.expires_at <= time.monotonic())):
+            self._drop(int(slot))
+        if self.vectors is None or not self.valid.any():
+            self.misses += 1
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = np.where(self.valid, self.vectors @ query, -np.inf)
+        slot = int(np.argmax(scores))
+        if scores[slot] >= self.threshold:
+            self.recent.move_to_end(slot)
+            self.hits += 1
+            return self.slots[slot][0]
+        self.misses += 1
+        return None
+
+    def put(self, embedding, answer, document_ids, text=None):
+        """
+        Store the answer of a prompt.
+
+        Args:
+            embedding (list): The embedding of the normalized prompt, None when it was not created.
+            answer (str): The answer of the LLM.
+            document_ids (set): The ids of the documents used to build the answer.
+            text (str, optional): The normalized prompt, to find the answer by its text. Defaults to None.
+        """
+        expires_at = time.monotonic() + self.ttl
+        if text is not None:
+            self.texts[text] = (answer, set(document_ids), expires_at)
+            self.texts.move_to_end(text)
+            while len(self.texts) > self.max_entries:
+                self.texts.popitem(last=False)
+        if embedding is None:
+            return
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        if self.vectors is None:
+            self.vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+        free = np.flatnonzero(~self.valid)
+        if len(free):
+            slot = int(free[0])
+        else:
+            slot, _ = self.recent.popitem(last=False)
+        self.vectors[slot] = vector
+        self.valid[slot] = True
+        self.expires_at[slot] = expires_at
+        self.slots[slot] = (answer, set(document_ids))
+        self.recent[slot] = None
+
+    def invalidate_document(self, document_id):
+        """
+        Drop the answers built from a document.
+
+        Args:
+            document_id (int): The ID of the updated document.
+        """
+        for slot, entry in enumerate(self.slots):
+            if entry is not None and document_id in entry[1]:
+                self._drop(slot)
+        for text in [text for text, entry in self.texts.items() if document_id in entry[1]]:
+            del self.texts[text]
+
+    @property
+    def stats(self):
+        """
+        dict: The hit and miss counters and the number of cached answers, by embedding and by text.
+        """
+        return {"hits": self.hits, "misses": self.misses, "entries": int(self.valid.sum()) + len(self.texts)}
 
 ## Methods to use QDRANT API, create a collection and index a document
 # Get all collections in Qdrant just to check if the collection already exists
-def get_all_collections(client_vdb):
+async def get_all_collections(client_vdb):
     """
     Get all collections in Qdrant.
 
     Args:
-        client_vdb (QdrantClient): The Qdrant client.
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
 
     Returns:
         list: A list of collection names.
@@ -77,113 +548,892 @@ def get_all_collections(client_vdb):
     """
     try:
         collections_list = []
-        collections = client_vdb.get_collections()
+        collections = await client_vdb.get_collections()
         for collection in collections:
             for c in list(collection[1]):
                 collections_list.append(c.name)
         return collections_list
-    except Exception as e:
-        print(f"Error fetching collections from Qdrant: {e}")
+    except Exception:
+        # The callers cannot tell a missing collection from an unreachable Qdrant, so the error is not swallowed
+        metrics.logger.error("The collections could not be fetched from Qdrant", exc_info=True)
+        raise
+
+# Create the collection when it does not exist yet, with the settings of the qdrant section of config.yaml
+async def ensure_collection(client_vdb, collection_name, size=1536, qdrant=None):
+    """
+    Create a collection in Qdrant if it does not exist. The payload indexes of an existing collection are added when they are missing.
+
+    Args:
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
+        collection_name (str): The name of the collection in Qdrant.
+        size (int, optional): The size of the embeddings. Defaults to 1536.
+        qdrant (dict, optional): The qdrant section of the configuration file, see lib.collection. Defaults to None (the default settings).
+
+    Returns:
+        bool: True if the collection was created, False if it already existed.
+    """
+    qdrant = qdrant or {}
+    if collection_name in await get_all_collections(client_vdb):
+        if not qdrant.get('local_path'):
+            await collection.ensure_payload_indexes(client_vdb, collection_name)
+        return False
+    # Create a collection with the given name, vector size, index, quantization and storage in Qdrant
+    await collection.create_collection(client_vdb, collection_name, qdrant, size)
+    return True
+
+# Get the last document id, the highest document id of the stored chunks and of the points of the first version
+async def get_last_document_id(client_vdb, collection_name):
+    """
+    Get the id of the last document stored in a collection.
+
+    The chunks are read ordered by the payload index of the document_id field, so the ids left unused by
+    failed uploads or removed documents are never given again. The documents stored by the first version
+    of the API, one point per document whose id is the document id, are also counted until they are split
+    in chunks by python lib/collection.py rechunk.
+
+    Args:
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
+        collection_name (str): The name of the collection in Qdrant.
+
+    Returns:
+        int: The highest document id in the collection, 0 when it is empty.
+    """
+    from qdrant_client.http.models import OrderBy, Direction
+
+    records, _ = await client_vdb.scroll(
+        collection_name=collection_name, limit=1, order_by=OrderBy(key="document_id", direction=Direction.DESC),
+        with_payload=["document_id"], with_vectors=False,
+    )
+    last_id = int(records[0].payload["document_id"]) if records else 0
+    offset = None
+    while True:
+        legacy, offset = await client_vdb.scroll(
+            collection_name=collection_name, scroll_filter=collection.legacy_filter(), limit=1024, offset=offset,
+            with_payload=False, with_vectors=False,
+        )
+        last_id = max([last_id, *(int(point.id) for point in legacy)])
+        if offset is None:
+            return last_id
 
-# Upload or update a document in the Qdrant vector database with the embeddings and text
-def upload_documents(collection_name, client_vdb, embeddings, text, id=0):
+# Allocator of document ids shared by the uploads, with the existence of the collection cached
+class DocumentIds:
     """
-    Upload or update a document in the Qdrant vector database.
+    Allocate the ids of the new documents from a counter stored in SQLite.
+
+    The counter is started from the highest document id found in Qdrant the first time it is used, and
+    then every allocation is a single SQLite transaction, so parallel uploads of this process or
+    of other processes using the same file never get the same id. The check of the collection
+    is also done once, instead of listing the collections on every upload.
 
     Args:
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
         collection_name (str): The name of the collection in Qdrant.
-        client_vdb (QdrantClient): The Qdrant client.
-        embeddings (list): The embeddings of the document.
-        text (str): The text of the document.
+        path (str, optional): The path to the SQLite file of the counter. Defaults to ":memory:".
+        size (int, optional): The size of the embeddings, used when the collection is created. Defaults to 1536.
+        qdrant (dict, optional): The qdrant section of the configuration file, used when the collection is created. Defaults to None.
+    """
+
+    def __init__(self, client_vdb, collection_name, path=":memory:", size=1536, qdrant=None):
+        self.client_vdb = client_vdb
+        self.collection_name = collection_name
+        self.size = size
+        self.qdrant = qdrant
+        self.collection_ready = False
+        self.synced = False
+        self.sync_lock = asyncio.Lock()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("CREATE TABLE IF NOT EXISTS document_ids (collection TEXT PRIMARY KEY, last_id INTEGER NOT NULL)")
+        # The file is shared with the other processes and a transaction waits for their writes, so a single thread
+        # runs the transactions instead of the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="document-ids")
+
+    async def _call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def ensure_collection(self):
+        """
+        Create the collection if it does not exist, checking Qdrant only the first time.
+
+        Returns:
+            bool: True if the collection was created by this call.
+        """
+        if self.collection_ready:
+            return False
+        async with self.sync_lock:
+            if self.collection_ready:
+                return False
+            created = await ensure_collection(self.client_vdb, self.collection_name, self.size, self.qdrant)
+            self.collection_ready = True
+            return created
+
+    def forget_collection(self):
+        """
+        Check again the collection on the next upload, for example after an error of Qdrant.
+        """
+        self.collection_ready = False
+
+    def _seed(self, stored):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO document_ids (collection, last_id) VALUES (?, ?) "
+                "ON CONFLICT (collection) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)",
+                (self.collection_name, stored),
+            )
+
+    def _last(self):
+        with self.lock:
+            return self.db.execute("SELECT last_id FROM document_ids WHERE collection = ?", (self.collection_name,)).fetchone()[0]
+
+    def _allocate(self, count):
+        with self.lock:
+            return self.db.execute(
+                "UPDATE document_ids SET last_id = last_id + ? WHERE collection = ? RETURNING last_id",
+                (count, self.collection_name),
+            ).fetchone()[0]
+
+    async def _sync(self):
+        # Start the counter from the highest id already stored, it never goes back
+        if self.synced:
+            return
+        async with self.sync_lock:
+            if self.synced:
+                return
+            stored = await get_last_document_id(self.client_vdb, self.collection_name) if self.collection_ready else 0
+            await self._call(self._seed, stored)
+            self.synced = True
+
+    async def last(self):
+        """
+        Get the last id allocated to a document.
+
+        Returns:
+            int: The last id, 0 when there are no documents.
+        """
+        await self.ensure_collection()
+        await self._sync()
+        return await self._call(self._last)
+
+    async def allocate(self, count=1):
+        """
+        Reserve the ids of new documents.
+
+        Args:
+            count (int, optional): The number of consecutive ids to reserve. Defaults to 1.
+
+        Returns:
+            int: The first id reserved.
+        """
+        await self.ensure_collection()
+        await self._sync()
+        return await self._call(self._allocate, count) - count + 1
+
+    def close(self):
+        """
+        Close the SQLite file of the counter.
+        """
+        self.executor.shutdown(wait=True)
+        self.db.close()
+
+# The id of the point of a chunk, derived from the document id, the fingerprint of the chunk and how many chunks of
+# the document have the same fingerprint before it
+def point_id(document_id, chunk_hash, occurrence=0):
+    return str(uuid.uuid5(CHUNK_NAMESPACE, f"{document_id}:{chunk_hash}:{occurrence}"))
+
+# Fingerprint of a chunk, the chunks with the same fingerprint have the same embedding
+def chunk_fingerprint(model, text):
+    """
+    Build the fingerprint of a chunk stored in the chunk_hash field of its payload.
+
+    Args:
+        model (str): The embedding model.
+        text (str): The text of the chunk.
+
+    Returns:
+        str: The key of the embedding of the chunk in the EmbeddingCache.
+    """
+    return EmbeddingCache.key(model, text)
+
+# Fingerprint of a document, the same file gives the same chunks and embeddings while the settings do not change
+def document_fingerprint(config, model, source_hash):
+    """
+    Build the fingerprint of a document stored in the document_hash field of its first chunk.
+
+    Args:
+        config (dict): A dictionary containing configuration settings.
+        model (str): The embedding model.
+        source_hash (str): The SHA-256 of the uploaded file.
+
+    Returns:
+        str: The SHA-256 hex digest of the file, the embedding model and the settings of the chunks.
+    """
+    settings = [
+        source_hash, model, config['openai']['tokenizer'], str(config['openai'].get('chunk_size', 500)),
+        str(config['openai'].get('chunk_overlap', 50)), str(FINGERPRINT_VERSION),
+    ]
+    return hashlib.sha256("\0".join(settings).encode("utf-8")).hexdigest()
+
+# Create one point per chunk, the id of the point is derived from the document id and the fingerprint of the chunk
+def create_points(document_id, embeddings, chunks, fingerprints, chunk_indexes=None, point_ids=None):
+    """
+    Create the Qdrant points of the chunks of a document.
+
+    Args:
+        document_id (int): The ID of the document.
+        embeddings (list): The embeddings of the chunks.
+        chunks (list): The text of the chunks.
+        fingerprints (list): The fingerprints of the chunks, see chunk_fingerprint.
+        chunk_indexes (list, optional): The index of every chunk in the document. Defaults to None (0, 1, 2...).
+        point_ids (list, optional): The id of every point. Defaults to None (derived from the fingerprints of the chunks).
+
+    Returns:
+        list: A list of PointStruct, one per chunk.
+    """
+    from qdrant_client.http.models import PointStruct
+
+    if chunk_indexes is None:
+        chunk_indexes = range(len(chunks))
+    if point_ids is None:
+        occurrences, point_ids = {}, []
+        for chunk_hash in fingerprints:
+            point_ids.append(point_id(document_id, chunk_hash, occurrences.get(chunk_hash, 0)))
+            occurrences[chunk_hash] = occurrences.get(chunk_hash, 0) + 1
+    return [
+        PointStruct(
+            id=point_ids[n], vector=embedding,
+            payload={"document_id": document_id, "chunk_index": chunk_index, "Document_text": chunk, "chunk_hash": fingerprints[n]},
+        )
+        for n, (chunk_index, embedding, chunk) in enumerate(zip(chunk_indexes, embeddings, chunks))
+    ]
+
+# Read the fingerprints stored in the points of a document
+async def stored_fingerprints(services, document_id):
+    """
+    Get the point and the index of every chunk of a stored document by its fingerprint.
+
+    Args:
+        services (Services): The clients, models and caches shared by the requests.
+        document_id (int): The ID of the document.
+
+    Returns:
+        dict: The point id and the chunk index of every tuple of fingerprint and occurrence, the number of chunks
+            with the same fingerprint before it in the document. The fingerprint is None for the chunks stored
+            before the fingerprints.
+    """
+    from qdrant_client.http.models import Filter, FieldCondition, MatchValue
+
+    chunks, offset = [], None
+    while True:
+        points, offset = await services.client_vdb.scroll(
+            collection_name=services.config['qdrant']['collection'],
+            scroll_filter=Filter(must=[FieldCondition(key="document_id", match=MatchValue(value=document_id))]),
+            limit=1024, offset=offset, with_payload=["chunk_index", "chunk_hash"], with_vectors=False,
+        )
+        chunks.extend((point.payload["chunk_index"], point.payload.get("chunk_hash"), str(point.id)) for point in points)
+        if offset is None:
+            break
+    fingerprints, occurrences = {}, {}
+    for chunk_index, chunk_hash, stored_id in sorted(chunks, key=lambda chunk: chunk[0]):
+        occurrence = occurrences.get(chunk_hash, 0)
+        occurrences[chunk_hash] = occurrence + 1
+        fingerprints[(chunk_hash, occurrence)] = (stored_id, chunk_index)
+    return fingerprints
+
+# Read the fingerprint of a stored document, it is only written when all its chunks are stored
+async def stored_document_fingerprint(services, document_id):
+    """
+    Get the fingerprint of a stored document.
+
+    Args:
+        services (Services): The clients, models and caches shared by the requests.
+        document_id (int): The ID of the document.
+
+    Returns:
+        tuple: The id of the point that keeps the fingerprint and the fingerprint, (None, None) if the document is not complete.
+    """
+    from qdrant_client.http.models import Filter, FieldCondition, MatchValue, IsEmptyCondition, PayloadField
+
+    records, _ = await services.client_vdb.scroll(
+        collection_name=services.config['qdrant']['collection'],
+        scroll_filter=Filter(
+            must=[FieldCondition(key="document_id", match=MatchValue(value=document_id))],
+            must_not=[IsEmptyCondition(is_empty=PayloadField(key="document_hash"))],
+        ),
+        limit=1, with_payload=["document_hash"], with_vectors=False,
+    )
+    return (str(records[0].id), records[0].payload["document_hash"]) if records else (None, None)
+
+# Mark a document as completely stored with its fingerprint, kept in the point of its first chunk
+async def store_document_fingerprint(services, first_point_id, fingerprint):
+    await services.client_vdb.set_payload(
+        collection_name=services.config['qdrant']['collection'], payload={"document_hash": fingerprint},
+        points=[first_point_id], wait=True,
+    )
+
+# Upload or update a document in the Qdrant vector database, embedding and storing its chunks in batches
+async def upload_documents(services, texts, id=0, document_id=None, progress=None, source_hash=None):
+    """
+    Upload or update a document in the Qdrant vector database, storing one point per chunk.
+
+    The chunks are produced from the stream of texts in a worker thread, and every batch of chunks is
+    embedded and upserted before the next one is read, so the document is never fully held in memory.
+
+    Every point keeps the fingerprint of its chunk, and the first point the fingerprint of the document
+    once all the chunks are stored. An update of a document with the same fingerprint is skipped without
+    reading the file. An update of a changed document matches the new chunks with the stored ones by their
+    fingerprint: only the new chunks are embedded and upserted, the chunks found at another position only
+    get their new chunk index, and the stored chunks that are not in the new version are removed, with the
+    single point of the document stored by the first version of the API.
+
+    Args:
+        services (Services): The clients, models and caches shared by the requests.
+        texts (iterable): The pieces of the document, for example the paragraphs streamed from the .docx file.
         id (int, optional): The ID of the document. Defaults to 0.
+        document_id (int, optional): The ID given to a new document. Defaults to None (a new ID is allocated).
+        progress (callable, optional): Coroutine function awaited with the stage ("extracting", "embedding" or
+            "upserting") and the number of chunks already stored. Defaults to None.
+        source_hash (str, optional): The SHA-256 of the uploaded file. Defaults to None (the document is always read).
 
     Returns:
-        str: A success message indicating the status of the document upload or update.
+        str: A success message indicating the status of the document upload or update, with the number of
+            chunks stored, unchanged, moved and removed by an update.
 
     Raises:
-        Exception: If there is an error during the document upload or update.
+        DocumentTooLarge: If the document is bigger than the configured limits.
+        InvalidDocument: If the document is not a valid .docx file or has no text.
+        Exception: The error of Qdrant or of the embeddings provider during the document upload or update.
     """
+    config = services.config
+    collection_name = config['qdrant']['collection']
     try:
-        if collection_name in get_all_collections(client_vdb):
-            # Get the information of the collection and the last id
-            if id == 0:
-                information = client_vdb.get_collection(collection_name=collection_name)
-                last_id = information.vectors_count
-                client_vdb.upsert(
-                    collection_name=collection_name,
-                    wait=True,
-                    points=[
-                        PointStruct(id=last_id+1, vector=embeddings, payload={"Document_text": text})
-                    ]
-                )
-                return "Document upload successful"
-            else: 
-                client_vdb.upsert(
-                    collection_name=collection_name,
-                    wait=True,
-                    points=[
-                        PointStruct(id=id, vector=embeddings, payload={"Document_text": text})
-                    ]
-                )
-                return "Document updated successful"
-        else:
-            # Create a collection with the given name and vector size in Qdrant
-            client_vdb.create_collection(
-                collection_name=collection_name,
-                vectors_config=VectorParams(size=1536, distance=Distance.COSINE),
-            )
-            # Index a document with the given id, embeddings, and text in the collection
-            client_vdb.upsert(
-                collection_name=collection_name,
-                wait=True,
-                points=[
-                    PointStruct(id=1, vector=embeddings, payload={"Document_text": text})
-                ]
+        created = await services.document_ids.ensure_collection()
+        # Allocate a new document id when the document is new
+        if id != 0:
+            document_id = id
+        elif document_id is None:
+            document_id = await services.document_ids.allocate()
+        model = services.embeddings.name
+        fingerprint = document_fingerprint(config, model, source_hash) if source_hash is not None else None
+
+        # Compare the document with the stored version, the update of an identical file is skipped
+        stored, legacy = {}, []
+        if id != 0:
+            with metrics.span("fingerprints"):
+                marker, stored_fingerprint = await stored_document_fingerprint(services, id)
+                if fingerprint is not None and stored_fingerprint == fingerprint:
+                    from qdrant_client.http.models import Filter, FieldCondition, MatchValue
+
+                    unchanged = (await services.client_vdb.count(
+                        collection_name=collection_name, exact=True,
+                        count_filter=Filter(must=[FieldCondition(key="document_id", match=MatchValue(value=id))]),
+                    )).count
+                    metrics.count_chunks("unchanged", unchanged)
+                    return f"Document unchanged, {unchanged} chunks skipped"
+                stored = await stored_fingerprints(services, id)
+                # The point of the document stored by the first version of the API, replaced by the chunks
+                legacy = await services.client_vdb.retrieve(collection_name=collection_name, ids=[id], with_payload=False, with_vectors=False)
+                # The document is not complete until the update ends
+                if marker is not None:
+                    await services.client_vdb.delete_payload(
+                        collection_name=collection_name, keys=["document_hash"], points=[marker], wait=True,
+                    )
+        texts = metrics.TimedIterator(texts)
+        chunks = chunk_stream(
+            texts, services.encoding, config['openai'].get('chunk_size', 500), config['openai'].get('chunk_overlap', 50)
+        )
+        batch_size = config['ingest'].get('upsert_batch_size', 256)
+        total = upserted = moved = 0
+        occurrences, first_point = {}, None
+        # The incremental XML parser keeps its state between the batches and must not move between threads, so
+        # the chunks of the document are read, and released, by a thread of their own
+        reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chunks")
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if progress is not None:
+                    await progress("extracting", total)
+                # The chunks are read from the parser, so the time spent parsing is taken from the time spent chunking
+                parsing = texts.seconds
+                start = time.perf_counter()
+                batch = await loop.run_in_executor(reader, lambda: list(islice(chunks, batch_size)))
+                metrics.record("parse", texts.seconds - parsing)
+                metrics.record("chunk", time.perf_counter() - start - (texts.seconds - parsing))
+                if not batch:
+                    break
+                # Match every chunk with a stored chunk with the same fingerprint, only the others are embedded and stored
+                fingerprints = [chunk_fingerprint(model, chunk) for chunk, _ in batch]
+                point_ids, changed, moves = [], [], []
+                for n, chunk_hash in enumerate(fingerprints):
+                    occurrence = occurrences.get(chunk_hash, 0)
+                    occurrences[chunk_hash] = occurrence + 1
+                    match = stored.pop((chunk_hash, occurrence), None)
+                    if match is None:
+                        point_ids.append(point_id(document_id, chunk_hash, occurrence))
+                        changed.append(n)
+                    else:
+                        point_ids.append(match[0])
+                        if match[1] != total + n:
+                            moves.append(n)
+                if first_point is None:
+                    first_point = point_ids[0]
+                if changed:
+                    batch_texts = [batch[n][0] for n in changed]
+                    if progress is not None:
+                        await progress("embedding", total)
+                    embeddings = await embed_texts(
+                        services.embeddings, batch_texts, [batch[n][1] for n in changed], cache=services.embedding_cache,
+                    )
+                    if progress is not None:
+                        await progress("upserting", total)
+                    points = create_points(
+                        document_id, embeddings, batch_texts, [fingerprints[n] for n in changed],
+                        chunk_indexes=[total + n for n in changed], point_ids=[point_ids[n] for n in changed],
+                    )
+                    with metrics.span("upsert"):
+                        await services.client_vdb.upsert(collection_name=collection_name, wait=True, points=points)
+                    if services.keyword_index is not None:
+                        services.keyword_index.add_points(points)
+                # The chunks found at another position keep their point and embedding, only their index changes
+                if moves:
+                    from qdrant_client.http.models import SetPayload, SetPayloadOperation
+
+                    with metrics.span("upsert"):
+                        await services.client_vdb.batch_update_points(
+                            collection_name=collection_name, wait=True,
+                            update_operations=[
+                                SetPayloadOperation(set_payload=SetPayload(payload={"chunk_index": total + n}, points=[point_ids[n]]))
+                                for n in moves
+                            ],
+                        )
+                    if services.keyword_index is not None:
+                        for n in moves:
+                            services.keyword_index.add(point_ids[n], document_id, total + n, batch[n][0])
+                upserted += len(changed)
+                moved += len(moves)
+                total += len(batch)
+        finally:
+            await loop.run_in_executor(reader, close_iterators, chunks, texts)
+            reader.shutdown(wait=False)
+        if total == 0:
+            raise InvalidDocument("The document is empty")
+        metrics.count_chunks("stored", upserted)
+        metrics.count_chunks("unchanged", total - upserted)
+        metrics.count_chunks("removed", len(stored) + len(legacy))
+
+        # Remove the stored chunks that are not in the new version of the document, and its point of the first version
+        if stored or legacy:
+            from qdrant_client.http.models import PointIdsList
+
+            removed = [stored_id for stored_id, _ in stored.values()]
+            await services.client_vdb.delete(
+                collection_name=collection_name, points_selector=PointIdsList(points=removed + [point.id for point in legacy]), wait=True,
             )
+            if services.keyword_index is not None and removed:
+                services.keyword_index.remove_points(removed)
+        if fingerprint is not None:
+            await store_document_fingerprint(services, first_point, fingerprint)
+        if created:
             return "Collection creation and document upload successful"
-    except Exception as e:
-        raise ValueError(f"Error during document upload or update: {e}")
+        if id == 0:
+            return "Document upload successful"
+        return (
+            f"Document updated successful, {upserted} chunks stored, {total - upserted - moved} unchanged, "
+            f"{moved} moved and {len(stored) + len(legacy)} removed"
+        )
+    except (DocumentTooLarge, InvalidDocument):
+        raise
+    except Exception:
+        # the collection may have been removed, check it again on the next upload
+        services.document_ids.forget_collection()
+        raise
 
 ## Methods to use OPENAI API, process text, and get an answer from a Language Model
-def get_answer_llm(config, client_vdb, client_ia, prompt):
+# Payload fields read from the retrieved chunks
+PASSAGE_FIELDS = ["document_id", "chunk_index", "Document_text"]
+
+# Re-rank the candidates with Maximal Marginal Relevance, so the context does not repeat the same content
+def mmr_rerank(scores, vectors, k, mmr_lambda=0.7):
     """
-    Provides an answer from a Language Model (LLM) based on the similarity between the prompt and documents.
+    Select k candidates balancing their similarity with the prompt and their similarity with the candidates already selected.
 
     Parameters:
-    - config (dict): A dictionary containing configuration settings.
-    - client_vdb: The client for interacting with a Vector Database.
-    - client_ia: The client for interacting with an Intelligent Assistant.
-    - prompt (str): The prompt to be used for generating the answer.
+    - scores (list): The cosine similarity of every candidate with the prompt.
+    - vectors (list): The embedding of every candidate.
+    - k (int): The number of candidates to select.
+    - mmr_lambda (float): The weight of the similarity with the prompt, 1 ignores the redundancy.
 
     Returns:
-    - response (str): The generated answer from the LLM.
+    - list: The indexes of the selected candidates, in the order they were selected.
+    """
+    relevance = np.asarray(scores, dtype=np.float32)
+    matrix = np.asarray(vectors, dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    similarity = matrix @ matrix.T
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    available = np.ones(len(relevance), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, len(relevance)):
+        marginal = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * redundancy, -np.inf)
+        best = int(np.argmax(marginal))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return selected
+
+# Read the payload of the chunks found by the keyword index
+async def fetch_keyword_passages(services, hits):
     """
-    # Create an instance of the ChatOpenAI class for the Language Model
-    llm = ChatOpenAI(temperature=0, openai_api_key=config['openai']['key'], model_name=config['openai']['llm_model'])
+    Get the chunks found by the keyword index from Qdrant, without their vectors.
 
-    # Normalize the prompt text
-    normalized_prompt = normalize_text(prompt)
+    Parameters:
+    - services (Services): The clients, models and caches shared by the requests.
+    - hits (list): Tuples of point id and BM25 score, best first.
 
-    # Create embeddings for the normalized prompt using the Intelligent Assistant client
-    embedding = client_ia.embeddings.create(input=normalized_prompt, model=config['openai']['model']).data[0].embedding
+    Returns:
+    - list: The chunks as ScoredPoint with the BM25 score, best first.
+    """
+    from qdrant_client.http.models import ScoredPoint
 
-    # Search for the best matching document in the Vector Database based on the prompt embedding
-    best_document = client_vdb.search(
-        collection_name=config['qdrant']['collection'], query_vector=embedding, limit=1
+    if not hits:
+        return []
+    records = await services.client_vdb.retrieve(
+        collection_name=services.config['qdrant']['collection'], ids=[point_id for point_id, _ in hits],
+        with_payload=PASSAGE_FIELDS, with_vectors=False,
     )
+    found = {str(record.id): record for record in records}
+    return [
+        ScoredPoint(id=point_id, version=0, score=score, payload=found[point_id].payload)
+        for point_id, score in hits if point_id in found
+    ]
+
+# Create the embedding of a normalized prompt, taken from the embedding cache when it was already created
+async def embed_prompt(services, normalized_prompt):
+    """
+    Create the embedding of a normalized prompt.
+
+    Parameters:
+    - services (Services): The clients, models and caches shared by the requests.
+    - normalized_prompt (str): The prompt normalized with normalize_text.
+
+    Returns:
+    - list: The embedding of the prompt.
+    """
+    return (await embed_texts(services.embeddings, [normalized_prompt], None, cache=services.embedding_cache))[0]
+
+# Look up the answer of a similar prompt before searching the chunks
+async def lookup_answer(services, normalized_prompt):
+    """
+    Create the embedding of a normalized prompt and look up the answer of a similar prompt in the answer cache,
+    so a cached answer skips the keyword and vector searches.
+
+    Parameters:
+    - services (Services): The clients, models and caches shared by the requests.
+    - normalized_prompt (str): The prompt normalized with normalize_text.
+
+    Returns:
+    - tuple: The embedding of the prompt and the cached answer, both None when the answer cache is disabled.
+    """
+    if services.answer_cache is None:
+        return None, None
+    embedding = await embed_prompt(services, normalized_prompt)
+    with metrics.span("answer_cache"):
+        return embedding, services.answer_cache.get(embedding)
+
+# Search the keyword index, the prompts that look like a lookup of codes or names are answered with it alone
+def search_keywords(services, normalized_prompt):
+    """
+    Search the chunks with the BM25 keyword index.
+
+    Parameters:
+    - services (Services): The clients, models and caches shared by the requests.
+    - normalized_prompt (str): The prompt normalized with normalize_text.
+
+    Returns:
+    - tuple: The hits, tuples of point id and BM25 score, best first, and True when the prompt looks lexical and
+      has hits, so it is answered without the vector search. No hits when the keyword index is disabled.
+    """
+    config = services.config
+    if services.keyword_index is None:
+        return [], False
+    with metrics.span("keyword_search"):
+        keyword_hits = services.keyword_index.search(
+            normalized_prompt, limit=config['llm'].get('top_k', 3), min_score=config['keyword'].get('min_score', 1.0)
+        )
+    return keyword_hits, bool(keyword_hits) and looks_lexical(normalized_prompt, config['keyword'].get('lexical_max_terms', 3))
+
+# Search the chunks that match the prompt, they are the context given to the Language Model
+async def retrieve_passages(services, normalized_prompt, embedding=None, keyword_hits=None):
+    """
+    Create the embedding of the normalized prompt, unless it is given, and search the best matching chunks.
 
-    ## If the best matching document has a score greater than or equal to the threshold, generate the answer
-    if best_document[0].score >= config['llm']['threshold']:
-        
-        # Get the text of the best matching document
-        text = best_document[0].payload['Document_text']
+    Qdrant only returns the chunks with a score above llm.threshold and only the payload fields used
+    to build the prompt. When llm.rerank_candidates is bigger than llm.top_k, that many candidates are
+    fetched with their vectors and the top_k are chosen with mmr_rerank.
 
-        # Fill the prompt template with the question and the content of the best matching document
-        prompt_template = PromptTemplate.from_template(config['llm']['prompt_template'])
-        filled_prompt = prompt_template.format(question=normalized_prompt, content=text)
+    When the keyword index is enabled, the BM25 ranking is fused with the vector ranking with Reciprocal
+    Rank Fusion. The score of a chunk is its cosine similarity, or its BM25 score when only the keyword
+    index found it. The lexical prompts are answered with the keyword hits alone, see answer_context.
+
+    Parameters:
+    - services (Services): The clients, models and caches shared by the requests.
+    - normalized_prompt (str): The prompt normalized with normalize_text.
+    - embedding (list, optional): The embedding of the prompt when it was already created. Defaults to None.
+    - keyword_hits (list, optional): The hits of search_keywords when it was already run. Defaults to None (the keyword index is searched).
+
+    Returns:
+    - tuple: The embedding of the prompt and the best chunks, best first.
+    """
+    config = services.config
+    top_k = config['llm'].get('top_k', 3)
+    candidates = max(config['llm'].get('rerank_candidates', 0), top_k)
+    if keyword_hits is None:
+        keyword_hits, _ = search_keywords(services, normalized_prompt)
+
+    # Create embeddings for the normalized prompt using the embeddings provider
+    if embedding is None:
+        embedding = await embed_prompt(services, normalized_prompt)
+
+    # Search the candidate chunks above the threshold, an empty collection is created instead of failing
+    await services.document_ids.ensure_collection()
+    with metrics.span("vector_search"):
+        passages = await services.client_vdb.search(
+            collection_name=config['qdrant']['collection'],
+            query_vector=embedding,
+            limit=candidates,
+            score_threshold=config['llm']['threshold'],
+            search_params=services.search_params,
+            with_payload=PASSAGE_FIELDS,
+            with_vectors=candidates > top_k,
+        )
+
+    ## Keep the top k chunks, re-ranked to avoid redundant passages when there are more candidates
+    if len(passages) > top_k:
+        with metrics.span("rerank"):
+            order = mmr_rerank([chunk.score for chunk in passages], [chunk.vector for chunk in passages], top_k,
+                               config['llm'].get('mmr_lambda', 0.7))
+        passages = [passages[n] for n in order]
+
+    ## Fuse the vector and keyword rankings
+    if keyword_hits:
+        by_id = {str(chunk.id): chunk for chunk in passages}
+        missing = [(point_id, score) for point_id, score in keyword_hits if point_id not in by_id]
+        with metrics.span("keyword_fetch"):
+            by_id.update((str(chunk.id), chunk) for chunk in await fetch_keyword_passages(services, missing))
+        fused = reciprocal_rank_fusion(
+            [[str(chunk.id) for chunk in passages], [point_id for point_id, _ in keyword_hits]],
+            k=config['keyword'].get('rrf_k', 60),
+        )
+        passages = [by_id[point_id] for point_id, _ in fused if point_id in by_id][:top_k]
+    return embedding, passages
+
+# Find the cached answer of a prompt, or the chunks to answer it with
+async def answer_context(services, normalized_prompt):
+    """
+    Look up the answer of a prompt in the answer cache and, when it is not cached, search its chunks.
+
+    A prompt that looks like a lookup of codes or names and is found by the keyword index is looked up
+    in the answer cache by its text and answered with the keyword hits alone, so it never creates an
+    embedding. The other prompts are embedded and looked up by similarity before the vector search.
+
+    Parameters:
+    - services (Services): The clients, models and caches shared by the requests.
+    - normalized_prompt (str): The prompt normalized with normalize_text.
+
+    Returns:
+    - tuple: The embedding of the prompt (None for a keyword search), the cached answer (None when it is not
+      cached) and the best chunks, best first (None when the answer is cached).
+    """
+    keyword_hits, lexical = search_keywords(services, normalized_prompt)
+    if lexical:
+        if services.answer_cache is not None:
+            with metrics.span("answer_cache"):
+                cached_answer = services.answer_cache.get_text(normalized_prompt)
+            if cached_answer is not None:
+                return None, cached_answer, None
+        with metrics.span("keyword_fetch"):
+            passages = await fetch_keyword_passages(services, keyword_hits)
+        if passages:
+            return None, None, passages
+    # Reuse the answer of a similar prompt without searching the chunks nor calling the Language Model
+    embedding, cached_answer = await lookup_answer(services, normalized_prompt)
+    if cached_answer is not None:
+        return embedding, cached_answer, None
+    embedding, passages = await retrieve_passages(services, normalized_prompt, embedding, keyword_hits)
+    return embedding, None, passages
+
+# Store the answer of a prompt, by its embedding or, for a keyword search, by its text
+def cache_answer(services, normalized_prompt, embedding, answer, passages):
+    if services.answer_cache is not None:
+        services.answer_cache.put(
+            embedding, answer, {chunk.payload.get('document_id') for chunk in passages},
+            text=normalized_prompt if embedding is None else None,
+        )
+
+# Pack the text of the best chunks in the context of the prompt without exceeding a number of tokens
+def build_context(encoding, passages, max_tokens):
+    """
+    Join the text of the chunks, best first, skipping the chunks that do not fit in the token budget.
+
+    Parameters:
+    - encoding (tiktoken.Encoding): The tokenizer of the Language Model.
+    - passages (list): The best matching chunks, best first.
+    - max_tokens (int): The maximum number of tokens of the context.
+
+    Returns:
+    - str: The text of the chunks that fit, separated by blank lines. The best chunk is cut to the budget when it does not fit alone.
+    """
+    separator = len(encoding.encode("\n\n"))
+    texts, used = [], 0
+    for chunk in passages:
+        tokens = encoding.encode(chunk.payload['Document_text'])
+        cost = len(tokens) + (separator if texts else 0)
+        if used + cost <= max_tokens:
+            texts.append(chunk.payload['Document_text'])
+            used += cost
+        elif not texts:
+            texts.append(encoding.decode(tokens[:max_tokens]))
+            used = max_tokens
+    metrics.count_tokens("context", used)
+    return "\n\n".join(texts)
+
+# Fill the prompt template with the question and the content of the best matching chunks
+def build_prompt(services, normalized_prompt, passages):
+    """
+    Fill the prompt template with the question and the text of the chunks that fit in llm.context_tokens.
+
+    Parameters:
+    - services (Services): The clients, models and caches shared by the requests.
+    - normalized_prompt (str): The normalized prompt.
+    - passages (list): The best matching chunks.
+
+    Returns:
+    - str: The prompt sent to the Language Model.
+    """
+    with metrics.span("build_prompt"):
+        text = build_context(services.encoding, passages, services.config['llm'].get('context_tokens', 2000))
+        return services.prompt_template.format(question=normalized_prompt, content=text)
+
+# Answer a normalized prompt with the chunks that match it
+async def answer_prompt(services, normalized_prompt):
+    """
+    Generate the answer of a normalized prompt with the best matching chunks, or take it from the answer cache.
+
+    Parameters:
+    - services (Services): The clients, models and caches shared by the requests.
+    - normalized_prompt (str): The prompt normalized with normalize_text.
+
+    Returns:
+    - response (str): The generated answer from the LLM.
+    """
+    embedding, cached_answer, passages = await answer_context(services, normalized_prompt)
+    if cached_answer is not None:
+        return cached_answer
+
+    ## If there are chunks above the threshold, generate the answer with them
+    if passages:
+        filled_prompt = build_prompt(services, normalized_prompt, passages)
 
         # Generate the answer from the Language Model using the filled prompt
-        response = llm.call_as_llm(filled_prompt)
+        with metrics.span("llm"):
+            response = await services.chat.complete(filled_prompt)
+        cache_answer(services, normalized_prompt, embedding, response, passages)
         return response
     else:
-        return "I don´t have data that matching with a document according with your search."
\ No newline at end of file
+        return NO_MATCH_ANSWER
+
+async def get_answer_llm(services, prompt):
+    """
+    Provides an answer from a Language Model (LLM) based on the similarity between the prompt and the chunks of the documents.
+
+    Concurrent searches with the same normalized prompt share a single answer, see services.search_flights.
+
+    Parameters:
+    - services (Services): The clients, models and caches shared by the requests.
+    - prompt (str): The prompt to be used for generating the answer.
+
+    Returns:
+    - response (str): The generated answer from the LLM.
+
+    Raises:
+    - TimeoutError: If the shared answer takes longer than llm.coalesce_timeout_seconds.
+    """
+    # Normalize the prompt text, the searches that only differ in the normalized characters share their answer
+    with metrics.span("normalize"):
+        normalized_prompt = normalize_text(prompt)
+    if services.search_flights is None:
+        return await answer_prompt(services, normalized_prompt)
+    return await services.search_flights.run(("answer", normalized_prompt), lambda: answer_prompt(services, normalized_prompt))
+
+# Stream the answer of a normalized prompt as it is generated
+async def stream_prompt(services, normalized_prompt):
+    """
+    Stream the answer of a normalized prompt, token by token.
+
+    Parameters:
+    - services (Services): The clients, models and caches shared by the requests.
+    - normalized_prompt (str): The prompt normalized with normalize_text.
+
+    Yields:
+    - tuple: The name of the event and its data.
+    """
+    # A cached answer is sent without searching the chunks, so its metadata has no documents
+    embedding, cached_answer, passages = await answer_context(services, normalized_prompt)
+    if cached_answer is not None:
+        yield "metadata", {"cached": True, "documents": []}
+        yield "token", cached_answer
+        yield "done", {}
+        return
+    yield "metadata", {
+        "cached": False,
+        "documents": [
+            {"document_id": chunk.payload.get('document_id'), "chunk_index": chunk.payload.get('chunk_index'), "score": chunk.score}
+            for chunk in passages
+        ],
+    }
+
+    if passages:
+        answer = []
+        filled_prompt = build_prompt(services, normalized_prompt, passages)
+        # The time to the first piece of the answer, and the time of the whole answer without the waits of the client
+        start, generating = time.perf_counter(), 0.0
+        async for piece in services.chat.stream(filled_prompt):
+            if not answer:
+                metrics.record("llm_first_token", time.perf_counter() - start)
+            generating += time.perf_counter() - start
+            answer.append(piece)
+            yield "token", piece
+            start = time.perf_counter()
+        metrics.record("llm", generating + time.perf_counter() - start)
+        cache_answer(services, normalized_prompt, embedding, "".join(answer), passages)
+    else:
+        yield "token", NO_MATCH_ANSWER
+    yield "done", {}
+
+# Stream the answer of the Language Model as it is generated
+async def stream_answer_llm(services, prompt):
+    """
+    Stream an answer from a Language Model (LLM), token by token.
+
+    The first event has the metadata of the retrieved chunks, then one event is sent per token
+    and the last event marks the end of the answer. Concurrent streams with the same normalized
+    prompt share the events of a single answer, a stream that joins late first gets the events
+    already sent.
+
+    Parameters:
+    - services (Services): The clients, models and caches shared by the requests.
+    - prompt (str): The prompt to be used for generating the answer.
+
+    Yields:
+    - tuple: The name of the event and its data.
+    """
+    with metrics.span("normalize"):
+        normalized_prompt = normalize_text(prompt)
+    if services.search_flights is None:
+        events = stream_prompt(services, normalized_prompt)
+    else:
+        events = services.search_flights.stream(("stream", normalized_prompt), lambda: stream_prompt(services, normalized_prompt))
+    # Close the shared stream as soon as this one is closed, so an abandoned answer is cancelled
+    async with aclosing(events):
+        async for event in events:
+            yield event
\ No newline at end of file
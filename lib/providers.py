@@ -0,0 +1,414 @@
+import re
+import queue
+import asyncio
+import hashlib
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+## Providers of embeddings and chat completions. The endpoints only use the interface of the providers, so the
+## remote OpenAI models, a local model running on the CPU or a deterministic fake can be selected in config.yaml.
+## An embeddings provider has a name, a dimension, the limits of one request and an async embed method; a chat
+## provider has an async complete method and an async stream method that yields the answer piece by piece.
+
+# Limits of a single request to the OpenAI embeddings API
+EMBEDDING_MAX_INPUTS = 2048
+EMBEDDING_MAX_TOKENS = 300000
+
+# Seconds the stream of a local answer waits for the next piece before checking that the generation did not fail
+LOCAL_STREAM_POLL_SECONDS = 1.0
+
+# Raised by a provider when the remote API rejects a request because of its rate limit
+class RateLimited(Exception):
+    pass
+
+# Embeddings created by the OpenAI API
+class OpenAIEmbeddings:
+    """
+    Embeddings created by the OpenAI embeddings API.
+
+    Args:
+        client (AsyncOpenAI): The async OpenAI client.
+        model (str): The embedding model.
+        dimension (int, optional): The size of the embeddings of the model. Defaults to 1536.
+    """
+
+    max_inputs = EMBEDDING_MAX_INPUTS
+    max_tokens = EMBEDDING_MAX_TOKENS
+
+    def __init__(self, client, model, dimension=1536):
+        self.client = client
+        self.name = model
+        self.dimension = dimension
+
+    async def embed(self, texts):
+        """
+        Create the embeddings of a batch of texts with a single request.
+
+        Args:
+            texts (list): The texts to embed.
+
+        Returns:
+            list: The embeddings in the same order as the texts.
+
+        Raises:
+            RateLimited: If the API answers with a rate limit error.
+        """
+        from openai import RateLimitError
+
+        try:
+            response = await self.client.embeddings.create(input=texts, model=self.name)
+        except RateLimitError as e:
+            raise RateLimited(str(e)) from e
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    async def close(self):
+        await self.client.close()
+
+# Answers generated by an OpenAI chat model through LangChain
+class OpenAIChat:
+    """
+    Answers generated by an OpenAI chat model.
+
+    Args:
+        llm (ChatOpenAI): The LangChain chat model.
+    """
+
+    def __init__(self, llm):
+        self.llm = llm
+
+    async def complete(self, prompt):
+        """
+        Generate the whole answer of a prompt.
+
+        Args:
+            prompt (str): The prompt.
+
+        Returns:
+            str: The answer.
+        """
+        return (await self.llm.ainvoke(prompt)).content
+
+    async def stream(self, prompt):
+        """
+        Generate the answer of a prompt piece by piece.
+
+        Args:
+            prompt (str): The prompt.
+
+        Yields:
+            str: The pieces of the answer.
+        """
+        async for chunk in self.llm.astream(prompt):
+            yield chunk.content
+
+    async def close(self):
+        pass
+
+# Embeddings created on the CPU by a local sentence-transformers model
+class LocalEmbeddings:
+    """
+    Embeddings created by a sentence-transformers model running on the CPU.
+
+    The model is loaded the first time it is used. The batches are encoded one at a time in a
+    dedicated thread, so the inference does not block the event loop and the CPU is not
+    oversubscribed by concurrent requests.
+
+    Args:
+        model (str): The name or path of the sentence-transformers model.
+        batch_size (int, optional): The number of texts encoded at once. Defaults to 32.
+    """
+
+    max_tokens = float("inf")
+
+    def __init__(self, model, batch_size=32):
+        self.name = model
+        self.batch_size = batch_size
+        self.max_inputs = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.model = None
+
+    def _load(self):
+        with self.lock:
+            if self.model is None:
+                from sentence_transformers import SentenceTransformer
+
+                self.model = SentenceTransformer(self.name, device="cpu")
+        return self.model
+
+    @property
+    def dimension(self):
+        """
+        int: The size of the embeddings of the model.
+        """
+        return self._load().get_sentence_embedding_dimension()
+
+    def _encode(self, texts):
+        vectors = self._load().encode(texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True)
+        return vectors.astype(np.float32).tolist()
+
+    async def embed(self, texts):
+        """
+        Create the embeddings of a batch of texts.
+
+        Args:
+            texts (list): The texts to embed.
+
+        Returns:
+            list: The embeddings in the same order as the texts.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._encode, texts)
+
+    async def close(self):
+        self.executor.shutdown()
+
+# Answers generated on the CPU by a local transformers chat model
+class LocalChat:
+    """
+    Answers generated by a small transformers causal language model running on the CPU.
+
+    The model is loaded the first time it is used and the generation runs in a dedicated thread,
+    one answer at a time.
+
+    Args:
+        model (str): The name or path of the transformers model.
+        max_new_tokens (int, optional): The maximum number of tokens of an answer. Defaults to 256.
+    """
+
+    def __init__(self, model, max_new_tokens=256):
+        self.name = model
+        self.max_new_tokens = max_new_tokens
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.model = None
+        self.tokenizer = None
+
+    def _load(self):
+        with self.lock:
+            if self.model is None:
+                from transformers import AutoModelForCausalLM, AutoTokenizer
+
+                self.tokenizer = AutoTokenizer.from_pretrained(self.name)
+                self.model = AutoModelForCausalLM.from_pretrained(self.name)
+        return self.model, self.tokenizer
+
+    def _generate(self, prompt, streamer=None):
+        model, tokenizer = self._load()
+        inputs = tokenizer(prompt, return_tensors="pt")
+        output = model.generate(**inputs, max_new_tokens=self.max_new_tokens, do_sample=False, streamer=streamer)
+        return tokenizer.decode(output[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+
+    async def complete(self, prompt):
+        """
+        Generate the whole answer of a prompt.
+
+        Args:
+            prompt (str): The prompt.
+
+        Returns:
+            str: The answer.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._generate, prompt)
+
+    async def stream(self, prompt):
+        """
+        Generate the answer of a prompt piece by piece.
+
+        Args:
+            prompt (str): The prompt.
+
+        Yields:
+            str: The pieces of the answer.
+
+        Raises:
+            Exception: The error of the generation, which never ends the stream of pieces by itself.
+        """
+        from transformers import TextIteratorStreamer
+
+        loop = asyncio.get_running_loop()
+        _, tokenizer = await loop.run_in_executor(self.executor, self._load)
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=LOCAL_STREAM_POLL_SECONDS)
+        generation = loop.run_in_executor(self.executor, self._generate, prompt, streamer)
+        # A stream closed early leaves the generation running in its thread, its error is not reported as never retrieved
+        generation.add_done_callback(lambda future: future.cancelled() or future.exception())
+        pieces = iter(streamer)
+        while True:
+            try:
+                piece = await asyncio.to_thread(next, pieces, None)
+            except queue.Empty:
+                # No piece yet, the answer is still generated unless the generation failed
+                if generation.done():
+                    generation.result()
+                    break
+                continue
+            if piece is None:
+                break
+            if piece:
+                yield piece
+        await generation
+
+    async def close(self):
+        self.executor.shutdown()
+
+# Deterministic embeddings built from the words of the text, for tests and load tests without network access
+class FakeEmbeddings:
+    """
+    Deterministic embeddings built with the hashing trick: every word adds +1 or -1 to a dimension
+    chosen by its hash. Texts that share words get similar embeddings, and the same text always
+    gets the same embedding.
+
+    Args:
+        dimension (int, optional): The size of the embeddings. Defaults to 1536.
+        latency (float, optional): The seconds every request waits, to simulate a remote API. Defaults to 0.
+    """
+
+    max_inputs = 2048
+    max_tokens = float("inf")
+
+    def __init__(self, dimension=1536, latency=0.0):
+        self.name = f"fake-{dimension}"
+        self.dimension = dimension
+        self.latency = latency
+        self.calls = 0
+
+    def _vector(self, text):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()) or [text]:
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            vector[value % self.dimension] += 1.0 if value >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    async def embed(self, texts):
+        """
+        Create the embeddings of a batch of texts.
+
+        Args:
+            texts (list): The texts to embed.
+
+        Returns:
+            list: The embeddings in the same order as the texts.
+        """
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    async def close(self):
+        pass
+
+# Deterministic answers, for tests and load tests without network access
+class FakeChat:
+    """
+    Deterministic answers that repeat the beginning of the prompt.
+
+    Args:
+        latency (float, optional): The seconds an answer waits, to simulate a remote API. Defaults to 0.
+        answer_words (int, optional): The number of words of the prompt repeated in the answer. Defaults to 20.
+    """
+
+    def __init__(self, latency=0.0, answer_words=20):
+        self.latency = latency
+        self.answer_words = answer_words
+        self.calls = 0
+
+    def _answer(self, prompt):
+        return "Fake answer: " + " ".join(prompt.split()[:self.answer_words])
+
+    async def complete(self, prompt):
+        """
+        Generate the whole answer of a prompt.
+
+        Args:
+            prompt (str): The prompt.
+
+        Returns:
+            str: The answer.
+        """
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._answer(prompt)
+
+    async def stream(self, prompt):
+        """
+        Generate the answer of a prompt word by word.
+
+        Args:
+            prompt (str): The prompt.
+
+        Yields:
+            str: The words of the answer.
+        """
+        self.calls += 1
+        words = self._answer(prompt).split(" ")
+        for n, word in enumerate(words):
+            if self.latency:
+                await asyncio.sleep(self.latency / len(words))
+            yield word if n == 0 else " " + word
+
+    async def close(self):
+        pass
+
+# Create the embeddings provider selected in the configuration file
+def create_embeddings(config, http_client=None):
+    """
+    Create the embeddings provider of the providers section of the configuration file.
+
+    Args:
+        config (dict): A dictionary containing configuration settings.
+        http_client (httpx.AsyncClient, optional): The pool of HTTP connections of the remote providers. Defaults to None.
+
+    Returns:
+        The embeddings provider: OpenAIEmbeddings, LocalEmbeddings or FakeEmbeddings.
+
+    Raises:
+        ValueError: If the provider is unknown.
+    """
+    providers = config.get('providers', {})
+    name = providers.get('embeddings', 'openai')
+    if name == 'openai':
+        from openai import AsyncOpenAI
+
+        # Initialize OpenAI client with your API key according to the configuration file
+        client = AsyncOpenAI(api_key=config['openai']['key'], http_client=http_client)
+        return OpenAIEmbeddings(client, config['openai']['model'], dimension=config['qdrant'].get('size_embeddings', 1536))
+    if name == 'local':
+        return LocalEmbeddings(providers['local_embedding_model'], batch_size=providers.get('local_batch_size', 32))
+    if name == 'fake':
+        return FakeEmbeddings(
+            dimension=config['qdrant'].get('size_embeddings', 1536), latency=providers.get('fake_latency_ms', 0) / 1000,
+        )
+    raise ValueError(f"Unknown embeddings provider: {name}")
+
+# Create the chat provider selected in the configuration file
+def create_chat(config, http_client=None):
+    """
+    Create the chat provider of the providers section of the configuration file.
+
+    Args:
+        config (dict): A dictionary containing configuration settings.
+        http_client (httpx.AsyncClient, optional): The pool of HTTP connections of the remote providers. Defaults to None.
+
+    Returns:
+        The chat provider: OpenAIChat, LocalChat or FakeChat.
+
+    Raises:
+        ValueError: If the provider is unknown.
+    """
+    providers = config.get('providers', {})
+    name = providers.get('chat', 'openai')
+    if name == 'openai':
+        from langchain_openai import ChatOpenAI
+
+        return OpenAIChat(ChatOpenAI(
+            temperature=0, openai_api_key=config['openai']['key'], model_name=config['openai']['llm_model'],
+            http_async_client=http_client,
+        ))
+    if name == 'local':
+        return LocalChat(providers['local_chat_model'], max_new_tokens=providers.get('local_max_new_tokens', 256))
+    if name == 'fake':
+        return FakeChat(latency=providers.get('fake_latency_ms', 0) / 1000)
+    raise ValueError(f"Unknown chat provider: {name}")
@@ -0,0 +1,144 @@
+import sys
+from pathlib import Path
+# Add the project directory to the PYTHONPATH
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import os
+import signal
+import asyncio
+import argparse
+import threading
+import multiprocessing
+from lib.settings import get_settings
+import lib.metrics as metrics
+
+## Production serving of the API in several processes. The bcrypt verifications, the parsing of the uploads, the
+## tokenizer and the serialization of the answers use the CPU, so with a single process they compete on one
+## interpreter. The launcher starts api.workers HTTP workers that share the port, and one ingestion process that
+## runs the jobs of the queue, restarted if it dies. The processes share the job queue, the document ids, the
+## embedding cache, the rate limits and the keyword index through their files in ./data.
+# Usage (from the main directory): python lib/serve.py --host 0.0.0.0 --port 8000 --config config.yaml
+
+# Directory of main.py
+APP_DIR = str(Path(__file__).resolve().parent.parent)
+
+# Seconds before the ingestion process is started again after it died
+RESTART_DELAY = 5
+
+# Run the jobs of the queue until the process is stopped
+async def run_ingest(config):
+    """
+    Start the services of the ingestion process and keep them until SIGTERM or SIGINT.
+
+    Args:
+        config (dict): A dictionary containing configuration settings.
+    """
+    from lib.services import Services
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    services = await Services.warm_up(config, role="ingest")
+    metrics.logger.info("The ingestion process %s is running %s job workers", os.getpid(), services.job_queue.workers)
+    try:
+        await stop.wait()
+    finally:
+        await services.close()
+
+# Entry point of the ingestion process
+def ingest_main(config_path):
+    settings = get_settings(config_path)
+    metrics.configure_logging(settings.config['api'].get('log_level', 'INFO'))
+    asyncio.run(run_ingest(settings.config))
+
+# Start the ingestion process and start it again when it dies
+class IngestSupervisor(threading.Thread):
+    """
+    Thread that keeps an ingestion process running.
+
+    Args:
+        config_path (str): The path to the configuration file.
+    """
+
+    def __init__(self, config_path):
+        super().__init__(name="ingest-supervisor", daemon=True)
+        self.config_path = config_path
+        self.context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.process = self.context.Process(target=ingest_main, args=(self.config_path,), name="ingest")
+            self.process.start()
+            self.process.join()
+            if self.stopping.is_set():
+                break
+            metrics.logger.warning(
+                "The ingestion process exited with code %s, starting it again in %s seconds", self.process.exitcode, RESTART_DELAY
+            )
+            if self.stopping.wait(RESTART_DELAY):
+                break
+
+    def stop(self, timeout=30):
+        """
+        Stop the ingestion process, the running jobs are processed again on the next start.
+
+        Args:
+            timeout (float, optional): The seconds given to the process to stop before it is killed. Defaults to 30.
+        """
+        self.stopping.set()
+        process = self.process
+        if process is not None and process.is_alive():
+            process.terminate()
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+        self.join(timeout)
+
+# Serve the API with the workers of the configuration file
+def serve(config_path, host, port, workers=None):
+    """
+    Serve the API, in a single process or in HTTP workers and an ingestion process.
+
+    Args:
+        config_path (str): The path to the configuration file.
+        host (str): The address the API listens on.
+        port (int): The port the API listens on.
+        workers (int, optional): The number of HTTP workers. Defaults to None (api.workers of the configuration file).
+
+    Raises:
+        ValueError: If several workers are requested with the embedded Qdrant.
+    """
+    import uvicorn
+
+    config_path = os.path.abspath(config_path)
+    config = get_settings(config_path).config
+    workers = workers or config['api'].get('workers', 1)
+    # The workers are new processes that read the same configuration file
+    os.environ["CONFIG_PATH"] = config_path
+    log_level = config['api'].get('log_level', 'INFO').lower()
+    if workers <= 1:
+        os.environ["API_ROLE"] = "all"
+        uvicorn.run("main:app", host=host, port=port, log_level=log_level, app_dir=APP_DIR)
+        return
+    if config['qdrant'].get('local_path'):
+        raise ValueError("The embedded Qdrant of qdrant.local_path is opened by a single process, set api.workers to 1 or use a Qdrant server")
+    os.environ["API_ROLE"] = "api"
+    metrics.configure_logging(config['api'].get('log_level', 'INFO'))
+    supervisor = IngestSupervisor(config_path)
+    supervisor.start()
+    try:
+        uvicorn.run("main:app", host=host, port=port, workers=workers, log_level=log_level, app_dir=APP_DIR)
+    finally:
+        supervisor.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the API in several processes with the settings of config.yaml.")
+    parser.add_argument("--host", default="0.0.0.0", help="The address the API listens on.")
+    parser.add_argument("--port", type=int, default=8000, help="The port the API listens on.")
+    parser.add_argument("--workers", type=int, help="The number of HTTP workers, api.workers of config.yaml by default.")
+    parser.add_argument("--config", default=os.environ.get("CONFIG_PATH", "./config.yaml"), help="The path to the config.yaml file.")
+    args = parser.parse_args()
+    serve(args.config, args.host, args.port, args.workers)
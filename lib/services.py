@@ -0,0 +1,247 @@
+import time
+import asyncio
+from fastapi import Request
+import lib.processing_docs as processing_docs
+import lib.jobs as jobs
+import lib.metrics as metrics
+import lib.providers as providers
+import lib.collection as collection
+from lib.keyword_index import KeywordIndex
+from lib.single_flight import SingleFlight
+from lib.limits import RateLimiter, ConcurrencyPool
+
+## Long-lived resources shared by all the requests. They are created once when the app starts,
+## so the handlers do not rebuild clients, tokenizers or prompt templates on every call. The clients and models
+## are imported when the services are created, so importing the app stays fast and the work is done by the warm-up.
+## When the API runs in several processes (see lib/serve.py) every process has its own services: the HTTP workers
+## (role api) answer the requests and queue the uploads, and a single ingestion process (role ingest) runs the jobs.
+
+# Roles of a process: everything in one process, the HTTP worker of several, or the process that runs the jobs
+ROLES = ("all", "api", "ingest")
+
+class Services:
+    """
+    Context with the clients, models and caches used by the endpoints.
+
+    Args:
+        config (dict): A dictionary containing configuration settings.
+        client_vdb (AsyncQdrantClient): The async Qdrant client.
+        embeddings: The embeddings provider, see lib.providers.
+        chat: The chat provider of the Language Model used to answer the searches, see lib.providers.
+        encoding (tiktoken.Encoding): The tokenizer used to split the documents in chunks.
+        prompt_template (PromptTemplate): The template filled with the question and the retrieved chunks.
+        embedding_cache (processing_docs.EmbeddingCache): The cache of embeddings.
+        answer_cache (processing_docs.AnswerCache): The semantic cache of answers, None when it is disabled.
+        parse_executor (concurrent.futures.Executor): The pool of workers used to parse the batch uploads.
+        job_queue (jobs.JobQueue): The queue of the uploads ingested in the background.
+        document_ids (processing_docs.DocumentIds): The allocator of the ids of the new documents.
+        keyword_index (KeywordIndex): The BM25 index of the chunks, None when it is disabled.
+        search_params (SearchParams, optional): The HNSW and quantization parameters of the vector searches. Defaults to None (the defaults of Qdrant).
+        search_flights (SingleFlight, optional): The searches in progress, shared by the identical searches. Defaults to None (not shared).
+        rate_limiter (RateLimiter, optional): The token buckets of the users. Defaults to None (no rate limits).
+        search_pool (ConcurrencyPool, optional): The slots of the searches. Defaults to None (no limit).
+        ingest_pool (ConcurrencyPool, optional): The slots of the uploads. Defaults to None (no limit).
+        role (str, optional): The role of the process, one of ROLES. Defaults to "all".
+    """
+
+    def __init__(self, config, client_vdb, embeddings, chat, encoding, prompt_template, embedding_cache, answer_cache, parse_executor, job_queue, document_ids, keyword_index, search_params=None, search_flights=None, rate_limiter=None, search_pool=None, ingest_pool=None, role="all"):
+        self.config = config
+        self.client_vdb = client_vdb
+        self.embeddings = embeddings
+        self.chat = chat
+        self.encoding = encoding
+        self.prompt_template = prompt_template
+        self.embedding_cache = embedding_cache
+        self.answer_cache = answer_cache
+        self.parse_executor = parse_executor
+        self.job_queue = job_queue
+        self.document_ids = document_ids
+        self.keyword_index = keyword_index
+        self.search_params = search_params
+        self.search_flights = search_flights
+        self.rate_limiter = rate_limiter
+        self.search_pool = search_pool if search_pool is not None else ConcurrencyPool("search")
+        self.ingest_pool = ingest_pool if ingest_pool is not None else ConcurrencyPool("ingest")
+        if role not in ROLES:
+            raise ValueError(f"The role must be one of {', '.join(ROLES)}, not {role!r}")
+        self.role = role
+        self.sync_task = None
+
+    @classmethod
+    def create(cls, config, role="all"):
+        """
+        Create all the shared resources from the configuration.
+
+        The remote providers and the Qdrant client keep a pool of HTTP connections, so the requests
+        reuse the open connections instead of creating a new one for every call. The providers are
+        selected in the providers section, and Qdrant runs embedded in the process when qdrant.local_path
+        is set, so the API can run without network access.
+
+        Args:
+            config (dict): A dictionary containing configuration settings.
+            role (str, optional): The role of the process, one of ROLES. Defaults to "all".
+
+        Returns:
+            Services: The context with all the resources.
+        """
+        import httpx
+        import tiktoken
+        from concurrent.futures import ProcessPoolExecutor
+        from qdrant_client import AsyncQdrantClient
+        from langchain.prompts import PromptTemplate
+
+        limits = httpx.Limits(
+            max_connections=config['api'].get('max_connections', 100),
+            max_keepalive_connections=config['api'].get('max_keepalive_connections', 20),
+        )
+        http_client = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(600.0, connect=5.0))
+        # Semantic cache of the answers of the LLM, disabled when answer_max_entries is 0
+        answer_max_entries = config['cache'].get('answer_max_entries', 1000)
+        # Initialize Qdrant client with the host and port according to the configuration file, or the embedded Qdrant
+        local_path = config['qdrant'].get('local_path')
+        if local_path == ':memory:':
+            client_vdb = AsyncQdrantClient(location=':memory:')
+        elif local_path:
+            client_vdb = AsyncQdrantClient(path=local_path)
+        else:
+            client_vdb = AsyncQdrantClient(config['qdrant']['host'], port=config['qdrant']['port'], limits=limits)
+        embeddings = providers.create_embeddings(config, http_client)
+        return cls(
+            config=config,
+            client_vdb=client_vdb,
+            embeddings=embeddings,
+            chat=providers.create_chat(config, http_client),
+            encoding=tiktoken.get_encoding(config['openai']['tokenizer']),
+            prompt_template=PromptTemplate.from_template(config['llm']['prompt_template']),
+            embedding_cache=processing_docs.EmbeddingCache(
+                max_entries=config['cache'].get('embedding_max_entries', 10000),
+                max_bytes=config['cache'].get('embedding_max_mb', 64) * 1024 * 1024,
+                # The processes started by lib/serve.py share the embeddings through the file, kept by default
+                path=config['cache'].get('embedding_path') or (None if role == "all" else './data/embeddings.db'),
+            ),
+            answer_cache=processing_docs.AnswerCache(
+                threshold=config['cache'].get('answer_threshold', 0.95),
+                ttl=config['cache'].get('answer_ttl_seconds', 3600),
+                max_entries=answer_max_entries,
+            ) if answer_max_entries > 0 else None,
+            parse_executor=ProcessPoolExecutor(max_workers=config['ingest'].get('parse_workers')),
+            job_queue=jobs.JobQueue(
+                config['ingest'].get('queue_path', './data/jobs.db'),
+                config['ingest'].get('spool_dir', './data/spool'),
+                max_depth=config['ingest'].get('queue_max_depth', 100),
+                workers=config['ingest'].get('queue_workers', 2),
+                max_attempts=config['ingest'].get('job_max_attempts', 3),
+                retry_delay=config['ingest'].get('job_retry_seconds', 5),
+                max_part_bytes=config['api'].get('max_part_mb', 200) * 1024 * 1024,
+            ),
+            document_ids=processing_docs.DocumentIds(
+                client_vdb, config['qdrant']['collection'], path=config['qdrant'].get('ids_path', './data/document_ids.db'),
+                size=embeddings.dimension, qdrant=config['qdrant'],
+            ),
+            keyword_index=KeywordIndex(
+                path=config['keyword'].get('path', './data/keyword_index.npz'),
+                save_interval=config['keyword'].get('save_interval', 30),
+            ) if config['keyword'].get('enabled', True) else None,
+            search_params=collection.search_params(config['qdrant']),
+            search_flights=SingleFlight(
+                timeout=config['llm'].get('coalesce_timeout_seconds', 120),
+            ) if config['llm'].get('coalesce_searches', True) else None,
+            rate_limiter=RateLimiter(
+                path=config['api'].get('limits_path', './data/limits.db') or ':memory:',
+                rates={
+                    "search": (config['api'].get('search_rate_per_minute', 0), config['api'].get('search_burst', 10)),
+                    "ingest": (config['api'].get('ingest_rate_per_minute', 0), config['api'].get('ingest_burst', 5)),
+                },
+            ),
+            search_pool=ConcurrencyPool(
+                "search", size=config['api'].get('search_concurrency', 64), timeout=config['api'].get('admission_timeout_seconds', 10),
+            ),
+            ingest_pool=ConcurrencyPool(
+                "ingest", size=config['api'].get('ingest_concurrency', 2), timeout=config['api'].get('admission_timeout_seconds', 10),
+            ),
+            role=role,
+        )
+
+    @classmethod
+    async def warm_up(cls, config, role="all"):
+        """
+        Create the shared resources in a worker thread and start them. The event loop keeps serving the
+        probes while the clients, the tokenizer and the caches are imported and loaded.
+
+        Args:
+            config (dict): A dictionary containing configuration settings.
+            role (str, optional): The role of the process, one of ROLES. Defaults to "all".
+
+        Returns:
+            Services: The started context with all the resources.
+        """
+        services = await asyncio.to_thread(cls.create, config, role)
+        await services.start()
+        return services
+
+    async def start(self):
+        """
+        Start the synchronization with the other processes and, unless the process is an HTTP worker of several,
+        the workers of the job queue, building the keyword index from Qdrant when its file does not exist yet.
+        """
+        self.sync_task = asyncio.create_task(self._sync(self.config['api'].get('sync_seconds', 5)))
+        if self.role == "api":
+            return
+        await self.job_queue.start(self)
+        if self.keyword_index is not None and len(self.keyword_index) == 0:
+            await self.document_ids.ensure_collection()
+            collection_name = self.config['qdrant']['collection']
+            if (await self.client_vdb.count(collection_name=collection_name, exact=False)).count:
+                await self.keyword_index.rebuild(self.client_vdb, collection_name)
+
+    async def _sync(self, interval):
+        # Save the keyword index and read the chunks saved by the other processes. The HTTP workers also drop the
+        # cached answers of the documents updated by the ingestion process
+        since = time.time()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if self.keyword_index is not None:
+                    await asyncio.to_thread(self.keyword_index.sync)
+                if self.role == "api" and self.answer_cache is not None:
+                    now = time.time()
+                    for document_id in await self.job_queue.updated_documents(since - interval):
+                        self.answer_cache.invalidate_document(document_id)
+                    since = now
+            except Exception:
+                metrics.logger.exception("The synchronization with the other processes failed")
+
+    async def close(self):
+        """
+        Close the clients, the pools of workers and the caches.
+        """
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+            await asyncio.gather(self.sync_task, return_exceptions=True)
+        await self.job_queue.close()
+        await self.client_vdb.close()
+        await self.embeddings.close()
+        await self.chat.close()
+        self.parse_executor.shutdown()
+        self.embedding_cache.close()
+        self.document_ids.close()
+        if self.rate_limiter is not None:
+            self.rate_limiter.close()
+        if self.keyword_index is not None:
+            await asyncio.to_thread(self.keyword_index.save, True)
+
+# Dependency that gives the shared resources to the endpoints
+async def get_services(request: Request) -> Services:
+    """
+    Get the shared resources created when the app started. A request that arrives during the warm-up waits for it.
+
+    Args:
+        request (Request): The incoming request.
+
+    Returns:
+        Services: The context with all the resources.
+    """
+    services = request.app.state.services
+    if services is None:
+        services = await asyncio.shield(request.app.state.warm_up)
+    return services
@@ -0,0 +1,104 @@
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+import lib.utils as utils
+
+## Settings of the API. config.yaml is read once and the same object is shared by main, the security module and
+## the services. The settings needed to start the API are checked and typed when the file is loaded, so a missing
+## or wrong value stops the start with a clear message instead of failing on the first request.
+
+# Sections of config.yaml, the optional ones may be left out and all their settings take the default values
+SECTIONS = ("openai", "qdrant", "llm", "secure", "ingest", "keyword", "cache", "api", "providers")
+
+# Settings of the API read from config.yaml
+@dataclass(frozen=True)
+class Settings:
+    """
+    Settings of the API.
+
+    The sections of the file are kept as dictionaries in config, where the modules read the optional
+    settings with their defaults. The settings required to start are exposed as typed attributes.
+
+    Args:
+        path (str): The path to the configuration file.
+        config (dict): The sections of the configuration file.
+        collection (str): The name of the collection in Qdrant.
+        tokenizer (str): The name of the tiktoken encoding.
+        prompt_template (str): The template of the prompt sent to the LLM.
+        threshold (float): The minimum score of the retrieved chunks.
+        secret_key (str): The key that signs the tokens.
+        algorithm (str): The algorithm that signs the tokens.
+        access_token_expire_minutes (int): The minutes a token is valid.
+        max_length_prompt (int): The maximum number of characters of a search.
+    """
+
+    path: str
+    config: dict
+    collection: str
+    tokenizer: str
+    prompt_template: str
+    threshold: float
+    secret_key: str
+    algorithm: str
+    access_token_expire_minutes: int
+    max_length_prompt: int
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read and check a configuration file.
+
+        Args:
+            path (str): The path to the YAML configuration file.
+
+        Returns:
+            Settings: The settings of the file.
+
+        Raises:
+            ValueError: If a required setting is missing or has a wrong type.
+        """
+        config = utils.load_config(path) or {}
+        for section in SECTIONS:
+            if config.get(section) is None:
+                config[section] = {}
+
+        def required(section, key, kind):
+            value = config[section].get(key)
+            if value is None:
+                raise ValueError(f"The setting {section}.{key} is missing in {path}")
+            # YAML reads a number without decimals, such as a threshold of 1, as an int
+            accepted = (int, float) if kind is float else kind
+            if isinstance(value, bool) and kind is not bool or not isinstance(value, accepted):
+                raise ValueError(f"The setting {section}.{key} of {path} must be {kind.__name__}, not {value!r}")
+            return kind(value)
+
+        return cls(
+            path=path,
+            config=config,
+            collection=required('qdrant', 'collection', str),
+            tokenizer=required('openai', 'tokenizer', str),
+            prompt_template=required('llm', 'prompt_template', str),
+            threshold=required('llm', 'threshold', float),
+            secret_key=required('secure', 'SECRET_KEY', str),
+            algorithm=required('secure', 'ALGORITHM', str),
+            access_token_expire_minutes=required('secure', 'ACCESS_TOKEN_EXPIRE_MINUTES', int),
+            max_length_prompt=required('api', 'max_length_prompt', int),
+        )
+
+@lru_cache(maxsize=None)
+def _load_settings(path):
+    return Settings.load(path)
+
+# The settings shared by all the modules, loaded the first time they are needed
+def get_settings(path=None):
+    """
+    Get the settings of a configuration file, reading it only the first time.
+
+    Args:
+        path (str, optional): The path to the configuration file. Defaults to the CONFIG_PATH
+            environment variable, or ./config.yaml when it is not set.
+
+    Returns:
+        Settings: The settings of the file.
+    """
+    return _load_settings(os.path.abspath(path or os.environ.get("CONFIG_PATH", "./config.yaml")))
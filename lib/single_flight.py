@@ -0,0 +1,146 @@
+import asyncio
+import lib.metrics as metrics
+
+## Single-flight execution of identical searches. When the same search arrives while it is being answered, the new
+## request waits for the answer in progress instead of embedding the prompt, searching Qdrant and calling the LLM
+## again. A streamed answer is shared event by event: a request that joins late first receives the events already
+## sent. The work runs in its own task, so it goes on when the client that started it disconnects, and it is
+## cancelled when every request waiting for it is gone or when it takes longer than the timeout.
+
+# Work in progress for a key, and the number of requests waiting for it
+class _Flight:
+    __slots__ = ("task", "waiters", "events", "updated")
+
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.events = []
+        self.updated = asyncio.get_running_loop().create_future()
+
+class SingleFlight:
+    """
+    Share the result of a coroutine, or the events of an async generator, between the concurrent calls with the same key.
+
+    The coroutine or generator of the first call runs in a new task, which copies the context of that call,
+    so its stages are recorded in the request that started it. The key is forgotten when the work ends, so
+    the calls after it start a new one.
+
+    Args:
+        timeout (float, optional): The maximum seconds of the work of a key, None for no limit. Defaults to None.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+        self.cancelled = 0
+        self.timeouts = 0
+
+    def _join(self, key, start):
+        # Get the work in progress for the key, or start it, and tell if this call started it
+        flight = self.flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self.flights[key] = _Flight()
+            flight.task = asyncio.create_task(start(flight))
+            flight.task.add_done_callback(lambda task: self._forget(key, flight))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        flight.waiters += 1
+        return flight, leader
+
+    def _forget(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def _leave(self, key, flight):
+        # Cancel the work when the last request waiting for it is gone
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            self._forget(key, flight)
+            flight.task.cancel()
+            self.cancelled += 1
+
+    async def _limit(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            # asyncio.TimeoutError is only the built-in TimeoutError from Python 3.11
+            raise TimeoutError(f"The work took longer than {self.timeout} seconds")
+
+    async def run(self, key, factory):
+        """
+        Get the result of the coroutine of a key, shared with the concurrent calls with the same key.
+
+        Args:
+            key (hashable): The key of the work, for example the normalized prompt.
+            factory (callable): Creates the coroutine, only called when no work is in progress for the key.
+
+        Returns:
+            The result of the coroutine.
+
+        Raises:
+            TimeoutError: If the work takes longer than the timeout.
+        """
+        flight, leader = self._join(key, lambda flight: self._limit(factory()))
+        try:
+            if leader:
+                return await asyncio.shield(flight.task)
+            # The time a request waits for the answer of another one
+            with metrics.span("coalesced"):
+                return await asyncio.shield(flight.task)
+        finally:
+            self._leave(key, flight)
+
+    async def _produce(self, flight, events):
+        # Keep every event of the generator and wake up the requests waiting for the next one
+        async def produce():
+            async for event in events:
+                flight.events.append(event)
+                flight.updated.set_result(None)
+                flight.updated = asyncio.get_running_loop().create_future()
+
+        try:
+            await self._limit(produce())
+        finally:
+            flight.updated.set_result(None)
+
+    async def stream(self, key, factory):
+        """
+        Get the events of the async generator of a key, shared with the concurrent calls with the same key.
+
+        Args:
+            key (hashable): The key of the work, for example the normalized prompt.
+            factory (callable): Creates the async generator, only called when no work is in progress for the key.
+
+        Yields:
+            The events of the generator, from the first one.
+
+        Raises:
+            TimeoutError: If the generator takes longer than the timeout.
+        """
+        flight, _ = self._join(key, lambda flight: self._produce(flight, factory()))
+        try:
+            sent = 0
+            while True:
+                if sent < len(flight.events):
+                    sent += 1
+                    yield flight.events[sent - 1]
+                elif flight.task.done():
+                    # Raise the error of the generator, if any
+                    flight.task.result()
+                    return
+                else:
+                    await asyncio.shield(flight.updated)
+        finally:
+            self._leave(key, flight)
+
+    @property
+    def stats(self):
+        """
+        dict: The number of calls that started a work, joined one, and of the works cancelled and timed out.
+        """
+        return {"leader": self.leaders, "follower": self.followers, "cancelled": self.cancelled, "timeout": self.timeouts}
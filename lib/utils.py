@@ -45,4 +45,16 @@ def load_json(file: str) -> dict:
 
     return data
 
+# Format an event of a Server-Sent Events stream
+def format_sse(event: str, data) -> str:
+    """
+    Format an event of a Server-Sent Events stream with its data encoded as JSON.
+
+    Args:
+        event (str): The name of the event.
+        data: The data of the event, any value that can be encoded as JSON.
 
+    Returns:
+        str: The event ready to be sent to the client.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
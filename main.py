@@ -1,33 +1,120 @@
+import os
+import math
+import asyncio
 from datetime import datetime, timedelta
+from contextlib import asynccontextmanager, aclosing
 from fastapi import Depends, FastAPI, HTTPException, status, Path, UploadFile, File
 from fastapi.security import OAuth2PasswordRequestForm
-from passlib.hash import bcrypt
 from fastapi.middleware.cors import CORSMiddleware
-from openai import OpenAI
-from qdrant_client import QdrantClient
-from fastapi.responses import JSONResponse
-from typing import Optional
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
+from typing import Optional, List
 import security.security as security
 import lib.processing_docs as processing_docs
+import lib.ingest as ingest
+import lib.extraction as extraction
+import lib.jobs as jobs
 import lib.utils as utils
-from docx import Document
-import io
+import lib.metrics as metrics
+import lib.limits as limits
+from lib.settings import Settings, get_settings
+from lib.services import Services, get_services
 
-# Load the configuration file
-config = utils.load_config('./config.yaml')
+# Load the configuration file, shared with the security module
+settings = get_settings()
+config = settings.config
+
+# Log every request with its correlation id and the time of its stages
+metrics.configure_logging(config['api'].get('log_level', 'INFO'))
 
 # Load documentation of the API development and show the information when is deployed
 tag = utils.load_json(r'./data/tags.json') 
 tags = [tag[t] for t in tag]
 
-# Initialize Qdrant client with the host and port according to the configuration file
-client_vdb = QdrantClient(config['qdrant']['host'], port=config['qdrant']['port'])
+# Create the shared clients, models and caches and load the password hashing before the first requests
+async def warm_up(app: FastAPI):
+    """
+    Create and start the resources shared by all the requests.
+
+    Args:
+        app (FastAPI): The FastAPI application.
+
+    Returns:
+        Services: The context with all the resources.
+    """
+    try:
+        # lib/serve.py sets the role of the HTTP workers when the API runs in several processes
+        services = await Services.warm_up(config, role=os.environ.get("API_ROLE", "all"))
+        # The bcrypt backend and the hash verified for the unknown usernames are loaded before the first login
+        await asyncio.get_running_loop().run_in_executor(security.password_executor, security.get_dummy_hash)
+    except Exception:
+        metrics.logger.exception("The warm-up of the API failed")
+        raise
+    app.state.services = services
+    return services
 
-# Initialize OpenAI client with your API key according to the configuration file
-client_ia = OpenAI(api_key=config['openai']['key'])
+# Warm up the shared resources in the background when the app starts and close them when it stops
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start the warm-up of the resources shared by all the requests and release them on shutdown. The app
+    accepts requests during the warm-up: /ready answers 503 and the other endpoints wait until it is done.
+
+    Args:
+        app (FastAPI): The FastAPI application.
+    """
+    app.state.services = None
+    app.state.warm_up = asyncio.create_task(warm_up(app))
+    yield
+    app.state.warm_up.cancel()
+    try:
+        services = await app.state.warm_up
+    except (asyncio.CancelledError, Exception):
+        return
+    await services.close()
+
+# Dependency that takes a token of the bucket of the user for a kind of request
+def rate_limited(kind: str):
+    """
+    Build the dependency that authenticates the user and applies the rate limit of a kind of request.
+
+    Args:
+        kind (str): The kind of request, search or ingest.
+
+    Returns:
+        callable: The dependency, which returns the current active user.
+    """
+    async def check(services: Services = Depends(get_services), current_user: security.User = Depends(security.get_current_active_user)) -> security.User:
+        # The username is the sub of the JWT
+        if services.rate_limiter is not None:
+            try:
+                await services.rate_limiter.acquire(current_user.username, kind)
+            except limits.RateLimited as e:
+                raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+        return current_user
+    return check
+
+# Take a slot of a pool, the request is refused when the pool stays busy
+async def admit(pool: limits.ConcurrencyPool) -> limits.Slot:
+    """
+    Wait for a free slot of a pool.
+
+    Args:
+        pool (limits.ConcurrencyPool): The search or ingest pool.
+
+    Returns:
+        limits.Slot: The slot, released at the end of the request.
+
+    Raises:
+        HTTPException: With status code 503 if no slot is free before the admission timeout.
+    """
+    try:
+        return await pool.acquire()
+    except limits.PoolBusy as e:
+        raise HTTPException(status_code=503, detail=f"{e}, try again later", headers={"Retry-After": "1"})
 
 # Create a FastAPI instance with the title and tags
-app = FastAPI(title="AI Engineer Test to create", openapi_tags= tags)
+app = FastAPI(title="AI Engineer Test to create", openapi_tags= tags, lifespan=lifespan)
 
 origins = ["*"]
 
@@ -38,8 +125,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
+# Time every request and give it a correlation id, added last so it also measures the CORS middleware
+app.add_middleware(metrics.MetricsMiddleware)
+
 
 # Route for the home page
 @app.get("/", tags=["Home"])
@@ -52,81 +143,208 @@ async def home():
     """
     return {'API created by Fabian Coy -2024 AI Engineer Test': 'API to load, upload data to QDRANT and get answers from OpenAI'}
 
-# Route for uploading a .docx file
+# Route for the readiness probe, the API is ready when the warm-up is done
+@app.get("/ready", tags=["Home"])
+async def ready():
+    """
+    Check if the API has finished its warm-up and can serve the requests without delay.
+
+    Returns:
+        JSONResponse: The status "ready" with status code 200, or "warming up" or "failed" with status code 503.
+    """
+    if getattr(app.state, "services", None) is not None:
+        return JSONResponse(content={"status": "ready"}, status_code=200)
+    warm_up_task = getattr(app.state, "warm_up", None)
+    if warm_up_task is not None and warm_up_task.done() and not warm_up_task.cancelled() and warm_up_task.exception() is not None:
+        return JSONResponse(content={"status": "failed", "detail": str(warm_up_task.exception())}, status_code=503)
+    return JSONResponse(content={"status": "warming up"}, status_code=503)
+
+# Route for uploading a .docx file, the document is ingested in the background
 @app.post("/upload/", tags=["Upload_file"])
-async def upload_file(file: UploadFile = File(...), id: Optional[int] = 0, current_user: security.User = Depends(security.get_current_active_user)):
+async def upload_file(file: UploadFile = File(...), id: Optional[int] = 0, services: Services = Depends(get_services), current_user: security.User = Depends(rate_limited("ingest"))):
     """
-    Upload or update a document in Qdrant vector database.
+    Queue the upload or update of a document in Qdrant vector database.
 
     Args:
         file (UploadFile): The .docx file to be uploaded.
         id (Optional[int]): The ID of the document (default is 0) when the function is upload a new document. If you want to update a document, you need to provide the ID of the document.
+        services (Services): The clients, models and caches shared by the requests.
         current_user (security.User): The current authenticated user.
 
     Returns:
-        JSONResponse: A JSON response indicating the status of the upload process.
+        JSONResponse: A JSON response with the id and the status of the ingestion job, to be followed in /jobs/{job_id}.
     """
     # check if the file is a .docx file 
     if not file.filename.lower().endswith('.docx'):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a .docx file")
+    # check the signature of the file, a file that is not a .docx would only fail in the queue
+    try:
+        await asyncio.to_thread(extraction.check_docx, file.file)
+    except extraction.InvalidDocument as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    config = services.config
     # check if the ID is valid
     if id != 0:    
-        information = client_vdb.get_collection(collection_name=config['qdrant']['collection'])
-        last_id = information.vectors_count
+        last_id = await services.document_ids.last()
         if id > last_id:
             raise HTTPException(status_code=400, detail=f"Invalid ID. The last ID is {last_id}")
 
-    # read the contents of the file, create embeddings, and upload the document to Qdrant
+    # refuse the upload before copying it when the queue is full, so the clients slow down
+    queue_full = HTTPException(status_code=503, detail="The ingestion queue is full, try again later", headers={"Retry-After": "30"})
+    if await services.job_queue.full():
+        raise queue_full
+    # copy the spooled upload to the queue directory and queue the job, the same document is not processed twice
     try:
-        contents = await file.read()
-        doc = Document(io.BytesIO(contents))
-        text = ""
-        for para in doc.paragraphs:
-            text += para.text + "\n"
-        embeddings, _, _ = processing_docs.create_embeddings(client_ia, text, config['openai']['tokenizer'], config['openai']['model'])
-        outcome_upload = processing_docs.upload_documents(config['qdrant']['collection'], client_vdb, embeddings, text, id=id)
+        async with await admit(services.ingest_pool):
+            with metrics.span("spool"):
+                spool_path, document_hash = await asyncio.to_thread(
+                    jobs.spool_upload, file.file, services.job_queue.spool_dir, config['api'].get('max_upload_mb', 50) * 1024 * 1024
+                )
+    except extraction.DocumentTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    try:
+        job, queued = await services.job_queue.submit(document_hash, id, file.filename, spool_path)
+    except jobs.QueueFull:
+        os.remove(spool_path)
+        raise queue_full
+    if not queued:
+        os.remove(spool_path)
+    # return the filename and the job that ingests the document
+    return JSONResponse(content={"the filename": file.filename, "job_id": job["id"], "status": job["status"]}, status_code=202)
 
-    except Exception:
-        raise HTTPException(status_code=500, detail=f"Error processing file: {file.filename}")
-    # return the filename and the status of the upload process
-    return JSONResponse(content={"the filename": file.filename, "process created": outcome_upload}, status_code=200)
+# Route to follow the ingestion of an uploaded document
+@app.get("/jobs/{job_id}", tags=["Upload_file"])
+async def job_status(job_id: str, services: Services = Depends(get_services), current_user: security.User = Depends(security.get_current_active_user)):
+    """
+    Get the progress of the ingestion of an uploaded document.
+
+    Args:
+        job_id (str): The id of the job returned by /upload/.
+        services (Services): The clients, models and caches shared by the requests.
+        current_user (security.User): The current authenticated user.
+
+    Returns:
+        JSONResponse: The status (queued, running, done or failed), stage, number of chunks stored, attempts, document ID and outcome of the job.
+    """
+    job = await services.job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return JSONResponse(content=job, status_code=200)
+
+# Route for uploading many .docx files, or zip archives with .docx files, in a single request
+@app.post("/upload/batch", tags=["Upload_file"])
+async def upload_batch(files: List[UploadFile] = File(...), services: Services = Depends(get_services), current_user: security.User = Depends(rate_limited("ingest"))):
+    """
+    Upload many documents to Qdrant vector database, parsing them in parallel and embedding them in batches.
+    The files, and the .docx files of the zip archives, bigger than api.max_upload_mb get a result with status_code 413.
+
+    Args:
+        files (List[UploadFile]): The .docx files or zip archives with .docx files to be uploaded.
+        services (Services): The clients, models and caches shared by the requests.
+        current_user (security.User): The current authenticated user.
+
+    Returns:
+        JSONResponse: A JSON response with the outcome of the upload of every file.
+    """
+    async with await admit(services.ingest_pool):
+        # the uploads are spooled files, they are copied to the spool directory instead of being read in memory
+        try:
+            results = await ingest.ingest_documents(services, [(file.filename, file.file) for file in files])
+        except Exception:
+            raise HTTPException(status_code=500, detail="Error processing the batch of files")
+    return JSONResponse(content={"results": results}, status_code=200)
 
 # Route to search the best document based on the prompt and create an answer using LLM model 
 @app.get("/search/{prompt}", tags=["Search"])
-async def read_words(prompt: str = Path(..., max_length=config['api']['max_length_prompt']), current_user: security.User = Depends(security.get_current_active_user)):
+async def read_words(prompt: str = Path(..., max_length=settings.max_length_prompt), services: Services = Depends(get_services), current_user: security.User = Depends(rate_limited("search"))):
     """
     Search for words or phrases in the documents stored in Qdrant vector database.
 
     Args:
         prompt (str): The search prompt or query.
+        services (Services): The clients, models and caches shared by the requests.
         current_user (security.User): The current authenticated user.
 
     Returns:
         JSONResponse: A JSON response indicating the LLM outcome using the prompt and document.
     """
-    response = processing_docs.get_answer_llm(config, client_vdb, client_ia, prompt)
+    try:
+        async with await admit(services.search_pool):
+            response = await processing_docs.get_answer_llm(services, prompt)
+    except TimeoutError:
+        raise HTTPException(status_code=504, detail="The answer took too long, try again later")
     return JSONResponse(content={"LLM answer": response}, status_code=200)
 
+# Route to stream the answer of the LLM model as Server-Sent Events
+@app.get("/search/stream/{prompt}", tags=["Search"])
+async def stream_words(prompt: str = Path(..., max_length=settings.max_length_prompt), services: Services = Depends(get_services), current_user: security.User = Depends(rate_limited("search"))):
+    """
+    Search for words or phrases in the documents and stream the answer of the LLM as it is generated.
+
+    Args:
+        prompt (str): The search prompt or query.
+        services (Services): The clients, models and caches shared by the requests.
+        current_user (security.User): The current authenticated user.
+
+    Returns:
+        StreamingResponse: A stream of Server-Sent Events with the metadata of the retrieved documents, the tokens of the answer and the end of the answer.
+    """
+    slot = await admit(services.search_pool)
+    events = processing_docs.stream_answer_llm(services, prompt)
+
+    async def event_stream():
+        # Close the answer as soon as the client disconnects, so an answer nobody reads is cancelled
+        try:
+            async with aclosing(events):
+                async for event, data in events:
+                    yield utils.format_sse(event, data)
+        finally:
+            slot.release()
+
+    # The slot is also released when the client disconnects before the stream starts
+    return StreamingResponse(
+        event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(slot.release),
+    )
+
+# Route with the metrics of the API in the Prometheus text format
+@app.get("/metrics", tags=["Metrics"])
+async def read_metrics(services: Services = Depends(get_services)):
+    """
+    Get the latency histograms of the requests and of their stages, the requests in flight, the tokens, the hits
+    and misses of the caches and the depth of the ingestion queue, to be scraped by Prometheus.
+
+    Args:
+        services (Services): The clients, models and caches shared by the requests.
+
+    Returns:
+        PlainTextResponse: The metrics in the Prometheus text format.
+    """
+    queue_depth = await services.job_queue.depth() if services.job_queue is not None else None
+    return PlainTextResponse(metrics.render(services, security.token_cache, queue_depth), media_type=metrics.CONTENT_TYPE)
+
 # Route to generate a token for accessing the API securely
 @app.post("/token", response_model=security.Token, tags=["Generate Token"])
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), users=Depends(security.get_users), settings: Settings = Depends(security.get_auth_settings)):
     """
     Generate a token for accessing the API securely.
 
     Args:
         form_data (OAuth2PasswordRequestForm): The form data containing the username and password.
+        users (JsonUserRepository | SqliteUserRepository): The repository of users.
+        settings (Settings): The settings with the lifetime of the tokens.
 
     Returns:
         dict: A dictionary containing the access token and token type.
     """
-    user = security.authenticate_user(security.db_dummy, form_data.username, form_data.password)
+    user = await security.authenticate_user(users, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=config['secure']['ACCESS_TOKEN_EXPIRE_MINUTES'])
+    access_token_expires = timedelta(minutes=settings.access_token_expire_minutes)
     access_token = security.create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
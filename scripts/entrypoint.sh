@@ -2,6 +2,5 @@
 
 set -e
 
-python manage.py collectstatic --noinput
-
-uwsgi --socket :8000 --master --enable-threads --module app.wsgi
+# Serve the API with api.workers HTTP workers and the ingestion process, the arguments are passed to the launcher
+exec python lib/serve.py --host 0.0.0.0 --port "${PORT:-8000}" "$@"
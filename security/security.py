@@ -4,26 +4,60 @@ from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-from lib.utils import  load_config, load_json
+from lib.settings import Settings, get_settings
+from security.users import create_user_repository
+from security.token_cache import TokenCache
+import lib.metrics as metrics
 from fastapi import Depends, HTTPException, status
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import asyncio
 
 
-# Load configuration from config.yaml file
-config = load_config('./config.yaml')
+# Load configuration from config.yaml file, the file is read once and shared with main
+settings = get_settings()
+config = settings.config
 
 # Set the secret key and algorithm for JWT token
-SECRET_KEY = config['secure']['SECRET_KEY']
-ALGORITHM = config['secure']['ALGORITHM']
+SECRET_KEY = settings.secret_key
+ALGORITHM = settings.algorithm
 
-# Load dummy user database from JSON file
-db_dummy = load_json('./data/dummy_users_database.json')
+# Load the repository of users, indexed by username
+users = create_user_repository(config)
 
-# Create a password context for hashing and verifying passwords
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Cache of the verified tokens, disabled when token_cache_size is 0
+token_cache_size = config['secure'].get('token_cache_size', 10000)
+token_cache = TokenCache(max_entries=token_cache_size) if token_cache_size > 0 else None
+
+# Create a password context for hashing and verifying passwords, the hashes with a different cost are marked for update
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=config['secure'].get('bcrypt_rounds', 12))
+
+# Pool of threads that verifies the passwords outside the event loop, its size caps the concurrent bcrypt verifications
+password_executor = ThreadPoolExecutor(max_workers=config['secure'].get('password_workers', 4), thread_name_prefix="bcrypt")
 
 # Define the OAuth2 password bearer scheme for token authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Dependency that gives the repository of users to the endpoints
+def get_users():
+    """
+    Get the repository of users loaded when the module was imported.
+
+    Returns:
+    - JsonUserRepository | SqliteUserRepository: The repository of users.
+    """
+    return users
+
+# Dependency that gives the settings of the tokens to the endpoints
+def get_auth_settings() -> Settings:
+    """
+    Get the settings of the configuration file, with the secret key and the lifetime of the tokens.
+
+    Returns:
+    - Settings: The settings shared with main.
+    """
+    return settings
+
 # Define the Token model for representing the access token
 class Token(BaseModel):
     access_token: str
@@ -60,6 +94,17 @@ def verify_password(plain_password, hashed_password):
     """
     return pwd_context.verify(plain_password, hashed_password)
 
+# Hash verified for the unknown usernames, so they take as long as the known ones
+@lru_cache(maxsize=1)
+def get_dummy_hash():
+    """
+    Generate, once, the hash verified when the username does not exist.
+
+    Returns:
+    - str: The hash of a random password.
+    """
+    return pwd_context.hash(SECRET_KEY + "dummy password")
+
 # Generate the hash of a password
 def get_password_hash(password):
     """
@@ -79,35 +124,51 @@ def get_user(db, username: str):
     Retrieve a user from the database based on the username.
 
     Parameters:
-    - db (dict): The user database.
+    - db (JsonUserRepository | SqliteUserRepository): The repository of users.
     - username (str): The username of the user to retrieve.
 
     Returns:
     - UserInDB: The user object if found, None otherwise.
     """
-    users = [db[i] for i in db]
-    username_db = [users[n]["username"] for n in range(len(users))]
-    if username in username_db:
-        user_dict = users[username.index(username)]
+    user_dict = db.get(username)
+    if user_dict is not None:
         return UserInDB(**user_dict)
 
 # Authenticate a user based on the provided username and password
-def authenticate_user(db, username: str, password: str):
+async def authenticate_user(db, username: str, password: str):
     """
     Authenticate a user based on the provided username and password.
 
+    The bcrypt verification runs in the pool of password threads, so it does not block the event
+    loop. An unknown username verifies a dummy hash to take the same time as a known one. When
+    rehash_passwords is enabled, a hash with an outdated cost is replaced after a valid login, in the
+    same pool of threads.
+
     Parameters:
-    - db (dict): The user database.
+    - db (JsonUserRepository | SqliteUserRepository): The repository of users.
     - username (str): The username of the user to authenticate.
     - password (str): The password of the user to authenticate.
 
     Returns:
     - Union[UserInDB, bool]: The authenticated user object if successful, False otherwise.
     """
-    user = get_user(db, username)
+    loop = asyncio.get_running_loop()
+    with metrics.span("user_lookup"):
+        user = get_user(db, username)
     if not user:
+        with metrics.span("password_verify"):
+            await loop.run_in_executor(password_executor, lambda: verify_password(password, get_dummy_hash()))
         return False
-    if not verify_password(password, user.hashed_password):
+    if config['secure'].get('rehash_passwords', False):
+        with metrics.span("password_verify"):
+            valid, new_hash = await loop.run_in_executor(password_executor, pwd_context.verify_and_update, password, user.hashed_password)
+        if valid and new_hash:
+            # The repository writes its file or its database, also outside the event loop
+            await loop.run_in_executor(password_executor, lambda: db.update(username, hashed_password=new_hash))
+    else:
+        with metrics.span("password_verify"):
+            valid = await loop.run_in_executor(password_executor, verify_password, password, user.hashed_password)
+    if not valid:
         return False
     return user
 
@@ -131,16 +192,19 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    with metrics.span("token_encode"):
+        encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 # Return the current user based on the provided token
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
+async def get_current_user(token: str = Depends(oauth2_scheme), users=Depends(get_users)) -> User:
     """
-    Retrieves the current user based on the provided token.
+    Retrieves the current user based on the provided token. The tokens already verified are
+    served from the token cache until they expire or the users change.
 
     Parameters:
     - token (str): The authentication token.
+    - users (JsonUserRepository | SqliteUserRepository): The repository of users.
 
     Returns:
     - user (User): The user associated with the token.
@@ -148,22 +212,32 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
     Raises:
     - HTTPException: If the credentials cannot be validated.
     """
+    # The version is read before loading the user, so a change made meanwhile is not cached
+    version = users.version
+    if token_cache is not None:
+        user = token_cache.get(token, version)
+        if user is not None:
+            return user
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with metrics.span("token_decode"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = get_user(db_dummy, username=token_data.username)
+    with metrics.span("user_lookup"):
+        user = get_user(users, username=token_data.username)
     if user is None:
         raise credentials_exception
+    if token_cache is not None and payload.get("exp") is not None:
+        token_cache.put(token, user, payload["exp"], version)
     return user
 
 # Return the current active user based on the provided token
@@ -0,0 +1,98 @@
+import time
+import threading
+from collections import OrderedDict
+
+## Cache of the tokens already verified, so a client that reuses its token does not pay the JWT
+## decoding and the user lookup on every request
+
+class TokenCache:
+    """
+    Bounded cache of verified tokens and the users they belong to.
+
+    Every entry expires at the expiration time of its token. The whole cache is dropped when the
+    version of the repository of users changes, so a disabled user is not served from the cache. The
+    version changes with every update and set_disabled, in this process or in another one, so the
+    repositories do not need to know the cache.
+
+    Args:
+        max_entries (int, optional): The maximum number of tokens kept. Defaults to 10000.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.version = version
+
+    def get(self, token: str, version):
+        """
+        Get the user of a verified token.
+
+        Args:
+            token (str): The bearer token.
+            version: The current version of the repository of users.
+
+        Returns:
+            User: The user of the token, None if the token is not cached or has expired.
+        """
+        with self.lock:
+            self._check_version(version)
+            entry = self.entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            user, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[token]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return user
+
+    def put(self, token: str, user, expires_at: float, version) -> None:
+        """
+        Store the user of a verified token.
+
+        Args:
+            token (str): The bearer token.
+            user (User): The user of the token.
+            expires_at (float): The expiration time of the token as a UNIX timestamp.
+            version: The version of the repository of users used to load the user.
+        """
+        with self.lock:
+            self._check_version(version)
+            if version != self.version:
+                return
+            self.entries[token] = (user, expires_at)
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    @property
+    def stats(self) -> dict:
+        """
+        dict: The counters of the cache and the number of cached tokens.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self.entries),
+        }
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+from typing import Dict, Union
+
+## Repositories of the users of the API. Both keep the users indexed by username, so looking up the
+## user of a request does not scan the whole database
+
+# Users stored in the dummy_users_database.json file
+class JsonUserRepository:
+    """
+    Users loaded from a JSON file and indexed by username.
+
+    The file is loaded once and loaded again when its modification time changes, at most once
+    every reload_interval seconds. The new index replaces the old one in a single assignment,
+    so the readers never see a half loaded database.
+
+    Args:
+        path (str): The path to the JSON file with the users.
+        reload_interval (float, optional): The minimum seconds between two checks of the file. Defaults to 1.
+    """
+
+    def __init__(self, path: str, reload_interval: float = 1.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.checked_at = 0.0
+        self.data = {}
+        self.index = {}
+        self.loads = 0
+        self._load()
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        self.mtime = os.stat(self.path).st_mtime_ns
+        self.data = data
+        self.index = {user["username"]: user for user in data.values()}
+        self.loads += 1
+
+    def _write(self, data):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, suffix='.tmp') as f:
+            json.dump(data, f, indent=4)
+        os.replace(f.name, self.path)
+        self._load()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self.checked_at < self.reload_interval:
+            return
+        self.checked_at = now
+        try:
+            if os.stat(self.path).st_mtime_ns != self.mtime:
+                with self.lock:
+                    self._load()
+        except (OSError, ValueError) as e:
+            print(f"Error reloading the users database: {e}")
+
+    def get(self, username: str) -> Union[dict, None]:
+        """
+        Get a user by username.
+
+        Args:
+            username (str): The username of the user.
+
+        Returns:
+            dict: The user data, None if the user does not exist.
+        """
+        self._refresh()
+        return self.index.get(username)
+
+    @property
+    def version(self) -> int:
+        """
+        int: A number that changes every time the users are loaded again.
+        """
+        self._refresh()
+        return self.loads
+
+    def add(self, user_data: Dict[str, str]) -> str:
+        """
+        Add a user and write the database to a temporary file that atomically replaces the JSON file.
+
+        Args:
+            user_data (Dict[str, str]): The user data with the keys username, full_name, email, hashed_password and disabled.
+
+        Returns:
+            str: The id of the new user.
+
+        Raises:
+            ValueError: If the username already exists.
+        """
+        with self.lock:
+            self._load()
+            if user_data["username"] in self.index:
+                raise ValueError(f"The username {user_data['username']} already exists")
+            data = dict(self.data)
+            new_id = str(max((int(key) for key in data), default=0) + 1)
+            data[new_id] = user_data
+            self._write(data)
+        return new_id
+
+    def update(self, username: str, **fields) -> None:
+        """
+        Update some fields of a user.
+
+        Args:
+            username (str): The username of the user.
+            **fields: The fields to update, for example disabled or hashed_password.
+
+        Raises:
+            KeyError: If the user does not exist.
+        """
+        with self.lock:
+            self._load()
+            data = {key: dict(user) for key, user in self.data.items()}
+            for user in data.values():
+                if user["username"] == username:
+                    user.update(fields)
+                    self._write(data)
+                    return
+        raise KeyError(username)
+
+    def set_disabled(self, username: str, disabled: bool = True) -> None:
+        """
+        Disable or enable a user.
+
+        Args:
+            username (str): The username of the user.
+            disabled (bool, optional): True to disable the user, False to enable it. Defaults to True.
+
+        Raises:
+            KeyError: If the user does not exist.
+        """
+        self.update(username, disabled=disabled)
+
+# Users stored in a SQLite database, for user bases too large to keep in a JSON file
+class SqliteUserRepository:
+    """
+    Users stored in a SQLite table with a unique index on the username.
+
+    Args:
+        path (str): The path to the SQLite database.
+        seed_path (str, optional): A JSON file with users imported when the table is empty. Defaults to None.
+    """
+
+    def __init__(self, path: str, seed_path: Union[str, None] = None):
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "id INTEGER PRIMARY KEY, username TEXT NOT NULL UNIQUE, full_name TEXT, email TEXT, "
+            "hashed_password TEXT NOT NULL, disabled INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.db.commit()
+        if seed_path and self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0:
+            with open(seed_path, 'r') as f:
+                for user_data in json.load(f).values():
+                    self.add(user_data)
+
+    def get(self, username: str) -> Union[dict, None]:
+        """
+        Get a user by username.
+
+        Args:
+            username (str): The username of the user.
+
+        Returns:
+            dict: The user data, None if the user does not exist.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT username, full_name, email, hashed_password, disabled FROM users WHERE username = ?", (username,)
+            ).fetchone()
+        if row is None:
+            return None
+        user = dict(row)
+        user["disabled"] = bool(user["disabled"])
+        return user
+
+    def add(self, user_data: Dict[str, str]) -> str:
+        """
+        Add a user.
+
+        Args:
+            user_data (Dict[str, str]): The user data with the keys username, full_name, email, hashed_password and disabled.
+
+        Returns:
+            str: The id of the new user.
+
+        Raises:
+            ValueError: If the username already exists.
+        """
+        try:
+            with self.lock, self.db:
+                cursor = self.db.execute(
+                    "INSERT INTO users (username, full_name, email, hashed_password, disabled) VALUES (?, ?, ?, ?, ?)",
+                    (user_data["username"], user_data.get("full_name"), user_data.get("email"),
+                     user_data["hashed_password"], int(bool(user_data.get("disabled")))),
+                )
+        except sqlite3.IntegrityError:
+            raise ValueError(f"The username {user_data['username']} already exists")
+        self.writes += 1
+        return str(cursor.lastrowid)
+
+    def update(self, username: str, **fields) -> None:
+        """
+        Update some fields of a user.
+
+        Args:
+            username (str): The username of the user.
+            **fields: The fields to update among full_name, email, hashed_password and disabled.
+
+        Raises:
+            KeyError: If the user does not exist.
+            ValueError: If a field is not a column of the table.
+        """
+        unknown = set(fields) - {"full_name", "email", "hashed_password", "disabled"}
+        if unknown:
+            raise ValueError(f"Unknown user fields: {', '.join(sorted(unknown))}")
+        if "disabled" in fields:
+            fields["disabled"] = int(bool(fields["disabled"]))
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self.lock, self.db:
+            cursor = self.db.execute(f"UPDATE users SET {assignments} WHERE username = ?", (*fields.values(), username))
+        if cursor.rowcount == 0:
+            raise KeyError(username)
+        self.writes += 1
+
+    def set_disabled(self, username: str, disabled: bool = True) -> None:
+        """
+        Disable or enable a user.
+
+        Args:
+            username (str): The username of the user.
+            disabled (bool, optional): True to disable the user, False to enable it. Defaults to True.
+
+        Raises:
+            KeyError: If the user does not exist.
+        """
+        self.update(username, disabled=disabled)
+
+    @property
+    def version(self) -> tuple:
+        """
+        tuple: A value that changes every time this or another connection modifies the users.
+        """
+        with self.lock:
+            data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        return data_version, self.writes
+
+# Create the repository of users selected in the configuration file
+def create_user_repository(config: dict):
+    """
+    Create the repository of users according to the secure section of the configuration file.
+
+    Args:
+        config (dict): A dictionary containing configuration settings.
+
+    Returns:
+        Union[JsonUserRepository, SqliteUserRepository]: The repository of users.
+    """
+    json_path = config['secure'].get('users_json', './data/dummy_users_database.json')
+    if config['secure'].get('users_backend', 'json') == 'sqlite':
+        return SqliteUserRepository(config['secure'].get('users_sqlite', './data/users.db'), seed_path=json_path)
+    return JsonUserRepository(json_path)
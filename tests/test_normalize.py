@@ -0,0 +1,37 @@
+import sys
+import random
+from pathlib import Path
+# Add the project directory to the PYTHONPATH
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest
+from lib.processing_docs import normalize_text
+
+## Tests of the rules of the text normalization
+# Usage (from the main directory, needs pytest): python -m pytest tests
+
+# The examples of the docstring of normalize_text
+@pytest.mark.parametrize("text, expected", [
+    ("# Title\n\ntext", "Title text"),
+    ("a \t b\n\nc", "a b c"),
+    ("end. , next", "end next"),
+    ("end . , next", "end next"),
+    ("end.. next", "end. next"),
+    ("end. . next", "end. next"),
+    ("  text  ", "text"),
+    ("", ""),
+])
+def test_normalize_examples(text, expected):
+    assert normalize_text(text) == expected
+
+# The normalized texts follow the rules of normalize_text, and normalizing them again does not change them
+def test_normalize_rules():
+    rng = random.Random(1)
+    alphabet = ["a", "b", " ", "  ", "\n", "\t", ".", ",", "#", " ,", ". ,", ".."]
+    for _ in range(20000):
+        s = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 16)))
+        normalized = normalize_text(s)
+        assert normalize_text(normalized) == normalized
+        assert normalized == normalized.strip()
+        for removed in ("#", "\n", "\t", "  ", "..", ". .", ". ,"):
+            assert removed not in normalized